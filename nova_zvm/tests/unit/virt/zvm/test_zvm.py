@@ -13,12 +13,18 @@
 #    under the License.
 """Test suite for ZVMDriver."""
 
+import contextlib
+import datetime
+import eventlet
+import hashlib
 import os
 import six
 from six.moves import http_client as httplib
 import socket
+import tarfile
 import time
 
+import fixtures
 import mock
 from mox3 import mox
 from nova.compute import power_state
@@ -33,20 +39,26 @@ from nova.tests.unit import fake_instance
 from nova.virt import configdrive as virt_configdrive
 from nova.virt import fake
 from nova.virt import hardware
-from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_serialization import jsonutils
 from oslo_utils import fileutils
 
+from nova_zvm.virt.zvm import admission
 from nova_zvm.virt.zvm import configdrive
+from nova_zvm.virt.zvm import dag
 from nova_zvm.virt.zvm import dist
 from nova_zvm.virt.zvm import driver
 from nova_zvm.virt.zvm import exception
+from nova_zvm.virt.zvm import imagecache
 from nova_zvm.virt.zvm import imageop
 from nova_zvm.virt.zvm import instance
 from nova_zvm.virt.zvm import networkop
+from nova_zvm.virt.zvm import pool
+from nova_zvm.virt.zvm import prewarm
+from nova_zvm.virt.zvm import timing
 from nova_zvm.virt.zvm import utils as zvmutils
 from nova_zvm.virt.zvm import volumeop
+from nova_zvm.virt.zvm import waiter
 
 
 CONF = cfg.CONF
@@ -136,6 +148,8 @@ class ZVMTestCase(test.TestCase):
                    zvm_zhcp_fcp_list="1FAF",
                    config_drive_format='iso9660',
                    zvm_image_compression_level='0')
+        self.stubs.Set(zvmutils, '_NODE_ATTR_CACHE', None)
+        self.stubs.Set(zvmutils, '_MN_FACTS', None)
 
     def tearDown(self):
         self.addCleanup(self.stubs.UnsetAll)
@@ -319,6 +333,16 @@ class ZVMDriverTestCases(ZVMTestCase):
         self.assertIn("os000001", inst_list)
         self.assertNotIn("xcat", inst_list)
 
+    def test_list_instances_exclude_warm_pool(self):
+        self.flags(zvm_warm_pool_size=1)
+        fake_inst_list = self._fake_instances_list()
+        fake_inst_list.append('"zwp00001","fakehcp.fake.com","ZWP00001",,,,')
+        self._set_fake_xcat_responses([
+            {'data': [{'data': fake_inst_list}]}])
+        inst_list = self.driver.list_instances()
+        self.mox.VerifyAll()
+        self.assertEqual(['os000001'], inst_list)
+
     def test_get_available_resource(self):
         self._set_fake_xcat_responses([self._fake_host_rinv_info(),
                                        self._fake_disk_info()])
@@ -519,6 +543,149 @@ class ZVMDriverTestCases(ZVMTestCase):
         self.driver.spawn({}, self.instance, self.fake_imgmeta_obj(), ['fake'],
                           'fakepass', self._fake_network_info(), {})
 
+    def test_spawn_create_userid_retried(self):
+        self.flags(zvm_spawn_step_retry_interval=0)
+        calls = []
+
+        def _call(name, result=None, error=None):
+            def _func(*args, **kwargs):
+                calls.append(name)
+                if error is not None and calls.count(name) == 1:
+                    raise error
+                return result
+            return _func
+
+        self.stubs.Set(self.instance, 'save', self._fake_fun())
+        self.stubs.Set(self.driver._pathutils, 'get_instance_path',
+                       self._fake_fun('/temp/os000001'))
+        self.stubs.Set(virt_configdrive, 'required_by', self._fake_fun(False))
+        self.stubs.Set(instance.ZVMInstance, 'create_xcat_node',
+                       _call('create_node'))
+        self.stubs.Set(instance.ZVMInstance, 'create_userid',
+                       _call('create_userid',
+                             error=exception.ZVMXCATRequestFailed(
+                                xcatserver='fake', msg='Communication error')))
+        self.stubs.Set(instance.ZVMInstance, 'delete_userid',
+                       _call('delete_userid'))
+        self.stubs.Set(self.driver, '_preset_instance_network',
+                       _call('network'))
+        self.stubs.Set(self.driver, '_add_nic_to_table', self._fake_fun())
+        self.stubs.Set(self.driver._zvm_images, 'image_exist_xcat',
+                       self._fake_fun(True))
+        self.stubs.Set(instance.ZVMInstance, 'update_node_info',
+                       self._fake_fun())
+        self.stubs.Set(self.driver._zvm_images, 'get_imgname_xcat',
+                       self._fake_fun('fakeimg'))
+        self.stubs.Set(dist.LinuxDist,
+                       "create_network_configuration_files",
+                       self._fake_fun((['fakefile', 'fakecmd'])))
+        self.stubs.Set(instance.ZVMInstance, 'deploy_node', self._fake_fun())
+        self.stubs.Set(self.driver._pathutils, 'clean_temp_folder',
+                       self._fake_fun())
+        self.stubs.Set(zvmutils, 'punch_adminpass_file', self._fake_fun())
+        self.stubs.Set(zvmutils, 'punch_iucv_file', self._fake_fun())
+        self.stubs.Set(instance.ZVMInstance, 'power_on', self._fake_fun())
+        self.stubs.Set(self.driver._zvm_images, 'update_last_use_date',
+                       self._fake_fun())
+        self.stubs.Set(self.driver, '_wait_and_get_nic_direct',
+                       self._fake_fun())
+        self.stubs.Set(self.driver._image_api, 'get', self.fake_image_get)
+        self.driver.spawn({}, self.instance, self.fake_imgmeta_obj(), [],
+                          'fakepass', self._fake_network_info(), {})
+
+        # rmvm of the retry removes the network tables of the node, they
+        # are only written once the userid is created
+        self.assertEqual(['create_node', 'create_userid', 'delete_userid',
+                          'create_node', 'create_userid', 'network'], calls)
+
+    @mock.patch.object(zvmutils, 'punch_configdrive_file')
+    @mock.patch.object(pool.WarmPool, 'take_over')
+    @mock.patch.object(instance.ZVMInstance, 'deploy_node')
+    @mock.patch.object(instance.ZVMInstance, 'create_userid')
+    @mock.patch.object(instance.ZVMInstance, 'create_xcat_node')
+    def test_spawn_from_warm_pool(self, create_node, create_userid,
+                                  deploy_node, take_over, punch_configdrive):
+        self.flags(zvm_warm_pool_size=2)
+        warm_pool = self.driver._warm_pool
+        key = warm_pool.get_key(self.instance, {})
+        guest = pool.PoolGuest('zwp00001', key, 'fakeimg')
+        warm_pool._ready[key] = [guest]
+        template = {'image_meta': {'properties': {
+                                            'root_disk_units': '3:CYL'}},
+                    'image_name': 'fakeimg'}
+        warm_pool._templates[key] = template
+
+        self.stubs.Set(self.instance, 'save', self._fake_fun())
+        self.instance['config_drive'] = True
+        self.stubs.Set(self.driver._pathutils, 'get_instance_path',
+                       self._fake_fun('/temp/os000001'))
+        self.stubs.Set(virt_configdrive, 'required_by', self._fake_fun(True))
+        self.stubs.Set(self.driver, '_create_config_drive',
+                       self._fake_fun('/temp/os000001/configdrive.tgz'))
+        self.stubs.Set(self.driver, '_preset_instance_network',
+                       self._fake_fun())
+        self.stubs.Set(instance.ZVMInstance, 'update_node_info',
+                       self._fake_fun())
+        self.stubs.Set(dist.LinuxDist,
+                       "create_network_configuration_files",
+                       self._fake_fun((['fakefile', 'fakecmd'])))
+        self.stubs.Set(self.driver._pathutils, 'clean_temp_folder',
+                       self._fake_fun())
+        self.stubs.Set(self.driver, '_add_nic_to_table', self._fake_fun())
+        self.stubs.Set(zvmutils, 'punch_iucv_file', self._fake_fun())
+        self.stubs.Set(instance.ZVMInstance, 'power_on', self._fake_fun())
+        self.stubs.Set(self.driver._zvm_images, 'update_last_use_date',
+                       self._fake_fun())
+        self.stubs.Set(self.driver, '_wait_and_get_nic_direct',
+                       self._fake_fun())
+        self.stubs.Set(self.driver._image_api, 'get', self.fake_image_get)
+        self.driver.spawn({}, self.instance, self.fake_imgmeta_obj(), ['fake'],
+                          'fakepass', self._fake_network_info(), {})
+
+        create_node.assert_called_once_with('fakehcp.fake.com', 'zwp00001')
+        take_over.assert_called_once_with(guest)
+        punch_configdrive.assert_called_once_with(
+                            '/temp/os000001/configdrive.tgz', 'os000001')
+        self.assertFalse(create_userid.called)
+        self.assertFalse(deploy_node.called)
+        self.assertEqual([], warm_pool._ready[key])
+        self.assertEqual(1, warm_pool._demand[key])
+        # No image was prepared, the template keeps the prepared image meta
+        self.assertIs(template, warm_pool._templates[key])
+
+    @mock.patch.object(instance.ZVMInstance, 'delete_xcat_node')
+    @mock.patch.object(pool.WarmPool, 'take_over')
+    @mock.patch.object(instance.ZVMInstance, 'create_xcat_node')
+    def test_spawn_from_warm_pool_failed(self, create_node, take_over,
+                                         delete_node):
+        self.flags(zvm_warm_pool_size=2)
+        warm_pool = self.driver._warm_pool
+        key = warm_pool.get_key(self.instance, {})
+        guest = pool.PoolGuest('zwp00001', key, 'fakeimg')
+        warm_pool._ready[key] = [guest]
+        create_node.side_effect = exception.ZVMXCATCreateNodeFailed(
+                                                node='os000001', msg='fake')
+
+        self.stubs.Set(self.instance, 'save', self._fake_fun())
+        self.stubs.Set(self.driver._pathutils, 'get_instance_path',
+                       self._fake_fun('/temp/os000001'))
+        self.stubs.Set(virt_configdrive, 'required_by', self._fake_fun(False))
+        self.stubs.Set(dist.LinuxDist,
+                       "create_network_configuration_files",
+                       self._fake_fun((['fakefile', 'fakecmd'])))
+        self.stubs.Set(self.driver._pathutils, 'clean_temp_folder',
+                       self._fake_fun())
+        self.stubs.Set(self.driver._image_api, 'get', self.fake_image_get)
+        self.assertRaises(exception.ZVMXCATCreateNodeFailed,
+                          self.driver.spawn, {}, self.instance,
+                          self.fake_imgmeta_obj(), [], 'fakepass',
+                          self._fake_network_info(), {})
+
+        # The guest was not taken over, it can be claimed again
+        self.assertFalse(take_over.called)
+        delete_node.assert_called_once_with()
+        self.assertEqual([guest], warm_pool._ready[key])
+
     @mock.patch.object(six.moves.builtins, 'open')
     def test_spawn_with_eph(self, mock_open):
         self.instance['config_drive'] = True
@@ -617,10 +784,10 @@ class ZVMDriverTestCases(ZVMTestCase):
             mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(), mox.IgnoreArg(),
             mox.IgnoreArg()).AndReturn('/temp/os000001/configdrive.tgz')
 
-        self.driver._zvm_images.image_exist_xcat(mox.IgnoreArg()).AndReturn(
-                                                                    True)
-        self.driver._zvm_images.get_imgname_xcat(mox.IgnoreArg()).AndReturn(
-                                                                    'fakeimg')
+        self.driver._zvm_images.image_exist_xcat(mox.IgnoreArg(),
+                                    mox.IgnoreArg()).AndReturn(True)
+        self.driver._zvm_images.get_imgname_xcat(mox.IgnoreArg(),
+                                    mox.IgnoreArg()).AndReturn('fakeimg')
         instance.ZVMInstance.create_xcat_node('fakehcp.fake.com')
         instance.ZVMInstance.create_userid(fake_bdi,
             image_meta, mox.IgnoreArg(), 'fakeimg')
@@ -632,13 +799,13 @@ class ZVMDriverTestCases(ZVMTestCase):
         zvmutils.punch_adminpass_file(mox.IgnoreArg(), 'os000001', 'pass',
                                       mox.IgnoreArg())
         zvmutils.punch_iucv_file('rhel6.2', 'fakehcp.fake.com',
-                        'fakehcp', 'os000001', '/temp/os000001')
+                        'fakehcp', 'os000001', '/temp/os000001', bundled=False)
         zvmutils.process_eph_disk('os000001', mox.IgnoreArg(), mox.IgnoreArg(),
                                   mox.IgnoreArg())
         zvmutils.process_eph_disk('os000001', mox.IgnoreArg(), mox.IgnoreArg(),
                                   mox.IgnoreArg())
         self.driver._wait_and_get_nic_direct('os000001')
-        instance.ZVMInstance.power_on()
+        instance.ZVMInstance.power_on(booting=True)
         self.driver._pathutils.clean_temp_folder(mox.IgnoreArg())
         self.driver._zvm_images.update_last_use_date(mox.IgnoreArg())
         self.mox.ReplayAll()
@@ -647,6 +814,20 @@ class ZVMDriverTestCases(ZVMTestCase):
             ['fake'], 'fakepass', self._fake_network_info(), fake_bdi)
         self.mox.VerifyAll()
 
+    @mock.patch.object(zvmutils, 'get_iucv_server_version')
+    def test_image_has_iucv_server(self, get_version):
+        get_version.return_value = 'a' * 32
+        image_meta = self._fake_image_meta()
+        self.assertFalse(self.driver._image_has_iucv_server(image_meta))
+        self.assertFalse(get_version.called)
+
+        image_meta['properties']['iucv_server_version'] = 'a' * 32
+        self.assertTrue(self.driver._image_has_iucv_server(image_meta))
+        get_version.assert_called_once_with('fakehcp')
+
+        image_meta['properties']['iucv_server_version'] = 'b' * 32
+        self.assertFalse(self.driver._image_has_iucv_server(image_meta))
+
     def test_spawn_image_error(self):
         self.stubs.Set(self.instance, 'save', self._fake_fun())
         self.stubs.Set(self.driver._pathutils, 'get_instance_path',
@@ -662,8 +843,8 @@ class ZVMDriverTestCases(ZVMTestCase):
                        "create_network_configuration_files",
                        self._fake_fun(('/tmp/fakefile', 'fakecmd')))
         self.mox.StubOutWithMock(self.driver._zvm_images, 'image_exist_xcat')
-        self.driver._zvm_images.image_exist_xcat(mox.IgnoreArg()
-                                ).AndRaise(exception.ZVMImageError(msg='fake'))
+        self.driver._zvm_images.image_exist_xcat(mox.IgnoreArg(),
+            mox.IgnoreArg()).AndRaise(exception.ZVMImageError(msg='fake'))
         self.stubs.Set(self.driver._image_api, 'get', self.fake_image_get)
         self.mox.ReplayAll()
         self.stubs.Set(instance.ZVMInstance, 'delete_xcat_node',
@@ -673,6 +854,26 @@ class ZVMDriverTestCases(ZVMTestCase):
                           'fakepass', self._fake_network_info(), {})
         self.mox.VerifyAll()
 
+    @mock.patch.object(driver.ZVMDriver, '_import_image_to_xcat')
+    def test_prepare_image_for_spawn_admission(self, import_xcat):
+        self.flags(zvm_diskpool_type='FBA')
+        zvm_images = self.driver._zvm_images
+        self.stubs.Set(zvm_images, 'get_imgname_xcat',
+                       self._fake_fun('fakeimg'))
+        gate = self.driver._admission._gates[admission.IMAGE]
+
+        self.stubs.Set(zvm_images, 'image_exist_xcat', self._fake_fun(True))
+        self.driver._prepare_image_for_spawn({}, self.instance,
+                                             self._fake_image_meta())
+        self.assertFalse(import_xcat.called)
+        self.assertEqual(0, gate.admitted)
+
+        self.stubs.Set(zvm_images, 'image_exist_xcat', self._fake_fun(False))
+        self.driver._prepare_image_for_spawn({}, self.instance,
+                                             self._fake_image_meta())
+        self.assertTrue(import_xcat.called)
+        self.assertEqual(1, gate.admitted)
+
     def test_spawn_deploy_failed(self):
         self.stubs.Set(self.instance, 'save', self._fake_fun())
         self.stubs.Set(self.driver._pathutils, 'get_instance_path',
@@ -714,6 +915,31 @@ class ZVMDriverTestCases(ZVMTestCase):
     def _set_reachable(self, stat):
         return {"data": [{"info": ["os000001: reachable"]}]}
 
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    @mock.patch('nova_zvm.virt.zvm.driver.ZVMDriver._get_nic_switch_info')
+    def test_get_nic_granted_nodes(self, get_switch, xreq):
+        get_switch.side_effect = [{'1000': 'xcatvsw2', '1003': 'xcatvsw3'},
+                                  {'1000': ''}]
+        xreq.return_value = {'errorcode': ['0']}
+        granted = self.driver._get_nic_granted_nodes(['os000001',
+                                                      'os000002'])
+        self.assertEqual(set(['os000001']), granted)
+        # one checknics request per NIC of os000001
+        self.assertEqual(2, xreq.call_count)
+        self.assertIn('&checknics=1000', xreq.call_args_list[0][0][1])
+        self.assertIn('&checknics=1003', xreq.call_args_list[1][0][1])
+        # complete switch info is reused on next check
+        self.assertIn('os000001', self.driver._nic_switch_cache)
+        self.assertNotIn('os000002', self.driver._nic_switch_cache)
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_is_nic_granted_one_of_two(self, xreq):
+        xreq.side_effect = [{'errorcode': ['0']}, {'errorcode': ['1']}]
+        self.assertFalse(self.driver._is_nic_granted('os000001',
+                                {'1000': 'xcatvsw2', '1003': 'xcatvsw3'}))
+        self.assertEqual(2, xreq.call_count)
+        self.assertIn('&checknics=1003', xreq.call_args[0][1])
+
     def test_power_on(self):
         info = ["os000001: Activating OS000001... Done\n"]
         self._set_fake_xcat_responses([self._generate_xcat_resp(info),
@@ -770,6 +996,8 @@ class ZVMDriverTestCases(ZVMTestCase):
         self.stubs.Set(self.driver._zvm_images, 'get_root_disk_units',
                        self._fake_fun(1111))
         self.stubs.Set(os, 'makedirs', self._fake_fun())
+        self.stubs.Set(self.driver, '_get_guest_iucv_server_version',
+                       self._fake_fun())
 
         self.driver.snapshot({}, self.instance, '0000-1111', self._fake_fun())
         self.mox.VerifyAll()
@@ -777,6 +1005,8 @@ class ZVMDriverTestCases(ZVMTestCase):
     def test_snapshot_capture_failed(self):
         self.instance['power_state'] = 0x04
         self.stubs.Set(self.driver, 'power_on', self._fake_fun())
+        self.stubs.Set(self.driver, '_get_guest_iucv_server_version',
+                       self._fake_fun())
         self.stubs.Set(glance, 'get_remote_image_service',
             self._fake_fun((FakeImageService(self._fake_image_meta()), 0)))
         self.stubs.Set(self.driver._zvm_images, 'get_free_space_xcat',
@@ -809,6 +1039,8 @@ class ZVMDriverTestCases(ZVMTestCase):
 
         self.stubs.Set(glance, 'get_remote_image_service',
             self._fake_fun((FakeImageService(self.fake_image_meta), 0)))
+        self.stubs.Set(self.driver, '_get_guest_iucv_server_version',
+                       self._fake_fun())
 
         self.mox.StubOutWithMock(self.driver._zvm_images,
                                  'get_free_space_xcat')
@@ -911,13 +1143,15 @@ class ZVMDriverTestCases(ZVMTestCase):
         self.driver.power_off(self.instance, 60, 10)
         pst.assert_called_once_with("PUT", "softoff")
 
-    @mock.patch('nova_zvm.virt.zvm.instance.ZVMInstance._check_power_stat')
+    @mock.patch('nova_zvm.virt.zvm.waiter.get_power_stats')
     @mock.patch('nova_zvm.virt.zvm.instance.ZVMInstance._power_state')
     def test_power_off_retry(self, pst, get_pst):
-        get_pst.side_effect = [0x00, 0x04]
+        get_pst.side_effect = [{'os000001': power_state.RUNNING},
+                               {'os000001': power_state.SHUTDOWN}]
+        self.driver._state_waiter._interval = 0.01
         self.driver.power_off(self.instance, 60, 10)
         pst.assert_called_once_with("PUT", "softoff")
-        self.assertTrue(get_pst.called)
+        self.assertEqual(2, get_pst.call_count)
 
     def test_power_off_failed(self):
         info = ["os000001: Stopping OS000001... Failed\n"]
@@ -1637,6 +1871,21 @@ class ZVMDriverTestCases(ZVMTestCase):
         self.assertEqual('fakehcp', hcp_info['nodename'])
         self.assertEqual('fakehcp', hcp_info['userid'])
 
+    def test_get_hcp_info_cached(self):
+        self.driver._host_stats = []
+        self.mox.StubOutWithMock(zvmutils, 'get_userid')
+        zvmutils.get_userid('fakehcp').AndReturn('fakehcp')
+        zvmutils.get_userid('fakehcp2').AndReturn('fakehcp2')
+        self.mox.ReplayAll()
+
+        self.driver._get_hcp_info('fakehcp.fake.com')
+        hcp_info = self.driver._get_hcp_info()
+        self.assertEqual('fakehcp', hcp_info['userid'])
+        # zHCP changed
+        hcp_info = self.driver._get_hcp_info('fakehcp2.fake.com')
+        self.mox.VerifyAll()
+        self.assertEqual('fakehcp2', hcp_info['userid'])
+
     def test_get_hcp_info_incorrect_init(self):
         self.driver._host_stats = []
         fake_hcpinfo = {'hostname': 'fakehcp.fake.com',
@@ -1686,6 +1935,24 @@ class ZVMDriverTestCases(ZVMTestCase):
         version = self.driver._get_xcat_version()
         self.assertEqual(version, '2.8.3.5')
 
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_get_xcat_version_cached(self, xreq):
+        xreq.return_value = {'data': [['Version 2.8.3.5 (built Mon Apr 27 '
+                                       '10:50:11 EDT 2015)']]}
+        self.assertEqual('2.8.3.5', self.driver._get_xcat_version())
+        self.assertEqual('2.8.3.5', self.driver._get_xcat_version())
+        xreq.assert_called_once_with('GET', mock.ANY)
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xdsh')
+    def test_rollback_live_migration_at_destination(self, xdsh):
+        xdsh.side_effect = [{'data': [['fakemn: ssh-rsa oldkey']]},
+                            {'data': [['fakemn: ssh-rsa newkey']]}]
+        self.assertEqual('ssh-rsa oldkey', zvmutils.get_mn_pub_key())
+        self.driver.rollback_live_migration_at_destination(self.context,
+                                            self.instance, [], None)
+        # Read again, it may have been rotated
+        self.assertEqual('ssh-rsa newkey', zvmutils.get_mn_pub_key())
+
     def test_has_min_version(self):
         self.driver._xcat_version = '1.2.3.4'
         self.assertFalse(self.driver.has_min_version((1, 3, 3, 4)))
@@ -1770,6 +2037,36 @@ class ZVMInstanceTestCases(ZVMTestCase):
         self._instance.create_xcat_node('fakehcp')
         self.mox.VerifyAll()
 
+    def test_wait_for_reachable_configured_timeout(self):
+        self.flags(zvm_reachable_timeout=300)
+        self.drv._boot_time_model = waiter.BootTimeModel()
+        for sec in (40, 50, 60):
+            self.drv._boot_time_model.record('0000-1111', None, sec)
+        self.drv._state_waiter.wait.return_value = True
+        self._instance._wait_for_reachable()
+        # The boot history only decides when to poll densely
+        self.drv._state_waiter.wait.assert_called_once_with(
+                            'os000001', waiter.REACHABLE, 300, 40)
+
+    @mock.patch.object(instance.ZVMInstance, '_wait_for_reachable')
+    def test_power_on_already_active(self, wait_reachable):
+        self.drv._power_on_batcher.submit.side_effect = (
+            exception.ZVMXCATInternalError(
+                msg="Return Code: 200\nReason Code: 8\n"))
+        # Powering on an active instance returns at once
+        self._instance.power_on()
+        self.assertFalse(wait_reachable.called)
+
+        self._instance._reachable = False
+        self.assertRaises(nova_exception.InstancePowerOnFailure,
+                          self._instance.power_on, booting=True)
+        # May still be booting after the failed batch, wait for it
+        wait_reachable.assert_called_once_with()
+
+        self._instance._reachable = True
+        self._instance.power_on(booting=True)
+        self.assertEqual(2, wait_reachable.call_count)
+
     def test_create_xcat_node_failed(self):
         resp = {'data': [{'errorcode': ['1'],
                           'error': ["One or more errors occured\n"]}]}
@@ -1833,6 +2130,7 @@ class ZVMInstanceTestCases(ZVMTestCase):
 
     def test_create_userid_has_ephemeral(self):
         """Create userid with epheral disk added."""
+        self.drv._xcat_version = '2.8.3.16'
         image_meta = {'name': 'fake',
                       'id': '00-11-22-33',
                       'properties': {'os_version': 'fake',
@@ -1855,6 +2153,7 @@ class ZVMInstanceTestCases(ZVMTestCase):
 
     def test_create_userid_with_eph_opts(self):
         """Create userid with '--ephemeral' options."""
+        self.drv._xcat_version = '2.8.3.16'
         self._instance._instance['root_gb'] = 0
         self._instance._instance['ephemeral_gb'] = 20
         fake_bdi = {'ephemerals': [
@@ -1891,6 +2190,7 @@ class ZVMInstanceTestCases(ZVMTestCase):
 
     def test_create_userid_with_eph_opts_resize(self):
         """Create userid with '--ephemeral' options."""
+        self.drv._xcat_version = '2.8.3.16'
         self._instance._instance['ephemeral_gb'] = 20
         self._instance._instance['root_gb'] = 5
         fake_bdi = {'ephemerals': [
@@ -1925,6 +2225,16 @@ class ZVMInstanceTestCases(ZVMTestCase):
         self._instance.create_userid(fake_bdi, image_meta, {})
         self.mox.VerifyAll()
 
+    @mock.patch.object(instance.ZVMInstance, 'add_mdisk')
+    @mock.patch.object(zvmutils, 'xcat_request')
+    def test_create_userid_disks_added_after_mkvm(self, xcat_req, add_mdisk):
+        image_meta = {'name': 'fake', 'id': '00-11-22-33'}
+        self._instance.create_userid({}, image_meta, {})
+
+        body = xcat_req.call_args[0][2]
+        self.assertEqual([], [p for p in body if p.startswith('mdisk=')])
+        add_mdisk.assert_called_once_with('fakedp', '0100', '10g')
+
     def test_update_node_info(self):
         image_meta = {'name': 'fake#@%4test',
                       'id': '00-11-22-33',
@@ -2259,6 +2569,104 @@ class ZVMUtilsTestCases(ZVMTestCase):
                           zvmutils.parse_os_version,
                           'ubuntu')
 
+    @mock.patch.object(zvmutils, 'add_iucv_in_zvm_table')
+    @mock.patch.object(zvmutils, 'punch_file')
+    def test_punch_iucv_file_bundled(self, punch_file, add_iucv):
+        zvmutils.punch_iucv_file('rhel7.2', 'fakehcp', 'fakeuid',
+                                 'os000001', '/temp/os000001', bundled=True)
+        self.assertEqual(
+            [mock.call('os000001', '/opt/zhcp/bin/IUCV/iucvserv', 'X',
+                       remote_host='fakehcp', del_src=False),
+             mock.call('os000001', '/opt/zhcp/bin/IUCV/iucvserd.service',
+                       'X', remote_host='fakehcp', del_src=False)],
+            punch_file.call_args_list)
+        add_iucv.assert_called_once_with('os000001')
+
+    def test_keyed_lock_reuse(self):
+        locks = zvmutils.KeyedLock()
+        calls = []
+
+        def _func(key):
+            calls.append(key)
+            eventlet.sleep(0.01)
+            return key.upper()
+
+        threads = [eventlet.spawn(locks.run, key, lambda k=key: _func(k))
+                   for key in ('a', 'a', 'b')]
+        self.assertEqual(['A', 'A', 'B'], [t.wait() for t in threads])
+        # 'b' was not blocked by 'a', and the second 'a' reused the result
+        self.assertEqual(['a', 'b'], calls)
+
+    def test_keyed_lock_retry_after_failure(self):
+        locks = zvmutils.KeyedLock()
+        results = [exception.ZVMImageError(msg='fake'), 'ok']
+
+        def _func():
+            eventlet.sleep(0.01)
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        first = eventlet.spawn(locks.run, 'a', _func)
+        second = eventlet.spawn(locks.run, 'a', _func)
+        self.assertRaises(exception.ZVMImageError, first.wait)
+        self.assertEqual('ok', second.wait())
+
+    def test_batcher_combine(self):
+        calls = []
+
+        def _func(items):
+            calls.append(items)
+            eventlet.sleep(0.01)
+            return len(items)
+
+        batcher = zvmutils.Batcher('fake', _func)
+        threads = [eventlet.spawn(batcher.submit, item)
+                   for item in ('a', 'b', 'c')]
+        self.assertEqual([3, 3, 3], [t.wait() for t in threads])
+        self.assertEqual([['a', 'b', 'c']], calls)
+
+        # Nothing pending, the next submit runs on its own
+        self.assertEqual(1, batcher.submit('d'))
+        self.assertEqual(['d'], calls[-1])
+
+    def test_batcher_retry_one_by_one(self):
+        calls = []
+
+        def _func(items):
+            calls.append(items)
+            if 'bad' in items:
+                raise exception.ZVMXCATInternalError(msg='fake')
+
+        batcher = zvmutils.Batcher('fake', _func)
+        good = eventlet.spawn(batcher.submit, 'good')
+        bad = eventlet.spawn(batcher.submit, 'bad')
+        self.assertIsNone(good.wait())
+        self.assertRaises(exception.ZVMXCATInternalError, bad.wait)
+        self.assertEqual([['good', 'bad'], ['good'], ['bad']], calls)
+
+    @mock.patch.object(zvmutils, 'xcat_request')
+    def test_power_on_nodes(self, xcat_request):
+        zvmutils.power_on_nodes(['os000001', 'os000002'])
+        url = zvmutils.get_xcat_url().rpower('/os000001,os000002')
+        xcat_request.assert_called_once_with('PUT', url, ['on'])
+
+    @mock.patch.object(zvmutils, 'xdsh')
+    def test_get_iucv_server_version(self, xdsh):
+        version = '0123456789abcdef0123456789abcdef'
+        xdsh.return_value = {'data': [['fakehcp: %s  /opt/zhcp/bin/IUCV/'
+                                       'iucvserv' % version]]}
+        self.assertEqual(version, zvmutils.get_iucv_server_version('fakehcp'))
+        # cached as MN fact
+        self.assertEqual(version, zvmutils.get_iucv_server_version('fakehcp'))
+        self.assertEqual(1, xdsh.call_count)
+
+    def test_get_iucv_setup_commands(self):
+        cmds = zvmutils.get_iucv_setup_commands('rhel6.5', 'fakeuid')
+        self.assertIn('echo -n fakeuid >/etc/iucv_authorized_userid', cmds)
+        self.assertIn('chkconfig --add iucvserd', cmds)
+
     def test_xcat_cmd_gettab(self):
         fake_resp = {"data": [["/install"]]}
         self.mox.StubOutWithMock(zvmutils, 'xcat_request')
@@ -2286,6 +2694,94 @@ class ZVMUtilsTestCases(ZVMTestCase):
         self.assertEqual(outp['type'], 'fake')
         self.assertEqual(outp['version'], 'fake')
 
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_node_attr_cache_load(self, xreq):
+        xreq.return_value = {'info': [['Object name: os000001',
+                                       '    hcp=fakehcp.fake.com',
+                                       '    provmethod=netboot',
+                                       '    userid=OS000001',
+                                       'Object name: os000002',
+                                       '    userid=OS000002']]}
+        zvmutils.get_node_attr_cache().load('fakegroup')
+        self.assertIn('/nodes/fakegroup', xreq.call_args[0][1])
+
+        xreq.reset_mock()
+        self.assertEqual('OS000001', zvmutils.get_userid('os000001'))
+        self.assertEqual('OS000002', zvmutils.get_userid('os000002'))
+        self.assertEqual('netboot', zvmutils.xcat_cmd_gettab('nodetype',
+                                        'node', 'os000001', 'provmethod'))
+        self.assertFalse(xreq.called)
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_node_attr_cache_settab(self, xreq):
+        xreq.return_value = {'data': []}
+        zvmutils.xcat_cmd_settab('zvm', 'node', 'os000001', 'hcp',
+                                 'fakehcp.fake.com')
+        zvmutils.xcat_cmd_settab('zvm', 'node', 'os000001', 'status',
+                                 'IUCV=1')
+        xreq.reset_mock()
+        self.assertEqual('fakehcp.fake.com', zvmutils.xcat_cmd_gettab('zvm',
+                                                'node', 'os000001', 'hcp'))
+        self.assertFalse(xreq.called)
+
+        # xCAT writes the status too, it is always read again
+        xreq.return_value = {'data': [['IUCV=1;CLONE_ONLY=1']]}
+        self.assertEqual('IUCV=1;CLONE_ONLY=1', zvmutils.xcat_cmd_gettab(
+                                        'zvm', 'node', 'os000001', 'status'))
+        xreq.assert_called_once_with('GET', mock.ANY)
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_get_userid_cached_on_miss(self, xreq):
+        xreq.return_value = {'info': [['Object name: os000001',
+                                       '    userid=OS000001']]}
+        self.assertEqual('OS000001', zvmutils.get_userid('os000001'))
+        self.assertEqual('OS000001', zvmutils.get_userid('os000001'))
+        xreq.assert_called_once_with('GET', mock.ANY)
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_node_attr_cache_expired(self, xreq):
+        self.flags(zvm_node_attr_refresh_interval=10)
+        xreq.return_value = {'info': [['Object name: os000001',
+                                       '    userid=OS000001']]}
+        self.assertEqual('OS000001', zvmutils.get_userid('os000001'))
+
+        # Changed by another compute node
+        xreq.return_value = {'info': [['Object name: os000001',
+                                       '    userid=OS000002']]}
+        self.assertEqual('OS000001', zvmutils.get_userid('os000001'))
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.assertEqual('OS000002', zvmutils.get_userid('os000001'))
+        self.assertEqual(2, xreq.call_count)
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xdsh')
+    def test_get_mn_pub_key_cached(self, xdsh):
+        xdsh.return_value = {'data': [['fakemn: ssh-rsa fakekey']]}
+        self.assertEqual('ssh-rsa fakekey', zvmutils.get_mn_pub_key())
+        self.assertEqual('ssh-rsa fakekey', zvmutils.get_mn_pub_key())
+        self.assertEqual(1, xdsh.call_count)
+
+    def test_mn_facts_expired(self):
+        self.flags(zvm_mn_facts_refresh_interval=10)
+        facts = zvmutils.MNFacts()
+        facts.set('fact', 'old')
+        self.assertEqual('old', facts.get('fact', lambda: 'new'))
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.assertIsNone(facts.get('fact'))
+            self.assertEqual('new', facts.get('fact', lambda: 'new'))
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_xcat_cmd_gettab_rows(self, xreq):
+        xreq.return_value = {'data': [['switch.interface: 1000'],
+                                      ['switch.switch: xcatvsw2'],
+                                      ['switch.interface: 1003'],
+                                      ['switch.switch: ']]}
+        rows = zvmutils.xcat_cmd_gettab_rows('switch', 'node', 'os000001',
+                                             ['interface', 'switch'])
+        self.assertEqual([{'interface': '1000', 'switch': 'xcatvsw2'},
+                          {'interface': '1003', 'switch': ''}], rows)
+        self.assertIn('&col=node=os000001&&attribute=interface'
+                      '&attribute=switch', xreq.call_args[0][1])
+
     def test_generate_network_configration(self):
         network = model.Network(bridge=None, subnets=[model.Subnet(
                   ips=[model.FixedIP(meta={}, version=4, type=u'fixed',
@@ -2322,6 +2818,26 @@ class ZVMUtilsTestCases(ZVMTestCase):
         # expect called 2 times
         fake_func.assert_has_calls([(), ()])
 
+    def test_is_transient_error(self):
+        def _failed(msg):
+            return exception.ZVMXCATRequestFailed(xcatserver='fake', msg=msg)
+
+        self.assertTrue(zvmutils.is_transient_error(
+                            _failed('Communication error: refused')))
+        self.assertTrue(zvmutils.is_transient_error(
+                            _failed("{'status': 503, 'reason': ''}")))
+        self.assertTrue(zvmutils.is_transient_error(
+                            exception.ZVMXCATInternalError(
+                                msg='Return Code: 596\nReason Code: 3610')))
+        # The request may have been done
+        self.assertFalse(zvmutils.is_transient_error(
+                            _failed('Failed to get response from xCAT: '
+                                    'timed out')))
+        self.assertFalse(zvmutils.is_transient_error(
+                            _failed("{'status': 504, 'reason': ''}")))
+        self.assertFalse(zvmutils.is_transient_error(
+                            exception.ZVMDriverError(msg='fake')))
+
     @mock.patch.object(zvmutils, "LOG")
     def test_expect_invalid_xcat_resp_data_list(self, mock_log):
         data = ['abcdef']
@@ -2356,6 +2872,551 @@ class ZVMUtilsTestCases(ZVMTestCase):
                 zvmutils.remove_prefix_of_unicode('uuuuasd81m.qw38927u'))
 
 
+class ZVMStateWaiterTestCases(ZVMTestCase):
+    """Test cases for zvm.waiter."""
+
+    def setUp(self):
+        super(ZVMStateWaiterTestCases, self).setUp()
+        self._waiter = waiter.StateWaiter(interval=0.01)
+        self._checker = mock.Mock()
+        self._waiter.register(waiter.REACHABLE, self._checker)
+
+    def test_wait_reached(self):
+        self._checker.side_effect = [set(), set(['os000001'])]
+        self.assertTrue(self._waiter.wait('os000001', waiter.REACHABLE, 10))
+        self.assertEqual(2, self._checker.call_count)
+        self.assertEqual(0, self._waiter.pending_count())
+
+    def test_wait_timeout(self):
+        self._checker.return_value = set()
+        self.assertFalse(self._waiter.wait('os000001', waiter.REACHABLE,
+                                           0.05))
+        self.assertEqual(0, self._waiter.pending_count())
+
+    def test_wait_check_error_retried(self):
+        self._checker.side_effect = [exception.ZVMXCATInternalError(msg='e'),
+                                     set(['os000001'])]
+        self.assertTrue(self._waiter.wait('os000001', waiter.REACHABLE, 10))
+
+    def test_wait_check_error_bisected(self):
+        def _check(nodes):
+            if 'os000003' in nodes:
+                raise exception.ZVMXCATInternalError(msg='e')
+            return set(nodes)
+
+        self._checker.side_effect = _check
+        threads = [eventlet.spawn(self._waiter.wait, node, waiter.REACHABLE,
+                                  0.1)
+                   for node in ('os000001', 'os000002', 'os000003')]
+        # The healthy nodes are done despite the failing one
+        self.assertEqual([True, True, False], [t.wait() for t in threads])
+
+    def test_wait_check_request_failed_not_bisected(self):
+        self._checker.side_effect = exception.ZVMXCATRequestFailed(
+                                    xcatserver='fake', msg="'status': 503")
+        threads = [eventlet.spawn(self._waiter.wait, node, waiter.REACHABLE,
+                                  0.01)
+                   for node in ('os000001', 'os000002', 'os000003')]
+        self.assertEqual([False, False, False], [t.wait() for t in threads])
+        # One request per tick for the whole batch
+        for call in self._checker.call_args_list:
+            self.assertEqual(3, len(call[0][0]))
+
+    def test_wait_unknown_state(self):
+        self.assertRaises(exception.ZVMDriverError, self._waiter.wait,
+                          'os000001', waiter.POWER_OFF)
+
+    def test_wait_multiplexed(self):
+        self._checker.side_effect = lambda nodes: set(nodes)
+        threads = [eventlet.spawn(self._waiter.wait, node, waiter.REACHABLE,
+                                  10) for node in ('os000001', 'os000002')]
+        self.assertEqual([True, True], [t.wait() for t in threads])
+        self._checker.assert_called_once_with(mock.ANY)
+        self.assertEqual(set(['os000001', 'os000002']),
+                         set(self._checker.call_args[0][0]))
+
+    def test_waiter_first_dense_check(self):
+        w = waiter._Waiter('os000001', 0, dense_after=20)
+        w.checked(w.dense_after - 40, 5)
+        self.assertEqual(w.dense_after - 10, w.next_check)
+        # Not later than the expected time
+        w.checked(w.dense_after - 10, 5)
+        self.assertEqual(w.dense_after, w.next_check)
+        w.checked(w.dense_after, 5)
+        self.assertEqual(w.dense_after + 5, w.next_check)
+
+    def test_wait_sparse_before_dense_after(self):
+        self._checker.return_value = set()
+        self.assertFalse(self._waiter.wait('os000001', waiter.REACHABLE,
+                                           0.03, dense_after=10))
+        # only the first check happens in the sparse period
+        self.assertEqual(1, self._checker.call_count)
+
+    def test_wait_adaptive_interval(self):
+        self._waiter._interval = 10
+        self._waiter.register(waiter.NICS_GRANTED, self._checker, 0.01)
+        self._checker.side_effect = [set(), set(), set(['os000001'])]
+        start = time.time()
+        self.assertTrue(self._waiter.wait('os000001', waiter.NICS_GRANTED,
+                                          10))
+        self.assertEqual(3, self._checker.call_count)
+        self.assertLess(time.time() - start, 1)
+
+    def test_boot_time_model(self):
+        model = waiter.BootTimeModel()
+        self.assertIsNone(model.expected('img1', 'rhel7'))
+        self.assertEqual(0, model.dense_after('img1', 'rhel7'))
+        for sec in (40, 50, 60):
+            model.record('img1', 'rhel7', sec)
+        self.assertEqual(50, model.expected('img1', 'rhel7'))
+        self.assertEqual(40, model.dense_after('img1', 'rhel7'))
+        # new image of a known distro uses the distro history
+        self.assertEqual(50, model.expected('img2', 'rhel7'))
+        self.assertIsNone(model.expected('img2', 'sles12'))
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_get_reachable_nodes(self, xreq):
+        xreq.return_value = {'info': [['os000001: reachable\n'
+                                       'os000002: unreachable']]}
+        self.assertEqual(set(['os000001']),
+            waiter.get_reachable_nodes(['os000001', 'os000002']))
+        self.assertEqual("PUT", xreq.call_args[0][0])
+        self.assertIn('/os000001,os000002', xreq.call_args[0][1])
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_get_powered_off_nodes(self, xreq):
+        xreq.return_value = {'info': [['os000001: on\nos000002: off']]}
+        self.assertEqual(set(['os000002']),
+            waiter.get_powered_off_nodes(['os000001', 'os000002']))
+
+
+class ZVMDAGExecutorTestCases(test.NoDBTestCase):
+    """Test cases for zvm.dag."""
+
+    def setUp(self):
+        super(ZVMDAGExecutorTestCases, self).setUp()
+        self.calls = []
+
+    def _step(self, name, exc=None):
+        def _func():
+            self.calls.append(name)
+            eventlet.sleep(0)
+            if exc is not None:
+                raise exc
+        return _func
+
+    def test_run_order(self):
+        flow = dag.DAGExecutor('fake')
+        flow.add('c', self._step('c'), requires=['a', 'b'])
+        flow.add('a', self._step('a'))
+        flow.add('b', self._step('b'), requires=['a'])
+        flow.run()
+        self.assertEqual(['a', 'b', 'c'], self.calls)
+        self.assertEqual(['a', 'b', 'c'], flow.done)
+
+    def test_run_concurrent(self):
+        running = []
+
+        def _func():
+            running.append(1)
+            eventlet.sleep(0.01)
+            self.calls.append(len(running))
+
+        flow = dag.DAGExecutor('fake', max_workers=2)
+        for name in ('a', 'b', 'c'):
+            flow.add(name, _func)
+        flow.run()
+        # two steps started before the first one finished
+        self.assertEqual(2, self.calls[0])
+
+    def test_run_failed_rollback(self):
+        rollback = mock.Mock()
+        flow = dag.DAGExecutor('fake')
+        flow.add('a', self._step('a'), rollback=rollback.a)
+        flow.add('b', self._step('b', exception.ZVMDriverError(msg='fake')),
+                 requires=['a'], rollback=rollback.b)
+        flow.add('c', self._step('c'), requires=['b'], rollback=rollback.c)
+        self.assertRaises(exception.ZVMDriverError, flow.run)
+        self.assertEqual(['a', 'b'], self.calls)
+        self.assertEqual(['b', 'a'], flow.rolled_back)
+        self.assertEqual([mock.call.b(), mock.call.a()],
+                         rollback.mock_calls)
+
+    def test_run_dependency_cycle(self):
+        flow = dag.DAGExecutor('fake')
+        flow.add('a', self._step('a'), requires=['b'])
+        flow.add('b', self._step('b'), requires=['a'])
+        self.assertRaises(exception.ZVMDriverError, flow.run)
+        self.assertEqual([], self.calls)
+
+    def test_run_unknown_step(self):
+        flow = dag.DAGExecutor('fake')
+        flow.add('a', self._step('a'), requires=['x'])
+        self.assertRaises(exception.ZVMDriverError, flow.run)
+
+    def test_run_timed(self):
+        timer = timing.PhaseTimer()
+        flow = dag.DAGExecutor('fake', timer=timer)
+        flow.add('a', self._step('a'))
+        flow.add('b', self._step('b'), requires=['a'])
+        flow.run()
+        self.assertEqual(['a', 'b'], list(timer.timings.keys()))
+
+    def _flaky_step(self, name, failures):
+        def _func():
+            self.calls.append(name)
+            if failures:
+                raise failures.pop(0)
+        return _func
+
+    def test_run_retry(self):
+        undo = mock.Mock()
+        transient = exception.ZVMXCATRequestFailed(xcatserver='fake',
+                                                   msg='Communication error')
+        flow = dag.DAGExecutor('fake', retry_if=zvmutils.is_transient_error)
+        flow.add('a', self._step('a'))
+        flow.add('b', self._flaky_step('b', [transient, transient]),
+                 requires=['a'], retries=2, undo=undo)
+        flow.run()
+        # the done step is kept, the failed one is cleaned up and done again
+        self.assertEqual(['a', 'b', 'b', 'b'], self.calls)
+        self.assertEqual(2, undo.call_count)
+        self.assertEqual({'b': 2}, flow.retried)
+        self.assertEqual(['a', 'b'], flow.done)
+
+    def test_run_retry_exhausted(self):
+        rollback = mock.Mock()
+        failures = [exception.ZVMXCATInternalError(msg='Return Code: 596')
+                    for i in range(3)]
+        flow = dag.DAGExecutor('fake', retry_if=zvmutils.is_transient_error)
+        flow.add('a', self._flaky_step('a', failures), retries=2,
+                 rollback=rollback)
+        self.assertRaises(exception.ZVMXCATInternalError, flow.run)
+        self.assertEqual(['a', 'a', 'a'], self.calls)
+        rollback.assert_called_once_with()
+
+    def test_run_no_retry(self):
+        undo = mock.Mock()
+        flow = dag.DAGExecutor('fake', retry_if=zvmutils.is_transient_error)
+        flow.add('a', self._step('a', exception.ZVMDriverError(msg='fake')),
+                 retries=2, undo=undo)
+        self.assertRaises(exception.ZVMDriverError, flow.run)
+        self.assertEqual(['a'], self.calls)
+        self.assertFalse(undo.called)
+        self.assertEqual({}, flow.retried)
+
+    def test_run_retry_undo_failed(self):
+        undo = mock.Mock(side_effect=exception.ZVMDriverError(msg='undo'))
+        transient = exception.ZVMXCATRequestFailed(xcatserver='fake',
+                                                   msg='Communication error')
+        flow = dag.DAGExecutor('fake', retry_if=zvmutils.is_transient_error)
+        flow.add('a', self._flaky_step('a', [transient]), retries=2,
+                 undo=undo)
+        # the original error is raised
+        self.assertRaises(exception.ZVMXCATRequestFailed, flow.run)
+        self.assertEqual(['a'], self.calls)
+
+
+class ZVMTimingTestCases(test.NoDBTestCase):
+    """Test cases for zvm.timing."""
+
+    def setUp(self):
+        super(ZVMTimingTestCases, self).setUp()
+        timing.reset()
+        self.addCleanup(timing.reset)
+
+    def test_histogram(self):
+        hist = timing.Histogram()
+        for seconds in (0.5, 1.5, 45, 4000):
+            hist.add(seconds)
+        stats = hist.to_dict()
+        self.assertEqual(4, stats['count'])
+        self.assertEqual(4047, stats['sum'])
+        self.assertEqual(4000, stats['max'])
+        self.assertEqual(1, stats['buckets']['le_1'])
+        self.assertEqual(1, stats['buckets']['le_2'])
+        self.assertEqual(1, stats['buckets']['le_60'])
+        self.assertEqual(1, stats['buckets']['inf'])
+
+    @mock.patch('time.time')
+    def test_phase_timer(self, time_mock):
+        time_mock.side_effect = [0, 0, 2, 2, 5, 6, 7, 10]
+        timer = timing.PhaseTimer('fake')
+        with timer.phase('a'):
+            pass
+        timer.start_phase('b')
+        with timer.phase('c'):
+            pass
+        self.assertEqual(10, timer.finish())
+        self.assertEqual('a=2.0s, c=1.0s, b=5.0s', timer.summary())
+        stats = timing.get_stats()['fake']
+        self.assertEqual(['a', 'b', 'c', 'total'], sorted(stats.keys()))
+        self.assertEqual(10, stats['total']['sum'])
+
+    def test_phase_timer_no_operation(self):
+        timer = timing.PhaseTimer()
+        with timer.phase('a'):
+            pass
+        timer.finish()
+        self.assertIn('a', timer.timings)
+        self.assertEqual({}, timing.get_stats())
+
+    def test_export(self):
+        path = os.path.join(self.useFixture(fixtures.TempDir()).path,
+                            'stats.json')
+        self.flags(zvm_phase_stats_file=path)
+        timing.record('spawn', 'mkvm', 3)
+        timing.PhaseTimer('spawn').finish()
+        with open(path) as f:
+            stats = jsonutils.loads(f.read())
+        self.assertEqual(1, stats['spawn']['mkvm']['count'])
+        self.assertEqual(1, stats['spawn']['mkvm']['buckets']['le_5'])
+        self.assertIn('total', stats['spawn'])
+
+
+class ZVMAdmissionTestCases(test.NoDBTestCase):
+    """Test cases for zvm.admission."""
+
+    def setUp(self):
+        super(ZVMAdmissionTestCases, self).setUp()
+        timing.reset()
+        self.addCleanup(timing.reset)
+        self.entered = []
+
+    def _enter(self, gate, name):
+        with gate.admit():
+            self.entered.append(name)
+            eventlet.sleep(0.01)
+
+    def test_gate_limit_fifo(self):
+        gate = admission.Gate('fake', 1)
+        threads = [eventlet.spawn(self._enter, gate, name)
+                   for name in ('a', 'b', 'c')]
+        eventlet.sleep(0)
+        self.assertEqual(['a'], self.entered)
+        self.assertEqual({'limit': 1, 'active': 1, 'queued': 2,
+                          'max_queued': 2, 'admitted': 1}, gate.to_dict())
+        for t in threads:
+            t.wait()
+        self.assertEqual(['a', 'b', 'c'], self.entered)
+        self.assertEqual(0, gate.to_dict()['active'])
+        self.assertEqual(3, timing.get_stats()['admission']['fake']['count'])
+
+    def test_gate_no_limit(self):
+        gate = admission.Gate('fake', 0)
+        threads = [eventlet.spawn(self._enter, gate, name)
+                   for name in ('a', 'b', 'c')]
+        eventlet.sleep(0)
+        self.assertEqual(['a', 'b', 'c'], self.entered)
+        for t in threads:
+            t.wait()
+        self.assertEqual(0, gate.to_dict()['max_queued'])
+
+    def test_controller_stats(self):
+        self.flags(zvm_spawn_image_concurrency=1)
+        controller = admission.AdmissionController()
+        with controller.admit(admission.IMAGE):
+            stats = controller.get_stats()
+        self.assertEqual(1, stats[admission.IMAGE]['active'])
+        self.assertEqual(1, stats[admission.IMAGE]['limit'])
+        self.assertEqual(0, stats[admission.DEPLOY]['admitted'])
+
+
+class ZVMWarmPoolTestCases(ZVMTestCase):
+    """Test cases for zvm.pool."""
+
+    def setUp(self):
+        super(ZVMWarmPoolTestCases, self).setUp()
+        self.flags(zvm_warm_pool_size=3, zvm_warm_pool_refill_rate=3)
+        self.drv = mock.Mock()
+        self.drv._get_hcp_info.return_value = {
+            'hostname': 'fakehcp.fake.com', 'nodename': 'fakehcp'}
+        self.drv._admission = admission.AdmissionController()
+        self.pool = pool.WarmPool(self.drv)
+        self.key = pool.WarmPool.get_key(self.instance, {})
+
+    def test_get_key(self):
+        self.assertEqual(('0000-1111', 1024, 2, 10, 0), self.key)
+        self.assertIsNone(pool.WarmPool.get_key(self.instance,
+                                            {'ephemerals': [{'size': 1}]}))
+
+    def test_claim(self):
+        self.assertIsNone(self.pool.claim(self.key))
+        guest = pool.PoolGuest('zwp00001', self.key, 'fakeimg')
+        self.pool._ready[self.key] = [guest]
+        self.assertIs(guest, self.pool.claim(self.key))
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats['claimed'])
+        self.assertEqual(1, stats['missed'])
+        self.assertEqual(0, stats['ready'])
+
+    def test_release(self):
+        guests = [pool.PoolGuest('zwp0000%d' % i, self.key, 'fakeimg')
+                  for i in (1, 2)]
+        self.pool._ready[self.key] = list(guests)
+        guest = self.pool.claim(self.key)
+        self.pool.release(guest)
+        self.assertEqual(guests, self.pool._ready[self.key])
+        self.assertEqual(0, self.pool.get_stats()['claimed'])
+
+    def test_claim_disabled(self):
+        self.flags(zvm_warm_pool_size=0)
+        self.pool._ready[self.key] = [
+                        pool.PoolGuest('zwp00001', self.key, 'fakeimg')]
+        self.assertIsNone(self.pool.claim(self.key))
+        self.assertFalse(self.pool.owns('zwp00001'))
+
+    def test_plan(self):
+        self.flags(zvm_warm_pool_targets=['2222-3333:0'],
+                   zvm_warm_pool_default_target=2)
+        small = ('0000-1111', 512, 1, 10, 0)
+        other = ('2222-3333', 1024, 2, 10, 0)
+        for key in (self.key, self.key, small, other):
+            self.pool.record_spawn(key, {}, 'fakeimg')
+        # Only the most spawned flavor, and nothing for a target of 0
+        self.assertEqual([self.key, self.key], self.pool.plan())
+
+        self.pool._ready[self.key] = [
+                        pool.PoolGuest('zwp00001', self.key, 'fakeimg')]
+        self.assertEqual([self.key], self.pool.plan())
+
+    def test_plan_pool_size(self):
+        self.flags(zvm_warm_pool_default_target=5)
+        other = ('2222-3333', 1024, 2, 10, 0)
+        for key in (self.key, self.key, other):
+            self.pool.record_spawn(key, {}, 'fakeimg')
+        self.assertEqual([self.key, other, self.key], self.pool.plan())
+
+    def test_next_node(self):
+        self.pool._seq = 41
+        self.assertEqual('zwp00042', self.pool._next_node())
+
+    @mock.patch.object(instance.ZVMInstance, 'deploy_node')
+    @mock.patch.object(instance.ZVMInstance, 'update_node_info')
+    @mock.patch.object(instance.ZVMInstance, 'create_userid')
+    @mock.patch.object(instance.ZVMInstance, 'create_xcat_node')
+    def test_refill(self, create_node, create_userid, update_node_info,
+                    deploy_node):
+        self.flags(zvm_warm_pool_refill_rate=1)
+        self.pool.record_spawn(self.key, {'name': 'fake'}, 'fakeimg')
+        self.pool.refill()
+        create_node.assert_called_once_with('fakehcp.fake.com')
+        create_userid.assert_called_once_with({}, {'name': 'fake'}, None,
+                                              'fakeimg')
+        deploy_node.assert_called_once_with('fakeimg')
+        guest = self.pool._ready[self.key][0]
+        self.assertEqual('zwp00001', guest.node)
+        self.assertEqual('fakeimg', guest.image_name)
+        self.assertEqual(1, self.pool.get_stats()['created'])
+
+    @mock.patch.object(instance.ZVMInstance, 'delete_userid')
+    @mock.patch.object(instance.ZVMInstance, 'create_userid')
+    @mock.patch.object(instance.ZVMInstance, 'create_xcat_node')
+    def test_refill_failed(self, create_node, create_userid, delete_userid):
+        self.flags(zvm_warm_pool_refill_rate=1)
+        create_userid.side_effect = exception.ZVMXCATCreateUserIdFailed(
+                                            instance='zwp00001', msg='fake')
+        self.pool.record_spawn(self.key, {'name': 'fake'}, 'fakeimg')
+        self.pool.refill()
+        delete_userid.assert_called_once_with('fakehcp', None)
+        self.assertEqual({}, self.pool._ready)
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats['failed'])
+        self.assertEqual(0, stats['creating'])
+
+    @mock.patch.object(instance.ZVMInstance, 'delete_userid')
+    @mock.patch.object(instance.ZVMInstance, 'deploy_node')
+    @mock.patch.object(instance.ZVMInstance, 'update_node_info')
+    @mock.patch.object(instance.ZVMInstance, 'create_userid')
+    @mock.patch.object(instance.ZVMInstance, 'create_xcat_node')
+    def test_refill_unexpected_error(self, create_node, create_userid,
+                                     update_node_info, deploy_node,
+                                     delete_userid):
+        create_userid.side_effect = [KeyError('root_disk_units'), None]
+        self.flags(zvm_warm_pool_refill_rate=2,
+                   zvm_warm_pool_default_target=2)
+        self.pool.record_spawn(self.key, {'name': 'fake'}, 'fakeimg')
+        self.pool.record_spawn(self.key, None, None)
+        self.assertEqual('fakeimg',
+                         self.pool._templates[self.key]['image_name'])
+        self.pool.refill()
+        # The failed guest is deleted, the next one is still created
+        delete_userid.assert_called_once_with('fakehcp', None)
+        self.assertEqual(2, create_userid.call_count)
+        self.assertEqual(1, len(self.pool._ready[self.key]))
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats['failed'])
+        self.assertEqual(1, stats['created'])
+
+    @mock.patch.object(instance.ZVMInstance, 'delete_userid')
+    def test_clean_leftovers(self, delete_userid):
+        self.drv._list_guest_nodes.return_value = ['os000001', 'zwp00007']
+        self.pool._clean_leftovers()
+        delete_userid.assert_called_once_with('fakehcp', None)
+        self.assertEqual('zwp00008', self.pool._next_node())
+
+
+class ZVMImagePrewarmTestCases(ZVMTestCase):
+    """Test cases for zvm.prewarm."""
+
+    def setUp(self):
+        super(ZVMImagePrewarmTestCases, self).setUp()
+        self.flags(zvm_image_prewarm_top=2, xcat_free_space_threshold=50)
+        self.drv = mock.Mock()
+        self.drv._zvm_images.image_exist_xcat.return_value = False
+        self.drv._image_api.get.side_effect = lambda ctx, image_id: {
+                                    'id': image_id, 'size': 10 * 1024 ** 3}
+        self.prewarmer = prewarm.ImagePrewarmer(self.drv)
+
+    def test_get_candidates(self):
+        self.flags(zvm_image_prewarm_images=['img3', ' img1'])
+        for image_id in ('img1', 'img2', 'img2', 'img4', 'img4', 'img4',
+                         'img5'):
+            self.prewarmer.record_spawn(image_id)
+        self.assertEqual(['img3', 'img1', 'img4', 'img2'],
+                         self.prewarmer.get_candidates())
+
+    def test_run(self):
+        self.drv._zvm_images.image_exist_xcat.side_effect = (
+                                                    lambda i: i == 'img2')
+        self.drv._zvm_images.get_free_space_xcat.return_value = 75
+        self.flags(zvm_image_prewarm_top=3)
+        instances = [{'image_ref': i} for i in ('img1', 'img2', 'img2',
+                                               'img3', 'img3', 'img3')]
+        self.prewarmer.run(self.context, instances)
+        # Spawn counts are seeded from the instances only once
+        self.prewarmer.run(self.context, instances)
+        self.assertEqual(3, self.prewarmer._spawns['img3'])
+
+        # One image per pass, img3 first
+        prepare = self.drv._prepare_image_for_spawn
+        self.assertEqual(2, prepare.call_count)
+        inst, image_meta = prepare.call_args[0][1:]
+        self.assertEqual('img3', inst['image_ref'])
+        self.assertEqual('img3', image_meta['id'])
+        self.assertEqual(2, self.prewarmer.get_stats()['imported'])
+
+        # Neither fits: 65 - 2 * 10 < 50
+        self.drv._zvm_images.get_free_space_xcat.return_value = 65
+        self.prewarmer.run(self.context, instances)
+        self.assertEqual(2, prepare.call_count)
+        self.assertEqual(2, self.prewarmer.get_stats()['no_space'])
+
+    def test_run_failed(self):
+        self.flags(zvm_image_prewarm_images=['img1'])
+        self.drv._zvm_images.get_free_space_xcat.return_value = 100
+        self.drv._prepare_image_for_spawn.side_effect = (
+                                    exception.ZVMImageError(msg='fake'))
+        self.prewarmer.run(self.context, [])
+        self.drv._prepare_image_for_spawn.side_effect = (
+                                    nova_exception.ImageNotFound(
+                                                        image_id='img1'))
+        self.prewarmer.run(self.context, [])
+        stats = self.prewarmer.get_stats()
+        self.assertEqual(2, stats['failed'])
+        self.assertEqual(0, stats['imported'])
+
+
 class ZVMConfigDriveTestCase(test.NoDBTestCase):
 
     def setUp(self):
@@ -4269,34 +5330,68 @@ class ZVMImageOPTestCases(ZVMTestCase):
                           self.imageop.get_image_file_name, '/fake')
         self.mox.VerifyAll()
 
-    @mock.patch('nova.utils.execute')
-    def test_get_root_disk_units(self, mk_exec):
-        # mk_exec.return_value = (''.join(['CKD', '1' * 160]), None)
-        mk_exec.return_value = (('00000000  78 43 41 54 20 43 4b 44  20 44 69'
-        ' 73 6b 20 49 6d  |xCAT CKD Disk Im| 00000010  61 67 65 3a 20 20 20 20'
-        '  20 20 20 20 33 33 33 38  |age:        3338| 00000020  20 43 59 4c'
-        ' 20 48 4c 65  6e 3a 20 30 30 35 35 20  | CYL HLen: 0055 | 00000030'),
-                                None)
+    def _write_image(self, header):
+        tmp_path = self.useFixture(fixtures.TempDir()).path
+        image_file = os.path.join(tmp_path, 'fake.img')
+        with open(image_file, 'wb') as f:
+            f.write(header + b'\0' * 100)
+        return image_file
+
+    def test_get_root_disk_units(self):
+        image_file = self._write_image(
+                    b'xCAT CKD Disk Image:        3338 CYL HLen: 0055 ')
         self.assertEqual('3338:CYL',
-                         self.imageop.get_root_disk_units('/fake'))
+                         self.imageop.get_root_disk_units(image_file))
+        image_file = self._write_image(
+                    b'xCAT FBA Disk Image:   578181045 BLK HLen: 0055 ')
+        self.assertEqual('578181045:BLK',
+                         self.imageop.get_root_disk_units(image_file))
 
-    @mock.patch('nova.utils.execute')
-    def test_get_root_disk_units_cmd_err(self, mk_exec):
-        mk_exec.side_effect = processutils.ProcessExecutionError
+    def test_get_root_disk_units_no_file(self):
         self.assertRaises(exception.ZVMImageError,
-                         self.imageop.get_root_disk_units, '/fake')
+                         self.imageop.get_root_disk_units, '/fake/fake.img')
 
-    @mock.patch('nova.utils.execute')
-    def test_get_root_disk_units_value_err(self, mk_exec):
-        mk_exec.return_value = (''.join(['CKD', 's' * 160]), None)
-        self.assertRaises(exception.ZVMImageError,
-                         self.imageop.get_root_disk_units, '/fake')
+    def test_get_root_disk_units_value_err(self):
+        for header in (b'xCAT CKD Disk Image:        ssss CYL HLen: 0055 ',
+                       b'xCAT CKD Disk Image:        3338 BLK HLen: 0055 ',
+                       b'xCAT CKD'):
+            image_file = self._write_image(header)
+            self.assertRaises(exception.ZVMImageError,
+                             self.imageop.get_root_disk_units, image_file)
 
-    @mock.patch('nova.utils.execute')
-    def test_get_root_disk_units_invalid_type(self, mk_exec):
-        mk_exec.return_value = ('1' * 160, None)
+    def test_get_root_disk_units_invalid_type(self):
+        image_file = self._write_image(b'1' * 48)
         self.assertRaises(exception.ZVMImageError,
-                         self.imageop.get_root_disk_units, '/fake')
+                         self.imageop.get_root_disk_units, image_file)
+
+    def test_set_image_root_disk_units_from_download(self):
+        header = b'xCAT CKD Disk Image:        3338 CYL HLen: 0055 '
+        image_service = mock.Mock()
+        image_service.download.return_value = iter([header[:10],
+                                                    header[10:], b'x'])
+        image_service.show.return_value = {'id': '0000-1111',
+                                           'properties': {}}
+        image_meta = {'id': '0000-1111', 'checksum': '0' * 32,
+                      'properties': {'os_version': 'rhel7.2'}}
+        with mock.patch.object(glance, 'get_remote_image_service',
+                               return_value=(image_service, '0000-1111')):
+            new_meta = self.imageop.set_image_root_disk_units(self.context,
+                                                              image_meta)
+            self.assertEqual('3338:CYL',
+                             new_meta['properties']['root_disk_units'])
+            image_service.update.assert_called_once_with(self.context,
+                                            '0000-1111', new_meta, None)
+
+            # Not inspected again
+            image_service.reset_mock()
+            new_meta = self.imageop.set_image_root_disk_units(self.context,
+                                                              image_meta)
+        self.assertEqual({'id': '0000-1111', 'checksum': '0' * 32,
+                          'properties': {'os_version': 'rhel7.2',
+                                         'root_disk_units': '3338:CYL'}},
+                         new_meta)
+        self.assertFalse(image_service.download.called)
+        self.assertFalse(image_service.update.called)
 
     def test_zimage_check(self):
         image_meta = {}
@@ -4313,6 +5408,458 @@ class ZVMImageOPTestCases(ZVMTestCase):
                "are missing")
         self.assertEqual(msg, six.text_type(exc))
 
+    def _stream_image_bundle(self, data, **meta):
+        image_meta = {'id': '0000-1111',
+                      'size': len(data),
+                      'checksum': hashlib.md5(data).hexdigest(),
+                      'properties': {'image_type_xcat': 'linux',
+                                     'os_version': 'rhel7.2',
+                                     'os_name': 'Linux',
+                                     'architecture': 's390x',
+                                     'provisioning_method': 'netboot'}}
+        image_meta.update(meta)
+        image_service = mock.Mock()
+        image_service.download.return_value = iter([data[:5], data[5:]])
+        self.tmp_path = self.useFixture(fixtures.TempDir()).path
+        with mock.patch.object(glance, 'get_remote_image_service',
+                               return_value=(image_service, '0000-1111')):
+            return self.imageop.stream_image_bundle(self.context, image_meta,
+                                        'fakeimg', 'fake.img', self.tmp_path,
+                                        '20170101000000')
+
+    def test_stream_image_bundle(self):
+        data = b'xCAT CKD Disk Image: ' * 100
+        tar_file = self._stream_image_bundle(data)
+        self.assertEqual(self.tmp_path + '/20170101000000_fakeimg.tar',
+                         tar_file)
+
+        tar = tarfile.open(tar_file)
+        self.assertEqual(['20170101000000', '20170101000000/manifest.xml',
+                          '20170101000000/fake.img'], tar.getnames())
+        self.assertEqual(data,
+                         tar.extractfile('20170101000000/fake.img').read())
+        manifest = tar.extractfile('20170101000000/manifest.xml').read()
+        self.assertIn(b'<imagename>rhel7.2-s390x-netboot-fakeimg_0000_1111<',
+                      manifest)
+        self.assertIn(b'<description>auto:md5:' +
+                      hashlib.md5(data).hexdigest().encode() + b'<',
+                      manifest)
+        tar.close()
+
+        # The same manifest as written for a downloaded image
+        self.imageop.generate_manifest_file(
+                {'id': '0000-1111',
+                 'checksum': hashlib.md5(data).hexdigest(),
+                 'properties': {'image_type_xcat': 'linux',
+                                'os_version': 'rhel7.2',
+                                'os_name': 'Linux',
+                                'architecture': 's390x',
+                                'provisioning_method': 'netboot'}},
+                'fakeimg', 'fake.img', self.tmp_path)
+        with open(self.tmp_path + '/manifest.xml', 'rb') as f:
+            self.assertEqual(manifest, f.read())
+
+    def test_untar_image_bundle(self):
+        self.tmp_path = self.useFixture(fixtures.TempDir()).path
+        data = b'xCAT CKD Disk Image: ' + b'\0' * 10000
+        image_bundle = os.path.join(self.tmp_path, 'fakeimg.tgz')
+        with contextlib.closing(tarfile.open(image_bundle, 'w:gz')) as tar:
+            info = tarfile.TarInfo('fakeimg/0100.img')
+            info.size = len(data)
+            tar.addfile(info, six.BytesIO(data))
+
+        self.imageop.untar_image_bundle(self.tmp_path, image_bundle)
+        self.assertFalse(os.path.exists(image_bundle))
+        with open(self.tmp_path + '/fakeimg/0100.img', 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_stream_image_bundle_checksum_mismatch(self):
+        self.assertRaises(exception.ZVMImageError, self._stream_image_bundle,
+                          b'x' * 100, checksum='0' * 32)
+        self.assertEqual([], os.listdir(self.tmp_path))
+
+    def test_stream_image_bundle_size_mismatch(self):
+        self.assertRaises(exception.ZVMImageError, self._stream_image_bundle,
+                          b'x' * 100, size=200)
+        self.assertEqual([], os.listdir(self.tmp_path))
+        self.assertRaises(exception.ZVMImageError, self._stream_image_bundle,
+                          b'x' * 100, size=50)
+
+    def _fake_osimages(self):
+        return {'info': [[
+            'Object name: rhel7.2-s390x-netboot-fakeimg_0000_1111',
+            '    isdeletable=auto:last_use_date:2017-01-01',
+            '    osarch=s390x',
+            '    profile=fakeimg_0000_1111',
+            '    provmethod=netboot',
+            'Object name: rhel7.2-s390x-netboot-otherimg_2222_3333',
+            '    osarch=s390x',
+            '    profile=otherimg_2222_3333',
+            '    provmethod=netboot']]}
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_catalog_find(self, xreq):
+        xreq.return_value = self._fake_osimages()
+        self.assertTrue(self.imageop.image_exist_xcat('0000-1111'))
+        self.assertEqual('rhel7.2-s390x-netboot-fakeimg_0000_1111',
+                         self.imageop.get_imgname_xcat('0000-1111'))
+        self.assertEqual('rhel7.2-s390x-netboot-otherimg_2222_3333',
+                         self.imageop.get_imgname_xcat('otherimg_2222_3333'))
+        # One list of all osimages, and the found one confirmed by name
+        self.assertEqual(2, xreq.call_count)
+        self.assertNotIn('criteria', xreq.call_args_list[0][0][1])
+        self.assertIn('/images/rhel7.2-s390x-netboot-fakeimg_0000_1111?',
+                      xreq.call_args[0][1])
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_catalog_find_deleted(self, xreq):
+        xreq.return_value = self._fake_osimages()
+        self.assertTrue(self.imageop.image_exist_xcat('0000-1111'))
+
+        # Deleted by another compute node
+        xreq.side_effect = [exception.ZVMXCATInternalError(
+                                msg="Could not find an object named 'x'"),
+                            {'info': []}]
+        self.assertFalse(self.imageop.image_exist_xcat('0000-1111'))
+        self.assertIn('&criteria=profile=~0000_1111', xreq.call_args[0][1])
+        self.assertIsNone(self.imageop.catalog.get(
+                                    'rhel7.2-s390x-netboot-fakeimg_0000_1111'))
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_catalog_find_miss(self, xreq):
+        xreq.side_effect = [{'info': []}, self._fake_osimages(),
+                            {'info': []}, {'info': []}]
+        self.assertEqual('rhel7.2-s390x-netboot-fakeimg_0000_1111',
+                         self.imageop.get_imgname_xcat('0000-1111'))
+        self.assertIn('&criteria=profile=~0000_1111', xreq.call_args[0][1])
+        self.assertEqual('rhel7.2-s390x-netboot-fakeimg_0000_1111',
+                         self.imageop.get_imgname_xcat('0000-1111'))
+        self.assertEqual(2, xreq.call_count)
+
+        self.assertFalse(self.imageop.image_exist_xcat('4444-5555'))
+        self.assertRaises(exception.ZVMImageError,
+                          self.imageop.get_imgname_xcat, '4444-5555')
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_catalog_find_same_content(self, xreq):
+        images = self._fake_osimages()
+        images['info'][0].append('    description=auto:md5:' + 'a' * 32)
+        xreq.return_value = images
+        name = 'rhel7.2-s390x-netboot-fakeimg_0000_1111'
+        self.assertEqual(name, self.imageop.get_imgname_xcat('4444-5555',
+                                                             'a' * 32))
+        # Remembered as an alias of the image, also across a reload
+        self.assertTrue(self.imageop.image_exist_xcat('4444-5555'))
+        self.imageop.catalog.reload()
+        self.assertTrue(self.imageop.image_exist_xcat('4444-5555'))
+        # The two lists, and the image confirmed twice
+        self.assertEqual(4, xreq.call_count)
+
+        xreq.return_value = {'info': []}
+        self.assertFalse(self.imageop.image_exist_xcat('6666-7777', 'b' * 32))
+        self.imageop.catalog.remove(name)
+        self.assertFalse(self.imageop.image_exist_xcat('4444-5555',
+                                                       'a' * 32))
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_catalog_refresh(self, xreq):
+        self.flags(zvm_image_catalog_refresh_interval=10)
+        xreq.return_value = self._fake_osimages()
+        self.assertTrue(self.imageop.image_exist_xcat('0000-1111'))
+        xreq.return_value = {'info': []}
+        self.assertTrue(self.imageop.image_exist_xcat('0000-1111'))
+        with mock.patch('time.time', return_value=time.time() + 11):
+            self.assertFalse(self.imageop.image_exist_xcat('0000-1111'))
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_catalog_updated(self, xreq):
+        xreq.return_value = self._fake_osimages()
+        name = 'rhel7.2-s390x-netboot-fakeimg_0000_1111'
+        self.assertEqual([[name, datetime.date(2017, 1, 1)]],
+                         self.imageop._get_image_list_xcat())
+
+        xreq.return_value = {'data': []}
+        today = self.imageop.update_last_use_date(name)
+        self.assertEqual(
+            [[name, datetime.datetime.strptime(today, '%Y-%m-%d').date()]],
+            self.imageop._get_image_list_xcat())
+
+        self.imageop.delete_image_from_xcat(name)
+        self.assertEqual([], self.imageop._get_image_list_xcat())
+        xreq.return_value = {'info': []}
+        self.assertFalse(self.imageop.image_exist_xcat('0000-1111'))
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_update_last_use_date_buffered(self, xreq):
+        xreq.return_value = self._fake_osimages()
+        name = 'rhel7.2-s390x-netboot-fakeimg_0000_1111'
+        self.assertTrue(self.imageop.image_exist_xcat('0000-1111'))
+        xreq.reset_mock()
+        xreq.return_value = {'data': []}
+
+        today = self.imageop.update_last_use_date(name)
+        self.imageop.update_last_use_date(name)
+        self.assertFalse(xreq.called)
+
+        self.imageop.flush_last_use_dates()
+        xreq.assert_called_once_with('PUT', mock.ANY,
+            ['imagename=' + name,
+             'osimage.isdeletable=auto:last_use_date:' + today])
+
+        # Already stored
+        xreq.reset_mock()
+        self.imageop.update_last_use_date(name)
+        self.imageop.flush_last_use_dates()
+        self.assertFalse(xreq.called)
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_update_last_use_date_flush_failed(self, xreq):
+        name = 'rhel7.2-s390x-netboot-fakeimg_0000_1111'
+        self.imageop.update_last_use_date(name)
+        xreq.side_effect = exception.ZVMXCATInternalError(msg='fake')
+        self.imageop.flush_last_use_dates()
+        xreq.side_effect = None
+        xreq.return_value = {'data': []}
+        self.imageop.flush_last_use_dates()
+        self.assertEqual(2, xreq.call_count)
+
+        # Written right away without a flush interval
+        xreq.reset_mock()
+        self.flags(zvm_image_last_use_flush_interval=0)
+        self.imageop.update_last_use_date(name)
+        xreq.assert_called_once_with('PUT', mock.ANY, mock.ANY)
+
+    def _fake_deletable_osimages(self):
+        info = []
+        for (i, uuid) in enumerate(('0000_1111', '2222_3333', '4444_5555')):
+            info.extend(['Object name: rhel7.2-s390x-netboot-img_' + uuid,
+                         '    isdeletable=auto:last_use_date:2017-01-0%d' %
+                         (3 - i),
+                         '    osarch=s390x',
+                         '    profile=img_' + uuid,
+                         '    provmethod=netboot'])
+        return {'info': [info]}
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_plan_image_eviction(self, xreq):
+        xreq.return_value = self._fake_deletable_osimages()
+        sizes = {'0000-1111': 2.0, '2222-3333': 0, '4444-5555': 2.0}
+        with mock.patch.object(self.imageop, '_get_image_size_glance',
+                side_effect=lambda ctxt, uuid: sizes[uuid]) as get_size:
+            plan, size = self.imageop.plan_image_eviction(self.context, 3)
+            self.assertEqual(['rhel7.2-s390x-netboot-img_4444_5555',
+                              'rhel7.2-s390x-netboot-img_0000_1111'],
+                             [image.name for image in plan])
+            self.assertEqual(4.0, size)
+            self.assertEqual(3, get_size.call_count)
+
+            # Sizes are kept
+            plan, size = self.imageop.plan_image_eviction(self.context, 1)
+            self.assertEqual(['rhel7.2-s390x-netboot-img_4444_5555'],
+                             [image.name for image in plan])
+            self.assertEqual(3, get_size.call_count)
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_prune_image_xcat_dry_run(self, xreq):
+        xreq.return_value = self._fake_deletable_osimages()
+        self.stubs.Set(self.imageop, '_get_image_size_glance',
+                       self._fake_fun(1.0))
+        with mock.patch.object(self.imageop,
+                               'delete_image_from_xcat') as delete:
+            self.assertEqual(['rhel7.2-s390x-netboot-img_4444_5555'],
+                             self.imageop.prune_image_xcat(self.context, 1,
+                                                           1, dry_run=True))
+            self.assertFalse(delete.called)
+            self.assertEqual(['rhel7.2-s390x-netboot-img_4444_5555'],
+                             self.imageop.prune_image_xcat(self.context, 1,
+                                                           1))
+            delete.assert_called_once_with(
+                                'rhel7.2-s390x-netboot-img_4444_5555')
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_clean_image_cache_xcat(self, xreq):
+        xreq.return_value = self._fake_deletable_osimages()
+        self.stubs.Set(self.imageop, '_get_image_size_glance',
+                       self._fake_fun(1.0))
+        with mock.patch.object(self.imageop,
+                               'delete_image_from_xcat') as delete:
+            self.imageop.clean_image_cache_xcat(0, self.context)
+        self.assertEqual(3, delete.call_count)
+
+    @mock.patch('nova_zvm.virt.zvm.utils.xcat_request')
+    def test_clean_image_cache_xcat_free_space_goal(self, xreq):
+        self.flags(xcat_image_free_space_goal=20)
+        xreq.return_value = self._fake_deletable_osimages()
+        self.stubs.Set(self.imageop, '_get_image_size_glance',
+                       self._fake_fun(1.0))
+        self.stubs.Set(self.imageop, 'get_free_space_xcat',
+                       self._fake_fun(18.5))
+        with mock.patch.object(self.imageop,
+                               'delete_image_from_xcat') as delete:
+            self.imageop.clean_image_cache_xcat(36500, self.context)
+        self.assertEqual([mock.call('rhel7.2-s390x-netboot-img_4444_5555'),
+                          mock.call('rhel7.2-s390x-netboot-img_2222_3333')],
+                         delete.call_args_list)
+
+    def test_stream_image_bundle_cached(self):
+        cache_path = self.useFixture(fixtures.TempDir()).path
+        self.flags(zvm_image_cache_size=1, zvm_image_cache_path=cache_path)
+        data = b'xCAT CKD Disk Image: ' * 100
+        self._stream_image_bundle(data)
+        checksum = hashlib.md5(data).hexdigest()
+        self.assertEqual([checksum, 'stats.json'],
+                         sorted(os.listdir(cache_path)))
+
+        # Not downloaded again
+        tmp_path = self.useFixture(fixtures.TempDir()).path
+        image_meta = {'id': '0000-1111', 'size': len(data),
+                      'checksum': checksum,
+                      'properties': {'image_type_xcat': 'linux',
+                                     'os_version': 'rhel7.2',
+                                     'os_name': 'Linux',
+                                     'architecture': 's390x',
+                                     'provisioning_method': 'netboot'}}
+        with mock.patch.object(glance, 'get_remote_image_service') as get:
+            tar_file = self.imageop.stream_image_bundle(self.context,
+                            image_meta, 'fakeimg', 'fake.img', tmp_path,
+                            '20170101000000')
+        self.assertFalse(get.called)
+        tar = tarfile.open(tar_file)
+        self.assertEqual(data,
+                         tar.extractfile('20170101000000/fake.img').read())
+        tar.close()
+        stats = self.imageop.image_cache.get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(len(data), stats['bytes_saved'])
+
+    def test_stream_image_bundle_cache_add_failed(self):
+        cache_path = self.useFixture(fixtures.TempDir()).path
+        self.flags(zvm_image_cache_size=1, zvm_image_cache_path=cache_path)
+        data = b'xCAT CKD Disk Image: ' * 100
+        with mock.patch.object(self.imageop.image_cache, 'add',
+                               side_effect=OSError('fake')):
+            tar_file = self._stream_image_bundle(data)
+        # The bundle is used, the part file is removed
+        self.assertTrue(os.path.isfile(tar_file))
+        self.assertEqual([], [name for name in os.listdir(cache_path)
+                              if name.endswith('.part')])
+
+
+class ZVMImageCacheTestCases(test.TestCase):
+    """Test cases of the compute node image cache."""
+
+    def setUp(self):
+        super(ZVMImageCacheTestCases, self).setUp()
+        self.cache_path = self.useFixture(fixtures.TempDir()).path
+        self.tmp_path = self.useFixture(fixtures.TempDir()).path
+        self.flags(zvm_image_cache_size=1,
+                   zvm_image_cache_path=self.cache_path)
+        self.cache = imagecache.ImageCache()
+
+    def _add(self, data):
+        src = os.path.join(self.tmp_path, 'image.img')
+        with open(src, 'wb') as f:
+            f.write(data)
+        checksum = hashlib.md5(data).hexdigest()
+        self.cache.add(checksum, src)
+        os.remove(src)
+        return checksum
+
+    def test_lookup(self):
+        data = b'x' * 100
+        checksum = hashlib.md5(data).hexdigest()
+        self.assertIsNone(self.cache.lookup(checksum))
+        self._add(data)
+        self.assertEqual(os.path.join(self.cache_path, checksum),
+                         self.cache.lookup(checksum))
+
+        target = os.path.join(self.tmp_path, 'target.img')
+        self.assertTrue(self.cache.fetch(checksum, target))
+        with open(target, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+        stats = self.cache.get_stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(0.667, stats['hit_rate'])
+        self.assertEqual(200, stats['bytes_saved'])
+        self.assertEqual(1, stats['images'])
+        self.assertEqual(100, stats['size'])
+
+    def test_lookup_disabled(self):
+        self.flags(zvm_image_cache_size=0)
+        checksum = self._add(b'x' * 100)
+        self.assertIsNone(self.cache.lookup(checksum))
+        self.assertEqual([], os.listdir(self.cache_path))
+
+    def test_add_checksum_mismatch(self):
+        src = os.path.join(self.tmp_path, 'image.img')
+        with open(src, 'wb') as f:
+            f.write(b'x' * 100)
+        self.cache.add('0' * 32, src)
+        self.assertIsNone(self.cache.lookup('0' * 32))
+
+    def test_evict_least_recently_used(self):
+        first = self._add(b'a' * 400 * 1024)
+        second = self._add(b'b' * 400 * 1024)
+        self.assertIsNotNone(self.cache.lookup(first))
+        third = self._add(b'c' * 400 * 1024)
+
+        self.assertIsNotNone(self.cache.lookup(first))
+        self.assertIsNone(self.cache.lookup(second))
+        self.assertIsNotNone(self.cache.lookup(third))
+        self.assertFalse(os.path.exists(os.path.join(self.cache_path,
+                                                     second)))
+        self.assertEqual(1, self.cache.get_stats()['evicted'])
+
+    def test_not_cached_above_limit(self):
+        checksum = self._add(b'x' * 2 * 1024 * 1024)
+        self.assertIsNone(self.cache.lookup(checksum))
+        self.assertIsNone(self.cache.get_part_file(checksum,
+                                                   2 * 1024 * 1024))
+
+    def test_part_file_unique(self):
+        checksum = hashlib.md5(b'x' * 100).hexdigest()
+        parts = [self.cache.get_part_file(checksum, 100) for i in range(2)]
+        self.assertNotEqual(parts[0], parts[1])
+        for part in parts:
+            with open(part, 'wb') as f:
+                f.write(b'x' * 100)
+        self.cache.add(checksum, parts[0])
+        self.cache.add(checksum, parts[1])
+        self.assertEqual(os.path.join(self.cache_path, checksum),
+                         self.cache.lookup(checksum))
+        self.assertEqual([checksum, 'stats.json'],
+                         sorted(os.listdir(self.cache_path)))
+
+    def test_restart(self):
+        checksum = self._add(b'x' * 100)
+        self.assertIsNotNone(self.cache.lookup(checksum))
+        open(os.path.join(self.cache_path, '1' * 32 + '.part'), 'w').close()
+
+        cache = imagecache.ImageCache()
+        self.assertEqual(os.path.join(self.cache_path, checksum),
+                         cache.lookup(checksum))
+        stats = cache.get_stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(200, stats['bytes_saved'])
+        self.assertEqual([checksum, 'stats.json'],
+                         sorted(os.listdir(self.cache_path)))
+
+    def test_sparse_file(self):
+        block = imagecache.SPARSE_BLOCK_SIZE
+        data = (b'x' * 10 + b'\0' * (block * 3) + b'y' * block +
+                b'\0' * (block * 2))
+        path = os.path.join(self.tmp_path, 'sparse.img')
+        with imagecache.SparseFile(path) as f:
+            # The zeros in the block of the x's are written
+            f.write(data[:block])
+            f.write(data[block:])
+            self.assertEqual(len(data), f.tell())
+        self.assertEqual(block * 3 + 10, f.skipped)
+        with open(path, 'rb') as f:
+            self.assertEqual(data, f.read())
+
 
 class ZVMDistTestCases(test.TestCase):
     def setUp(self):
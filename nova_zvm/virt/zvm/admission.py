@@ -0,0 +1,117 @@
+# Copyright 2017 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import collections
+import contextlib
+import eventlet
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from nova_zvm.virt.zvm import timing
+
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+# Spawn phases with a concurrency limit
+IMAGE = 'image'
+DIRECTORY = 'directory'
+DEPLOY = 'deploy'
+
+
+class Gate(object):
+    """Let at most limit callers in at a time, the others wait in FIFO."""
+
+    def __init__(self, name, limit):
+        self.name = name
+        # 0 means no limit
+        self.limit = limit
+        self.active = 0
+        self.admitted = 0
+        self.max_queued = 0
+        self._queue = collections.deque()
+
+    def _full(self):
+        return bool(self.limit) and self.active >= self.limit
+
+    @contextlib.contextmanager
+    def admit(self):
+        start = time.time()
+        if self._full() or self._queue:
+            event = eventlet.event.Event()
+            self._queue.append(event)
+            self.max_queued = max(self.max_queued, len(self._queue))
+            LOG.debug("Waiting to enter %(gate)s, %(num)d waiting",
+                      {'gate': self.name, 'num': len(self._queue)})
+            try:
+                # The slot is handed over by the one leaving
+                event.wait()
+            except BaseException:
+                if event in self._queue:
+                    self._queue.remove(event)
+                else:
+                    self._leave()
+                raise
+        else:
+            self.active += 1
+
+        self.admitted += 1
+        timing.record('admission', self.name, time.time() - start)
+        try:
+            yield
+        finally:
+            self._leave()
+
+    def _leave(self):
+        if self._queue:
+            # Hand the slot over to the first waiter
+            self._queue.popleft().send(None)
+        else:
+            self.active -= 1
+
+    def to_dict(self):
+        return {'limit': self.limit,
+                'active': self.active,
+                'queued': len(self._queue),
+                'max_queued': self.max_queued,
+                'admitted': self.admitted}
+
+
+class AdmissionController(object):
+    """Limit how many spawns run each expensive phase at the same time.
+
+    Image transfer, user directory creation and deploy each have a gate.
+    Spawns beyond the limit of a phase wait in FIFO order, so a large
+    batch proceeds at the rate xCAT and DirMaint can sustain instead of
+    contending for them all at once. The time spent waiting is recorded
+    in the 'admission' phase timings.
+    """
+
+    def __init__(self):
+        self._gates = {
+            IMAGE: Gate(IMAGE, CONF.zvm_spawn_image_concurrency),
+            DIRECTORY: Gate(DIRECTORY, CONF.zvm_spawn_directory_concurrency),
+            DEPLOY: Gate(DEPLOY, CONF.zvm_spawn_deploy_concurrency),
+            }
+
+    def admit(self, phase):
+        return self._gates[phase].admit()
+
+    def get_stats(self):
+        """Return the queue statistics of each phase."""
+        return dict((phase, gate.to_dict())
+                    for (phase, gate) in self._gates.items())
@@ -252,6 +252,23 @@ Possible Values:
     but it will vary depending on instance and system load.
     A value of 0 is used for debug. In this case the underlying z/VM guest
     will not be deleted when the instance is marked in ERROR state.
+"""),
+    cfg.IntOpt('zvm_state_poll_interval',
+               default=5,
+               min=1,
+               help="""
+Interval (seconds) between two checks of instances waiting for a state.
+
+Instances waiting to become reachable, to be powered off or to have their
+NICs granted are checked together by a single polling loop, with one xCAT
+request per target state on each check no matter how many instances are
+waiting. This is the time the loop sleeps between two checks.
+
+Possible values:
+    Any positive integer.
+
+Related:
+    zvm_reachable_timeout
 """),
     cfg.IntOpt('zvm_xcat_connection_timeout',
                default=3600,
@@ -268,6 +285,265 @@ Possible Values:
     Any positive integer.
     Recommended to be larger than 3600 (1 hour), depending on the size of
     your images.
+"""),
+    cfg.IntOpt('zvm_spawn_step_concurrency',
+               default=4,
+               min=1,
+               help="""
+Maximum number of steps of one instance spawn run at the same time.
+
+Spawning an instance is made of steps like building the config drive,
+importing the image, creating the xCAT node and z/VM userid, writing the
+network tables, deploying the image and waiting for the NICs. A step is
+started as soon as the steps it depends on are done, so independent steps
+overlap.
+
+Possible values:
+    Any positive integer. 1 runs the steps one after another.
+"""),
+    cfg.IntOpt('zvm_spawn_step_retries',
+               default=2,
+               min=0,
+               help="""
+Number of times a spawn step failed by a transient error is done again.
+
+Steps of a spawn which are done are kept, and a step like creating the xCAT
+node or z/VM userid, writing the network tables or powering on which failed
+because the request could not be sent to xCAT, xCAT was unavailable or
+DirMaint was busy is cleaned up and done again. Failures after which the
+request may have been done, like a timeout waiting for xCAT, are not
+retried. The instance is only destroyed when a step fails for another reason
+or after all retries.
+
+Possible values:
+    Any positive integer, or 0 to destroy the instance on any failure.
+
+Related:
+    zvm_spawn_step_retry_interval
+"""),
+    cfg.IntOpt('zvm_spawn_step_retry_interval',
+               default=10,
+               min=0,
+               help="""
+Interval (seconds) before a failed spawn step is done again, doubled for
+each further retry of the step.
+
+Related:
+    zvm_spawn_step_retries
+"""),
+    cfg.IntOpt('zvm_spawn_image_concurrency',
+               default=2,
+               min=0,
+               help="""
+Maximum number of spawns transferring images at the same time.
+
+Spawns beyond this number wait in first come, first served order before
+downloading the image from glance and importing it to xCAT, which limits the
+load on the local disk and the xCAT MN when many instances are spawned
+together. The number of waiting spawns and their waiting time are exported
+with the phase timings.
+
+Possible values:
+    Any positive integer, or 0 for no limit.
+
+Related:
+    zvm_spawn_directory_concurrency
+    zvm_spawn_deploy_concurrency
+    zvm_phase_stats_file
+"""),
+    cfg.IntOpt('zvm_spawn_directory_concurrency',
+               default=4,
+               min=0,
+               help="""
+Maximum number of spawns creating z/VM user directory entries at a time.
+
+Spawns beyond this number wait in first come, first served order before
+creating the z/VM userid and its disks, which are serialized by the directory
+manager anyway.
+
+Possible values:
+    Any positive integer, or 0 for no limit.
+
+Related:
+    zvm_spawn_image_concurrency
+    zvm_spawn_deploy_concurrency
+"""),
+    cfg.IntOpt('zvm_spawn_deploy_concurrency',
+               default=8,
+               min=0,
+               help="""
+Maximum number of spawns deploying images to disks at the same time.
+
+Spawns beyond this number wait in first come, first served order before the
+image is copied to the root disk of the instance by xCAT.
+
+Possible values:
+    Any positive integer, or 0 for no limit.
+
+Related:
+    zvm_spawn_image_concurrency
+    zvm_spawn_directory_concurrency
+"""),
+    cfg.IntOpt('zvm_mn_facts_refresh_interval',
+               default=86400,
+               min=0,
+               help="""
+Interval (seconds) after which cached xCAT MN and zHCP facts are reloaded.
+
+Facts which rarely change, like the SSH public key of the xCAT MN, the zHCP
+hostname, node name and userid, and the xCAT version, are loaded once and
+kept in memory. A cached fact is reloaded the next time it is used after
+this interval, or earlier when it is found to be different.
+
+Possible values:
+    Any positive integer, or 0 to never reload a cached fact.
+"""),
+    cfg.IntOpt('zvm_node_attr_refresh_interval',
+               default=600,
+               min=0,
+               help="""
+Interval (seconds) after which cached xCAT node attributes are read again.
+
+The z/VM userid, zHCP and provisioning method of the xCAT nodes are listed
+once for the whole node group and kept in memory. A cached attribute is read
+again from xCAT the next time it is used after this interval, to pick up the
+changes made by others, for example by another compute node sharing the xCAT
+MN.
+
+Possible values:
+    Any positive integer, or 0 to never read a cached attribute again.
+
+Related:
+    zvm_mn_facts_refresh_interval
+"""),
+    cfg.BoolOpt('zvm_bundle_transport_files',
+                default=False,
+                help="""
+Run the first boot scripts of a new instance from its config drive.
+
+The commands which change the root password and set up the IUCV server of an
+instance deployed from an xcatconf4z image are added to the first boot script
+of the config drive, instead of each being punched to the reader of the
+instance as a separate file. The IUCV server files themselves are still
+punched from zHCP.
+
+Only enable it when all xcatconf4z images spawned on the host run the whole
+first boot script of the config drive as root, the way they run its network
+configuration commands, before the reader files would be processed. The
+driver can not check this; an image which only takes the network commands
+from the config drive boots without its password set and without IUCV
+authorized.
+
+Possible values:
+    True or False
+"""),
+    cfg.StrOpt('zvm_phase_stats_file',
+               default=None,
+               help="""
+File to which the phase timing histograms are written.
+
+The duration of each phase of spawn, destroy, snapshot and migrations, like
+importing the image, creating the z/VM userid, deploying and waiting for the
+instance to be reachable, is logged with the instance and accumulated in
+histograms. The histograms are written as JSON to this file after each
+operation.
+
+Possible values:
+    A path writable by the compute service, or empty to not write them.
+"""),
+    cfg.IntOpt('zvm_warm_pool_size',
+               default=0,
+               min=0,
+               help="""
+Maximum number of pre-created z/VM guests kept in the warm pool.
+
+The warm pool keeps guests whose z/VM userid was created and image deployed in
+advance, for the images and flavors spawned on this host. A spawn with the
+same image and flavor takes over one of them, and only has to define its xCAT
+node and punch its config drive, instead of creating the userid and deploying
+the image. Pool guests are named with zvm_warm_pool_prefix and are not listed
+as instances.
+
+Possible values:
+    Any positive integer, or 0 to disable the warm pool.
+
+Related:
+    zvm_warm_pool_targets
+    zvm_warm_pool_default_target
+    zvm_warm_pool_refill_interval
+    zvm_warm_pool_refill_rate
+    zvm_warm_pool_prefix
+"""),
+    cfg.ListOpt('zvm_warm_pool_targets',
+                default=[],
+                help="""
+Number of pool guests to keep for given images.
+
+Each entry is <image id>:<count>. The guests of an image are created with
+the flavor it was spawned with most often. Images not listed here have
+zvm_warm_pool_default_target guests.
+
+Possible values:
+    A comma separated list of <image id>:<count> entries.
+
+Related:
+    zvm_warm_pool_size
+    zvm_warm_pool_default_target
+"""),
+    cfg.IntOpt('zvm_warm_pool_default_target',
+               default=1,
+               min=0,
+               help="""
+Number of pool guests to keep for images spawned on this host that are not
+listed in zvm_warm_pool_targets.
+
+Possible values:
+    Any positive integer, or 0 to only keep guests for the listed images.
+
+Related:
+    zvm_warm_pool_targets
+"""),
+    cfg.IntOpt('zvm_warm_pool_refill_interval',
+               default=60,
+               min=1,
+               help="""
+Interval (seconds) at which missing pool guests are created.
+
+Possible values:
+    Any positive integer.
+
+Related:
+    zvm_warm_pool_refill_rate
+"""),
+    cfg.IntOpt('zvm_warm_pool_refill_rate',
+               default=1,
+               min=1,
+               help="""
+Maximum number of pool guests created per refill interval.
+
+Pool guests are created one after another, and wait for the admission of
+the directory and deploy phases like spawns do, so refilling the pool does
+not slow down spawns much.
+
+Possible values:
+    Any positive integer.
+
+Related:
+    zvm_warm_pool_refill_interval
+    zvm_spawn_directory_concurrency
+    zvm_spawn_deploy_concurrency
+"""),
+    cfg.StrOpt('zvm_warm_pool_prefix',
+               default='zwp',
+               help="""
+Prefix of the xCAT node names and z/VM userids of the pool guests.
+
+Possible values:
+    A string of at most 3 characters which no instance name created by
+    instance_name_template starts with.
+
+Related:
+    zvm_warm_pool_size
 """),
     cfg.IntOpt('zvm_console_log_size',
                default=100,
@@ -459,6 +735,72 @@ Possible values:
                help='The threshold for xCAT free space, if snapshot or spawn '
                      'check xCAT free space not enough for its image '
                      'operations, it will prune image to meet the threshold'),
+    cfg.IntOpt('xcat_image_free_space_goal',
+               default=0,
+               min=0,
+               help="""
+Free space (GB) the periodic image cleanup keeps in the xCAT MN /install.
+
+After the images unused for xcat_image_clean_period days are purged, the
+least recently used images are purged as well until the xCAT MN has this much
+free space. Keeping the image repository below this mark ahead of time
+avoids pruning images while a spawn or snapshot waits for the space.
+
+Possible values:
+    0 to only purge images by age, or any positive integer, preferably
+    larger than xcat_free_space_threshold.
+
+Related:
+    xcat_image_clean_period
+    xcat_free_space_threshold
+"""),
+    cfg.IntOpt('zvm_image_clean_concurrency',
+               default=4,
+               min=1,
+               help="""
+Maximum number of images deleted from xCAT at the same time.
+
+Image cleanup and pruning delete the images they purge concurrently, each
+deletion being two requests to xCAT.
+
+Possible values:
+    Any positive integer.
+"""),
+    cfg.IntOpt('zvm_image_prewarm_top',
+               default=0,
+               min=0,
+               help="""
+Number of the most spawned images imported to xCAT ahead of their spawns.
+
+The spawns of each image on the host are counted, starting from the images of
+the instances on the host. After the periodic image cleanup, the most spawned
+images which are not in the xCAT image repository are imported to it, one
+image per cleanup, as long as the xCAT MN keeps xcat_free_space_threshold and
+xcat_image_free_space_goal free. A spawn of such an image does not wait for
+its download and import.
+
+Possible values:
+    0 to only import the images of zvm_image_prewarm_images, or any positive
+    integer.
+
+Related:
+    zvm_image_prewarm_images
+    xcat_image_free_space_goal
+"""),
+    cfg.ListOpt('zvm_image_prewarm_images',
+                default=[],
+                help="""
+Glance images always imported to xCAT ahead of their spawns.
+
+These images are imported before the most spawned ones, whenever they are not
+in the xCAT image repository, for example after the image cleanup purged them.
+
+Possible values:
+    A comma separated list of glance image ids.
+
+Related:
+    zvm_image_prewarm_top
+"""),
     cfg.StrOpt('zvm_image_compression_level',
                default=None,
                help="""
@@ -474,6 +816,87 @@ Possible values:
     An integer between 0 and 9, where 0 is no compression and 9 is the best,
     but slowest compression. A value of "None" will result in the default
     compression level, which is currently '6' for gzip.
+"""),
+    cfg.BoolOpt('zvm_image_stream_import',
+                default=True,
+                help="""
+Write the image bundle imported to xCAT while the image is downloaded.
+
+The bundle, a tar file of the image and its manifest, is written directly
+from the glance download and the image checksum is verified in the same pass,
+instead of writing the image file first and copying it into the bundle. This
+halves the disk I/O and temporary space needed in zvm_image_tmp_path. For an
+image without root_disk_units, only the header of the image is read from
+glance first to get its disk size, and the bundle is still streamed. Only
+images of unknown size are downloaded to a file first.
+
+Possible values:
+    True or False
+"""),
+    cfg.IntOpt('zvm_image_cache_size',
+               default=0,
+               help="""
+Size limit, in MB, of the image cache on the compute node.
+
+Images downloaded from glance are kept in the cache, keyed by their checksum,
+so that an image purged from xCAT is imported again from the cache instead of
+being downloaded again. When the cache grows beyond this size, the least
+recently used images are removed from it.
+
+Possible values:
+    0 disables the cache, any positive integer is the limit in MB.
+
+Related:
+    zvm_image_cache_path
+"""),
+    cfg.StrOpt('zvm_image_cache_path',
+               default=None,
+               help="""
+The path at which the image cache is kept.
+
+Possible values:
+    A path in host that running compute service. When not set, the
+    image_cache folder in zvm_image_tmp_path is used.
+
+Related:
+    zvm_image_cache_size
+"""),
+    cfg.IntOpt('zvm_image_catalog_refresh_interval',
+               default=600,
+               min=0,
+               help="""
+Interval (seconds) after which the catalog of xCAT osimages is listed again.
+
+The driver keeps a catalog of the osimages in xCAT, listed at once, to find
+the image of a spawn without querying xCAT. The images it imports, uses and
+deletes itself are updated in the catalog right away, and an image missing
+from it is looked up in xCAT before it is imported. Listing again picks up
+the images deleted by others, for example by another compute node sharing
+the xCAT MN. The catalog is also listed again by the periodic image cleanup.
+
+Possible values:
+    Any positive integer, or 0 to only list again on image cleanup.
+
+Related:
+    xcat_image_clean_period
+"""),
+    cfg.IntOpt('zvm_image_last_use_flush_interval',
+               default=300,
+               min=0,
+               help="""
+Interval (seconds) at which the last use dates of images are written to xCAT.
+
+The last use date of an image, which decides when an unused image is purged
+from xCAT, is updated after each deploy and capture. The dates are kept in
+memory and written in one pass at this interval and when the compute service
+stops, at most once per image and day, instead of one table update per
+deploy.
+
+Possible values:
+    Any positive integer, or 0 to write the date right after each deploy.
+
+Related:
+    xcat_image_clean_period
 """),
     ]
 
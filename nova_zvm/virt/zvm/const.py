@@ -64,6 +64,24 @@ ZVM_DEFAULT_FCP_ID = 'auto'
 
 ZVM_IMAGE_SIZE_MAX = 10
 
+# Image property set at capture time to the md5sum of the IUCV server
+# installed in the image
+IMAGE_IUCV_SERVER_VERSION = 'iucv_server_version'
+
+# Parts of xCAT and DirMaint error messages of failures worth retrying:
+# the request could not be sent to xCAT, xCAT was unavailable, or DirMaint
+# was busy. Only failures of requests known not to have been applied are
+# listed; after a timeout waiting for the response, or a 504, the request
+# may still be done, and DirMaint operations are not safe to do twice.
+XCAT_TRANSIENT_ERRORS = ('Communication error',
+                         "'status': 502",
+                         "'status': 503",
+                         'Return Code: 596')
+
+# First interval (seconds) of checking whether NICs are granted, doubled on
+# each check up to zvm_state_poll_interval
+NIC_CHECK_MIN_INTERVAL = 1
+
 # This is the version that our plugin can work ,if xcat version
 # is lower than this version, we will warn user and prevent
 # compute service to start up.
@@ -0,0 +1,219 @@
+# Copyright 2017 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import eventlet
+from eventlet import queue
+import six
+import sys
+import time
+
+from nova.i18n import _LW
+from oslo_log import log as logging
+
+from nova_zvm.virt.zvm import exception
+from nova_zvm.virt.zvm import utils as zvmutils
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Step(object):
+    """One step of a DAGExecutor."""
+
+    def __init__(self, name, func, requires=(), rollback=None, retries=0,
+                 undo=None):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.rollback = rollback
+        self.retries = retries
+        self.undo = undo
+
+
+class DAGExecutor(object):
+    """Run steps as soon as all the steps they require are done.
+
+    Steps are started in green threads, at most max_workers at a time, in
+    the order they were added among those which are ready. When a step
+    fails no more steps are started; after the running ones finish, the
+    rollback hooks of the failed steps, which may have been half done, and
+    then of the done steps are called in reverse order, and the first
+    failure is re-raised.
+    A step with retries is done again, after its undo hook cleaned up what
+    it may have half done, when it fails with an error for which retry_if
+    returns True. The steps done so far are kept meanwhile.
+    If a timing.PhaseTimer is given, each step is timed as a phase.
+    """
+
+    def __init__(self, name, max_workers=None, timer=None, retry_if=None,
+                 retry_interval=0):
+        self._name = name
+        self._max_workers = max_workers
+        self._timer = timer
+        self._retry_if = retry_if
+        self._retry_interval = retry_interval
+        self._steps = []
+        # names of the done and failed steps, in the order they finished
+        self.done = []
+        self.failed = []
+        # names of the steps rolled back
+        self.rolled_back = []
+        # name -> number of retries of the steps retried
+        self.retried = {}
+
+    def add(self, name, func, requires=(), rollback=None, retries=0,
+            undo=None):
+        """Add a step.
+
+        :param name: unique name of the step.
+        :param func: callable without arguments doing the step.
+        :param requires: names of the steps which must be done first.
+        :param rollback: callable without arguments undoing the step, called
+                         if this or another step failed.
+        :param retries: number of times the step is done again when it
+                        failed with an error accepted by retry_if.
+        :param undo: callable without arguments cleaning up a failed try of
+                     the step before it is done again.
+        """
+        if name in [s.name for s in self._steps]:
+            msg = "Duplicate step %s" % name
+            raise exception.ZVMDriverError(msg=msg)
+        self._steps.append(Step(name, func, requires, rollback, retries,
+                                undo))
+
+    def _check(self):
+        """Check that all steps can be run."""
+        names = set(s.name for s in self._steps)
+        for step in self._steps:
+            unknown = set(step.requires) - names
+            if unknown:
+                msg = ("Step %(step)s requires unknown steps %(unknown)s" %
+                       {'step': step.name, 'unknown': sorted(unknown)})
+                raise exception.ZVMDriverError(msg=msg)
+
+        resolved = set()
+        pending = list(self._steps)
+        while pending:
+            ready = [s for s in pending if set(s.requires) <= resolved]
+            if not ready:
+                msg = ("Dependency cycle among steps %s" %
+                       [s.name for s in pending])
+                raise exception.ZVMDriverError(msg=msg)
+            for step in ready:
+                resolved.add(step.name)
+                pending.remove(step)
+
+    def run(self):
+        self._check()
+
+        pool = eventlet.GreenPool(self._max_workers or len(self._steps) or 1)
+        results = queue.LightQueue()
+        pending = list(self._steps)
+        running = set()
+        failure = None
+
+        def _run_step(step):
+            try:
+                if self._timer is None:
+                    self._try_step(step)
+                else:
+                    with self._timer.phase(step.name):
+                        self._try_step(step)
+                results.put((step, None))
+            except Exception:
+                results.put((step, sys.exc_info()))
+
+        while True:
+            if failure is None:
+                for step in [s for s in pending
+                             if set(s.requires) <= set(self.done)]:
+                    if not pool.free():
+                        break
+                    pending.remove(step)
+                    running.add(step.name)
+                    LOG.debug("%(flow)s: start step %(step)s",
+                              {'flow': self._name, 'step': step.name})
+                    pool.spawn_n(_run_step, step)
+
+            if not running:
+                break
+
+            step, exc_info = results.get()
+            running.remove(step.name)
+            if exc_info is None:
+                self.done.append(step.name)
+                continue
+
+            self.failed.append(step.name)
+            if failure is None:
+                failure = exc_info
+            else:
+                LOG.warning(_LW("%(flow)s: step %(step)s also failed: "
+                                "%(err)s"),
+                            {'flow': self._name, 'step': step.name,
+                             'err': zvmutils.format_exception_msg(
+                                                                exc_info[1])})
+
+        if failure is not None:
+            self._rollback()
+            six.reraise(*failure)
+
+    def _try_step(self, step):
+        attempt = 0
+        while True:
+            try:
+                return step.func()
+            except Exception as err:
+                if (attempt >= step.retries or self._retry_if is None or
+                        not self._retry_if(err)):
+                    raise
+                exc_info = sys.exc_info()
+
+            attempt += 1
+            self.retried[step.name] = attempt
+            LOG.warning(_LW("%(flow)s: step %(step)s failed, retry "
+                            "%(attempt)d of %(retries)d: %(err)s"),
+                        {'flow': self._name, 'step': step.name,
+                         'attempt': attempt, 'retries': step.retries,
+                         'err': zvmutils.format_exception_msg(exc_info[1])})
+            if step.undo is not None:
+                try:
+                    step.undo()
+                except Exception as err:
+                    # Doing the step again is not safe, fail with the
+                    # original error
+                    LOG.warning(_LW("%(flow)s: failed to clean up step "
+                                    "%(step)s: %(err)s"),
+                                {'flow': self._name, 'step': step.name,
+                                 'err': zvmutils.format_exception_msg(err)})
+                    six.reraise(*exc_info)
+            time.sleep(self._retry_interval * 2 ** (attempt - 1))
+
+    def _rollback(self):
+        steps = dict((s.name, s) for s in self._steps)
+        for name in (list(reversed(self.failed)) +
+                     list(reversed(self.done))):
+            if steps[name].rollback is None:
+                continue
+            self.rolled_back.append(name)
+            LOG.debug("%(flow)s: roll back step %(step)s",
+                      {'flow': self._name, 'step': name})
+            try:
+                steps[name].rollback()
+            except Exception as err:
+                LOG.warning(_LW("%(flow)s: failed to roll back step "
+                                "%(step)s: %(err)s"),
+                            {'flow': self._name, 'step': name,
+                             'err': zvmutils.format_exception_msg(err)})
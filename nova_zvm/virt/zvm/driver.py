@@ -13,8 +13,7 @@
 #    under the License.
 
 import contextlib
-import datetime
-import eventlet
+import functools
 import itertools
 import operator
 import os
@@ -37,23 +36,27 @@ from nova.virt import driver
 from nova.volume import cinder
 from oslo_log import log as logging
 from oslo_serialization import jsonutils
-from oslo_service import loopingcall
 from oslo_utils import excutils
-from oslo_utils import timeutils
 from oslo_utils import units
 from oslo_utils import uuidutils
 from oslo_utils import versionutils
 
+from nova_zvm.virt.zvm import admission
 from nova_zvm.virt.zvm import conf
 from nova_zvm.virt.zvm import configdrive as zvmconfigdrive
 from nova_zvm.virt.zvm import const
+from nova_zvm.virt.zvm import dag
 from nova_zvm.virt.zvm import dist
 from nova_zvm.virt.zvm import exception
 from nova_zvm.virt.zvm import imageop
 from nova_zvm.virt.zvm import instance as zvminstance
 from nova_zvm.virt.zvm import networkop
+from nova_zvm.virt.zvm import pool
+from nova_zvm.virt.zvm import prewarm
+from nova_zvm.virt.zvm import timing
 from nova_zvm.virt.zvm import utils as zvmutils
 from nova_zvm.virt.zvm import volumeop
+from nova_zvm.virt.zvm import waiter as zvmwaiter
 
 
 LOG = logging.getLogger(__name__)
@@ -78,6 +81,9 @@ class ZVMDriver(driver.ComputeDriver):
     def __init__(self, virtapi):
         super(ZVMDriver, self).__init__(virtapi)
         self._xcat_url = zvmutils.get_xcat_url()
+        # Reported in the host stats, which are loaded below
+        self._warm_pool = pool.WarmPool(self)
+        timing.register_stats('warm_pool', self._warm_pool.get_stats)
 
         # incremental sleep interval list
         _inc_slp = [5, 10, 20, 30, 60]
@@ -93,6 +99,7 @@ class ZVMDriver(driver.ComputeDriver):
                             "will sleep some time and check again"),
                             {'xcat_version': self._xcat_version,
                              'minimum': const.XCAT_MINIMUM_VERSION})
+            zvmutils.get_mn_facts().invalidate('xcat_version')
             self._xcat_version = self._get_xcat_version()
             version_ok = self.has_min_version(const.XCAT_MINIMUM_VERSION)
 
@@ -117,6 +124,10 @@ class ZVMDriver(driver.ComputeDriver):
 
         self._networkop = networkop.NetworkOperator()
         self._zvm_images = imageop.ZVMImages()
+        timing.register_stats('image_cache',
+                              self._zvm_images.image_cache.get_stats)
+        self._prewarmer = prewarm.ImagePrewarmer(self)
+        timing.register_stats('image_prewarm', self._prewarmer.get_stats)
         self._pathutils = zvmutils.PathUtils()
         self._networkutils = zvmutils.NetworkUtils()
         self._volumeop = volumeop.VolumeOperator()
@@ -128,8 +139,35 @@ class ZVMDriver(driver.ComputeDriver):
         # import image to nova if root_disk_units not set,so multi threads
         # might work on same image and the lastest one will overwrite the
         # former ones' image data.The former ones can't find the data any more
-        # so add this semaphore to synchronize between those threads
-        self._imageop_semaphore = eventlet.semaphore.Semaphore(1)
+        # so synchronize the threads working on the same image, the waiting
+        # ones reuse the result. Different images are prepared in parallel.
+        self._image_locks = zvmutils.KeyedLock()
+
+        # Limit the spawns running the expensive phases at the same time
+        self._admission = admission.AdmissionController()
+        timing.register_stats('admission_queues', self._admission.get_stats)
+
+        # Requests of concurrent spawns made while a previous one is in
+        # progress are combined into one request for all of them
+        self._makehosts_batcher = zvmutils.Batcher('makehosts',
+                                    lambda nodes: self._networkop.makehosts())
+        self._power_on_batcher = zvmutils.Batcher('power on',
+                                                  zvmutils.power_on_nodes)
+
+        # All instances waiting for the same state are checked together by
+        # one polling loop instead of one loop per instance
+        self._state_waiter = zvmwaiter.StateWaiter()
+        self._boot_time_model = zvmwaiter.BootTimeModel()
+        self._state_waiter.register(zvmwaiter.REACHABLE,
+                                    self._get_reachable_nodes)
+        self._state_waiter.register(zvmwaiter.POWER_OFF,
+                                    zvmwaiter.get_powered_off_nodes)
+        # NICs are normally granted by neutron-zvm-agent within seconds,
+        # check them at a short interval backing off to the normal one
+        self._nic_switch_cache = {}
+        self._state_waiter.register(zvmwaiter.NICS_GRANTED,
+                                    self._get_nic_granted_nodes,
+                                    const.NIC_CHECK_MIN_INTERVAL)
 
     def init_host(self, host):
         """Initialize anything that is necessary for the driver to function,
@@ -142,6 +180,20 @@ class ZVMDriver(driver.ComputeDriver):
             LOG.warning(_LW("Exception raised while initializing z/VM driver: "
                             "%s"), emsg)
 
+        try:
+            # Later lookups of node attributes are served from the cache
+            zvmutils.get_node_attr_cache().load()
+        except exception.ZVMBaseException as e:
+            LOG.warning(_LW("Failed to load xCAT node attributes: %s"),
+                        e.format_message())
+
+        self._warm_pool.start()
+        self._zvm_images.start_last_use_writer()
+
+    def cleanup_host(self, host):
+        """Write the image last use dates before the service stops."""
+        self._zvm_images.flush_last_use_dates()
+
     def get_info(self, instance):
         """Get the current status of an instance, by name (not ID!)
 
@@ -172,6 +224,12 @@ class ZVMDriver(driver.ComputeDriver):
         """Return the names of all the instances known to the virtualization
         layer, as a list.
         """
+        # Guests of the warm pool are not instances yet
+        return [node for node in self._list_guest_nodes()
+                if not self._warm_pool.owns(node)]
+
+    def _list_guest_nodes(self):
+        """Return the names of all the guests managed by the zHCP."""
         zvm_host = CONF.zvm_host
         hcp_base = self._get_hcp_info()['hostname']
 
@@ -301,92 +359,114 @@ class ZVMDriver(driver.ComputeDriver):
         if len(net_conf_files) > 0:
             injected_files.extend(net_conf_files)
 
-        # Create configure drive
         if not CONF.zvm_config_drive_inject_password:
             admin_password = CONF.zvm_image_default_password
-        transportfiles = None
-        if configdrive.required_by(instance):
-            transportfiles = self._create_config_drive(context, instance_path,
-                                instance, injected_files, admin_password,
-                                net_conf_cmds, linuxdist, image_type)
+
+        iucv = zvmutils.xcat_support_iucv(self._xcat_version)
+        # Images captured with the IUCV server of zhcp only need to be told
+        # the authorized userid
+        iucv_in_image = (iucv and not boot_from_volume and
+                         self._image_has_iucv_server(image_meta))
+
+        # First boot scripts of xcatconf4z images are run from the config
+        # drive instead of being punched to the reader one by one
+        bundle_scripts = (CONF.zvm_bundle_transport_files and
+                          image_type in ['xcatconf4z', 'volume-snapshot'] and
+                          configdrive.required_by(instance))
+        if bundle_scripts:
+            first_boot_cmds = [net_conf_cmds,
+                               linuxdist.get_change_passwd_command(
+                                                            admin_password)]
+            if iucv_in_image:
+                first_boot_cmds.append(zvmutils.get_iucv_authorized_command(
+                                                                zhcp_userid))
+            elif iucv:
+                first_boot_cmds.append(zvmutils.get_iucv_setup_commands(
+                                                    os_version, zhcp_userid))
+            net_conf_cmds = '\n'.join(cmd for cmd in first_boot_cmds if cmd)
 
         LOG.info(_LI("The instance %(name)s is spawning at %(node)s"),
                  {'name': zvm_inst._name, 'node': compute_node},
                  instance=instance)
 
-        spawn_start = time.time()
+        timer = timing.PhaseTimer('spawn')
+        zvm_inst.timer = timer
+
+        # A guest of the warm pool with the image deployed already replaces
+        # creating the userid and deploying the image
+        pool_key = None
+        if self._warm_pool.enabled():
+            pool_key = self._warm_pool.get_key(instance, block_device_info)
+        pool_guest = self._warm_pool.claim(pool_key)
+
+        # Values produced by steps and used by later ones
+        deploy = {'image_meta': image_meta,
+                  'image_name': pool_guest and pool_guest.image_name,
+                  'transportfiles': None}
+
+        def _create_config_drive():
+            # Create configure drive
+            if configdrive.required_by(instance):
+                deploy['transportfiles'] = self._create_config_drive(context,
+                                instance_path, instance, injected_files,
+                                admin_password, net_conf_cmds, linuxdist,
+                                image_type)
+
+        def _prepare_image():
+            deploy['image_meta'], deploy['image_name'] = \
+                self._prepare_image_for_spawn(context, instance,
+                                              deploy['image_meta'])
+
+        def _create_userid():
+            if pool_guest is not None:
+                # The node of the instance is defined for its userid
+                self._warm_pool.take_over(pool_guest)
+                return
+            with self._admission.admit(admission.DIRECTORY):
+                zvm_inst.create_userid(block_device_info,
+                                       deploy['image_meta'], context,
+                                       deploy['image_name'])
 
-        try:
-            deploy_image_name = None
-            if not boot_from_volume:
-                tmp_file_fn = None
-                bundle_file_path = None
-
-                with self._imageop_semaphore:
-                    root_disk_units = image_meta['properties'].get(
-                                      'root_disk_units', '')
-                    # Currently, disk unit values have the form number:units,
-                    # for example: '3338:CYL'. Images captured using older
-                    # versions of the driver may lack the colon delimiter and
-                    # units. If the unit-less form is found, convert it to the
-                    # new form by adding the units.
-                    if ':' not in root_disk_units:
-                        (tmp_file_fn, image_file_path,
-                        bundle_file_path) = self._import_image_to_nova(
-                                                    context,
-                                                    instance, image_meta)
-                        image_meta = self._zvm_images.\
-                                        set_image_root_disk_units(
-                                        context, image_meta, image_file_path)
-                        root_disk_units = image_meta['properties'][
-                                                    'root_disk_units']
-                disk_units = root_disk_units.split(":")[1]
-                if ((disk_units == "CYL" and CONF.zvm_diskpool_type == "FBA")
-                    or (disk_units == "BLK" and
-                        CONF.zvm_diskpool_type == "ECKD")):
-                    msg = (_("The image's disk size units is: %(diskunits)s,"
-                             " it doesn't match the specified disk type"
-                             " %(disktype)s in nova.conf."),
-                             {'diskunits': disk_units,
-                              'disktype': CONF.zvm_diskpool_type})
-                    raise exception.ZVMImageError(msg=msg)
-
-                image_in_xcat = self._zvm_images.image_exist_xcat(
-                                    instance['image_ref'])
-                if not image_in_xcat:
-                    self._import_image_to_xcat(context, instance, image_meta,
-                                               tmp_file_fn)
-                elif bundle_file_path is not None:
-                    self._pathutils.clean_temp_folder(bundle_file_path)
-
-                deploy_image_name = self._zvm_images.get_imgname_xcat(
-                                        instance['image_ref'])
-
-            # Create xCAT node and userid for the instance
-            zvm_inst.create_xcat_node(zhcp)
-            zvm_inst.create_userid(block_device_info, image_meta, context,
-                                   deploy_image_name)
-
-            # Setup network for z/VM instance
+        def _setup_network():
             self._preset_instance_network(zvm_inst._name, network_info)
             self._add_nic_to_table(zvm_inst._name, network_info)
 
+        def _deploy_node():
+            if pool_guest is not None:
+                zvm_inst.update_node_info(deploy['image_meta'])
+                if deploy['transportfiles']:
+                    zvmutils.punch_configdrive_file(deploy['transportfiles'],
+                                                    zvm_inst._name)
+                return
             # Call nodeset restapi to deploy image on node
-            if not boot_from_volume:
-                zvm_inst.update_node_info(image_meta)
-                zvm_inst.deploy_node(deploy_image_name, transportfiles)
-            else:
-                zvmutils.punch_configdrive_file(transportfiles, zvm_inst._name)
+            with self._admission.admit(admission.DEPLOY):
+                if not boot_from_volume:
+                    zvm_inst.update_node_info(deploy['image_meta'])
+                    zvm_inst.deploy_node(deploy['image_name'],
+                                         deploy['transportfiles'])
+                else:
+                    zvmutils.punch_configdrive_file(deploy['transportfiles'],
+                                                    zvm_inst._name)
 
+        def _punch_files():
             if image_type in ['xcatconf4z', 'volume-snapshot']:
-                # Change vm's admin password during spawn
-                zvmutils.punch_adminpass_file(instance_path, zvm_inst._name,
-                                              admin_password, linuxdist)
-                if zvmutils.xcat_support_iucv(self._xcat_version):
+                if not bundle_scripts:
+                    # Change vm's admin password during spawn
+                    zvmutils.punch_adminpass_file(instance_path,
+                                                  zvm_inst._name,
+                                                  admin_password, linuxdist)
+                if iucv_in_image:
+                    if not bundle_scripts:
+                        zvmutils.punch_iucv_authorized_file(zvm_inst._name,
+                                            zvm_inst._name, zhcp_userid)
+                    zvmutils.add_iucv_in_zvm_table(zvm_inst._name)
+                elif iucv:
                     # Punch IUCV server files to reader.
                     zvmutils.punch_iucv_file(os_version, zhcp, zhcp_userid,
-                                            zvm_inst._name, instance_path)
+                                            zvm_inst._name, instance_path,
+                                            bundled=bundle_scripts)
 
+        def _setup_ephemeral():
             # punch ephemeral disk info to the instance
             if instance['ephemeral_gb'] != 0:
                 eph_disks = block_device_info.get('ephemerals', [])
@@ -401,54 +481,214 @@ class ZVMDriver(driver.ComputeDriver):
                         zvmutils.process_eph_disk(zvm_inst._name, vdev, fmt,
                                                   mount_dir)
 
+        def _wait_nic():
             # Wait neutron zvm-agent add NIC information to user direct.
             self._wait_and_get_nic_direct(zvm_inst._name, instance)
 
+        def _attach_volumes():
             # Attach persistent volume, exclude root volume
             bdm_attach = list(bdm)
             bdm_attach = self._exclude_root_volume_bdm(bdm_attach,
                                                        root_mount_device)
             self._attach_volume_to_instance(context, instance, bdm_attach)
 
+        def _prepare_volume_boot():
             # 1. Prepare for booting from volume
             # 2. Write the zipl.conf file and issue zipl
-            if boot_from_volume:
-                (lun, wwpn, size, fcp) = zvm_inst.prepare_volume_boot(context,
-                                            instance, bdm, root_mount_device,
-                                            volume_meta)
-                zvmutils.punch_zipl_file(instance_path, zvm_inst._name,
-                                         lun, wwpn, fcp, volume_meta)
-
-            # Power on the instance, then put MN's public key into instance
-            zvm_inst.power_on()
-            spawn_time = time.time() - spawn_start
-            LOG.info(_LI("Instance spawned succeeded in %s seconds"),
-                     spawn_time, instance=instance)
-        except (exception.ZVMXCATCreateNodeFailed,
-                exception.ZVMImageError):
-            with excutils.save_and_reraise_exception():
+            (lun, wwpn, size, fcp) = zvm_inst.prepare_volume_boot(context,
+                                        instance, bdm, root_mount_device,
+                                        volume_meta)
+            zvmutils.punch_zipl_file(instance_path, zvm_inst._name,
+                                     lun, wwpn, fcp, volume_meta)
+
+        def _delete_xcat_node():
+            # destroy() of the userid rollback removes the node as well
+            if 'create_userid' not in flow.rolled_back:
                 zvm_inst.delete_xcat_node()
-        except (exception.ZVMXCATCreateUserIdFailed,
-                exception.ZVMNetworkError,
-                exception.ZVMVolumeError,
-                exception.ZVMXCATUpdateNodeFailed,
-                exception.ZVMXCATDeployNodeFailed):
-            with excutils.save_and_reraise_exception():
-                self.destroy(context, instance, network_info,
-                             block_device_info)
+
+        def _destroy():
+            # Whatever step failed after it, the partial instance is
+            # cleaned up as the driver API requires
+            self.destroy(context, instance, network_info, block_device_info)
+
+        def _reset_userid():
+            # A failed mkvm may have created part of the user directory
+            # entry, delete it with the node and define the node again
+            zvm_inst.delete_userid(self._get_hcp_info()['nodename'],
+                                   context)
+            create_node()
+
+        # Steps run as soon as the steps they require are done. Files are
+        # punched to the reader in the same order as before.
+        # Steps failed by xCAT or DirMaint errors known to leave the request
+        # undone are done again, keeping the steps done, when doing them
+        # twice is harmless.
+        flow = dag.DAGExecutor('spawn %s' % zvm_inst._name,
+                               CONF.zvm_spawn_step_concurrency, timer,
+                               zvmutils.is_transient_error,
+                               CONF.zvm_spawn_step_retry_interval)
+        retries = CONF.zvm_spawn_step_retries
+        flow.add('config_drive', _create_config_drive)
+        prepare_image = not boot_from_volume and pool_guest is None
+        if prepare_image:
+            flow.add('image', _prepare_image)
+        create_node = functools.partial(zvm_inst.create_xcat_node, zhcp)
+        if pool_guest is not None:
+            create_node = functools.partial(create_node, pool_guest.userid)
+        flow.add('create_node', create_node, rollback=_delete_xcat_node,
+                 retries=retries, undo=zvm_inst.delete_xcat_node)
+        # Taking over a pool guest can simply be done again
+        flow.add('create_userid', _create_userid,
+                 requires=['create_node'] + (
+                    ['image'] if prepare_image else []),
+                 rollback=_destroy, retries=retries,
+                 undo=None if pool_guest else _reset_userid)
+        # The retry of create_userid deletes the node with its network
+        # tables, they are written after it
+        flow.add('network', _setup_network, requires=['create_userid'],
+                 retries=retries)
+        # Not retried, the config drive punched to the reader by a failed
+        # try would be punched twice
+        flow.add('deploy', _deploy_node,
+                 requires=['create_userid', 'network', 'config_drive'])
+        # The steps changing the user directory of the instance run one
+        # after the other, waiting for the NICs only reads it
+        flow.add('punch', _punch_files, requires=['deploy'])
+        flow.add('ephemeral', _setup_ephemeral, requires=['punch'])
+        flow.add('nic_wait', _wait_nic, requires=['deploy'])
+        flow.add('volumes', _attach_volumes, requires=['ephemeral'])
+        power_on_requires = ['ephemeral', 'nic_wait', 'volumes']
+        if boot_from_volume:
+            flow.add('volume_boot', _prepare_volume_boot,
+                     requires=['volumes', 'ephemeral'])
+            power_on_requires.append('volume_boot')
+        # Power on the instance, then put MN's public key into instance
+        flow.add('power_on', functools.partial(zvm_inst.power_on,
+                                               booting=True),
+                 requires=power_on_requires,
+                 retries=retries)
+
+        try:
+            flow.run()
+            spawn_time = timer.finish()
+            LOG.info(_LI("Instance spawned succeeded in %(time)s seconds "
+                         "(%(phases)s, retried %(retried)s)"),
+                     {'time': spawn_time, 'phases': timer.summary(),
+                      'retried': flow.retried},
+                     instance=instance)
         except Exception as err:
             # Just a error log then re-raise
             with excutils.save_and_reraise_exception():
                 LOG.error(_("Deploy image to instance %(instance)s "
-                            "failed with reason: %(err)s"),
-                          {'instance': zvm_inst._name, 'err': err},
+                            "failed with reason: %(err)s (%(phases)s, "
+                            "done %(done)s, retried %(retried)s)"),
+                          {'instance': zvm_inst._name, 'err': err,
+                           'phases': timer.summary(), 'done': flow.done,
+                           'retried': flow.retried},
                           instance=instance)
+                # The pool guest is unchanged until it is taken over
+                if (pool_guest is not None and
+                        'create_userid' not in flow.done + flow.failed):
+                    self._warm_pool.release(pool_guest)
         finally:
             self._pathutils.clean_temp_folder(instance_path)
 
         # Update image last deploy date in xCAT osimage table
         if not boot_from_volume:
-            self._zvm_images.update_last_use_date(deploy_image_name)
+            self._zvm_images.update_last_use_date(deploy['image_name'])
+            # Guests of the pool are made from the prepared image meta
+            self._warm_pool.record_spawn(pool_key,
+                            deploy['image_meta'] if prepare_image else None,
+                            deploy['image_name'])
+            self._prewarmer.record_spawn(instance['image_ref'])
+
+    def _image_has_iucv_server(self, image_meta):
+        """Whether the image has the IUCV server of zhcp installed."""
+        version = image_meta['properties'].get(
+                                        const.IMAGE_IUCV_SERVER_VERSION)
+        if not version:
+            return False
+
+        try:
+            zhcp_version = zvmutils.get_iucv_server_version(
+                                            self._get_hcp_info()['nodename'])
+        except exception.ZVMBaseException as err:
+            LOG.warning(_LW("Failed to get the IUCV server version of zhcp: "
+                            "%s"), err.format_message())
+            return False
+        return version == zhcp_version
+
+    def _get_guest_iucv_server_version(self, inst_name):
+        """Get the IUCV server version of an instance, None if unknown."""
+        try:
+            return zvmutils.get_guest_iucv_server_version(inst_name)
+        except exception.ZVMBaseException as err:
+            LOG.debug("Failed to get the IUCV server version of %(inst)s: "
+                      "%(err)s", {'inst': inst_name,
+                                  'err': err.format_message()})
+            return None
+
+    def _prepare_image_for_spawn(self, context, instance, image_meta):
+        """Make sure the image is in xCAT.
+
+        Spawns of the same image wait for the one preparing it and reuse
+        its result. Only the download and import of the image are limited
+        by zvm_spawn_image_concurrency.
+
+        :returns: a tuple of the image meta and the xCAT image name to deploy
+        """
+        return self._image_locks.run(instance['image_ref'],
+                                     functools.partial(
+                                        self._do_prepare_image_for_spawn,
+                                        context, instance, image_meta))
+
+    def _do_prepare_image_for_spawn(self, context, instance, image_meta):
+        tmp_file_fn = None
+        bundle_file_path = None
+
+        root_disk_units = image_meta['properties'].get('root_disk_units', '')
+        # Currently, disk unit values have the form number:units,
+        # for example: '3338:CYL'. Images captured using older
+        # versions of the driver may lack the colon delimiter and
+        # units. If the unit-less form is found, convert it to the
+        # new form by adding the units.
+        if ':' not in root_disk_units:
+            image_file_path = None
+            if not (CONF.zvm_image_stream_import and image_meta.get('size')):
+                with self._admission.admit(admission.IMAGE):
+                    (tmp_file_fn, image_file_path,
+                    bundle_file_path) = self._import_image_to_nova(context,
+                                                                   instance,
+                                                                   image_meta)
+            # Without the image file, only the image header is downloaded,
+            # and the image is streamed to xCAT if it is not there
+            image_meta = self._zvm_images.set_image_root_disk_units(
+                                context, image_meta, image_file_path)
+            root_disk_units = image_meta['properties']['root_disk_units']
+        disk_units = root_disk_units.split(":")[1]
+        if ((disk_units == "CYL" and CONF.zvm_diskpool_type == "FBA")
+            or (disk_units == "BLK" and
+                CONF.zvm_diskpool_type == "ECKD")):
+            msg = (_("The image's disk size units is: %(diskunits)s,"
+                     " it doesn't match the specified disk type"
+                     " %(disktype)s in nova.conf."),
+                     {'diskunits': disk_units,
+                      'disktype': CONF.zvm_diskpool_type})
+            raise exception.ZVMImageError(msg=msg)
+
+        image_in_xcat = self._zvm_images.image_exist_xcat(
+                            instance['image_ref'], image_meta.get('checksum'))
+        if not image_in_xcat:
+            with self._admission.admit(admission.IMAGE):
+                self._import_image_to_xcat(context, instance, image_meta,
+                                           tmp_file_fn)
+        elif bundle_file_path is not None:
+            self._pathutils.clean_temp_folder(bundle_file_path)
+
+        deploy_image_name = self._zvm_images.get_imgname_xcat(
+                                instance['image_ref'],
+                                image_meta.get('checksum'))
+        return image_meta, deploy_image_name
 
     def _create_config_drive(self, context, instance_path, instance,
                              injected_files, admin_password, commands,
@@ -511,7 +751,7 @@ class ZVMDriver(driver.ComputeDriver):
             raise exception.ZVMNetworkError(msg=msg)
 
         self._networkop.add_xcat_host(instance_name, ip_addr, instance_name)
-        self._networkop.makehosts()
+        self._makehosts_batcher.submit(instance_name)
 
     def _import_image_to_nova(self, context, instance, image_meta):
         image_file_name = image_meta['properties']['image_file_name']
@@ -528,7 +768,8 @@ class ZVMDriver(driver.ComputeDriver):
                                      image_meta['id'],
                                      image_file_path,
                                      instance['user_id'],
-                                     instance['project_id'])
+                                     instance['project_id'],
+                                     image_meta.get('checksum'))
         return (tmp_file_fn, image_file_path, bundle_file_path)
 
     def _import_image_to_xcat(self, context, instance, image_meta, tmp_f_fn):
@@ -539,6 +780,19 @@ class ZVMDriver(driver.ComputeDriver):
         image_file_name = image_meta['properties']['image_file_name']
         disk_file = ''.join(j for j in image_file_name.split(".img")[0]
                            if j.isalnum()) + ".img"
+        if (tmp_f_fn is None and CONF.zvm_image_stream_import and
+                image_meta.get('size')):
+            # The image has not been downloaded yet, write the bundle
+            # while downloading it
+            image_name = zvmutils.remove_prefix_of_unicode(image_name)
+            image_bundle_package = self._zvm_images.stream_image_bundle(
+                                    context, image_meta, image_name,
+                                    disk_file, spawn_path,
+                                    self._pathutils.make_time_stamp())
+            self._put_image_bundle_to_xcat(context, instance, image_name,
+                                           image_bundle_package)
+            return
+
         if tmp_f_fn is None:
             tmp_f_fn = self._pathutils.make_time_stamp()
             bundle_file_path = self._pathutils.get_bundle_tmp_path(tmp_f_fn)
@@ -550,7 +804,8 @@ class ZVMDriver(driver.ComputeDriver):
                                      image_meta['id'],
                                      image_file_path,
                                      instance['user_id'],
-                                     instance['project_id'])
+                                     instance['project_id'],
+                                     image_meta.get('checksum'))
         else:
             bundle_file_path = self._pathutils.get_bundle_tmp_path(tmp_f_fn)
             image_file_path = self._pathutils.get_img_path(
@@ -569,7 +824,12 @@ class ZVMDriver(driver.ComputeDriver):
         image_bundle_package = self._zvm_images.generate_image_bundle(
                                     spawn_path, tmp_f_fn, image_name)
 
-        LOG.debug("Importing the image %s to xCAT", image_meta['id'],
+        self._put_image_bundle_to_xcat(context, instance, image_name,
+                                       image_bundle_package)
+
+    def _put_image_bundle_to_xcat(self, context, instance, image_name,
+                                  image_bundle_package):
+        LOG.debug("Importing the image %s to xCAT", instance['image_ref'],
                   instance=instance)
         profile_str = image_name, instance['image_ref'].replace('-', '_')
         image_profile = '_'.join(profile_str)
@@ -607,6 +867,8 @@ class ZVMDriver(driver.ComputeDriver):
         if self._instance_exists(inst_name):
             LOG.info(_LI("Destroying instance %s"), inst_name,
                      instance=instance)
+            timer = timing.PhaseTimer('destroy')
+            timer.start_phase('diagnostics')
 
             # Collect diagnostics when the instance is unreachable, since this
             # is most often caused by a deployment failure but the deployment
@@ -627,6 +889,7 @@ class ZVMDriver(driver.ComputeDriver):
                 zvm_inst.collect_diagnostics(context,
                                     const.DIAGNOSTICS_RSN_DEPLOYMENT_TIMEOUT)
 
+            timer.start_phase('volumes')
             bdm = driver.block_device_info_get_mapping(block_device_info)
             try:
                 bdm_det = list(bdm)
@@ -640,6 +903,7 @@ class ZVMDriver(driver.ComputeDriver):
                 LOG.warning(_LW("Failed to detach volume: %s"),
                          err.format_message(), instance=instance)
 
+            timer.start_phase('network')
             if network_info:
                 try:
                     for vif in network_info:
@@ -649,7 +913,13 @@ class ZVMDriver(driver.ComputeDriver):
                                  "destroying z/VM instance %s"), inst_name,
                              instance=instance)
 
+            timer.start_phase('delete_userid')
             zvm_inst.delete_userid(self._get_hcp_info()['nodename'], context)
+            destroy_time = timer.finish()
+            LOG.info(_LI("Instance destroyed in %(time)s seconds "
+                         "(%(phases)s)"),
+                     {'time': destroy_time, 'phases': timer.summary()},
+                     instance=instance)
         else:
             LOG.warning(_LW('Instance %s does not exist'), inst_name,
                      instance=instance)
@@ -658,7 +928,8 @@ class ZVMDriver(driver.ComputeDriver):
         """Clean the image cache in xCAT MN."""
         LOG.info(_LI("Check and clean image cache in xCAT"))
         clean_period = CONF.xcat_image_clean_period
-        self._zvm_images.clean_image_cache_xcat(clean_period)
+        self._zvm_images.clean_image_cache_xcat(clean_period, context)
+        self._prewarmer.run(context, filtered_instances)
 
     def reboot(self, context, instance, network_info, reboot_type,
                block_device_info=None, bad_volumes_callback=None):
@@ -800,6 +1071,9 @@ class ZVMDriver(driver.ComputeDriver):
         :param image_href: Reference to a pre-created image that will
                          hold the snapshot.
         """
+        timer = timing.PhaseTimer('snapshot')
+        timer.start_phase('prepare')
+
         # Check the image status
         (image_service, image_id) = glance.get_remote_image_service(context,
                                                                     image_href)
@@ -822,6 +1096,13 @@ class ZVMDriver(driver.ComputeDriver):
         elif state == power_state.PAUSED:
             self.unpause(instance)
 
+        # Record the IUCV server in the image so that its instances don't
+        # need it to be punched
+        iucv_version = None
+        if zvmutils.xcat_support_iucv(self._xcat_version):
+            iucv_version = self._get_guest_iucv_server_version(
+                                                        instance['name'])
+
         # Check xCAT free space and invoke the zvmimages.create_zvm_image()
         try:
             free_space_xcat = self._zvm_images.get_free_space_xcat(
@@ -835,6 +1116,7 @@ class ZVMDriver(driver.ComputeDriver):
                 size_needed = float(larger - free_space_xcat)
                 self._zvm_images.prune_image_xcat(context, size_needed,
                                               imgcapture_needed)
+            timer.start_phase('capture')
             image_name_xcat = self._zvm_images.create_zvm_image(instance,
                                                                 image_name,
                                                                 image_href)
@@ -853,6 +1135,7 @@ class ZVMDriver(driver.ComputeDriver):
         if not shared_image_repo:
             # The image will be exported from xCAT and imported to nova after
             # successfully captured.
+            timer.start_phase('export')
             snapshot_time_path = self._zvm_images.get_snapshot_time_path()
             try:
                 image_bundle = self._zvm_images.get_image_from_xcat(
@@ -870,6 +1153,7 @@ class ZVMDriver(driver.ComputeDriver):
             self._zvm_images.delete_image_from_xcat(image_name_xcat)
 
             # Untar the image_bundle and parse manifest.xml
+            timer.start_phase('untar')
             image_package_path = os.path.join(snapshot_time_path,
                                               image_name_xcat)
             try:
@@ -922,6 +1206,9 @@ class ZVMDriver(driver.ComputeDriver):
             'disk_format': 'raw',
             'container_format': 'bare',
         }
+        if iucv_version:
+            new_image_meta['properties'][
+                            const.IMAGE_IUCV_SERVER_VERSION] = iucv_version
 
         # Upload that image to the image service
         image_path = os.path.join(image_package_path, image_file_name)
@@ -937,6 +1224,7 @@ class ZVMDriver(driver.ComputeDriver):
                 # Clean up image from xCAT image repo for all-in-one mode
                 self._zvm_images.delete_image_from_xcat(image_name_xcat)
 
+        timer.start_phase('upload')
         try:
             with open(image_path, 'r') as image_file:
                 image_service.update(context,
@@ -954,7 +1242,11 @@ class ZVMDriver(driver.ComputeDriver):
 
         cleanup_temp_image()
 
-        LOG.info(_LI("Snapshot complete successfully"), instance=instance)
+        snapshot_time = timer.finish()
+        LOG.info(_LI("Snapshot complete successfully in %(time)s seconds "
+                     "(%(phases)s)"),
+                 {'time': snapshot_time, 'phases': timer.summary()},
+                 instance=instance)
 
     def pause(self, instance):
         """Pause the specified instance."""
@@ -1167,6 +1459,7 @@ class ZVMDriver(driver.ComputeDriver):
         dest_host = migrate_data['dest_host']
         LOG.info(_LI("Live-migrating %(inst)s to %(dest)s"),
                  {'inst': inst_name, 'dest': dest_host}, instance=instance_ref)
+        timer = timing.PhaseTimer('live_migration')
 
         same_mn = migrate_data['pre_live_migration_result']['same_xcat_mn']
         dest_diff_mn_key = migrate_data['pre_live_migration_result'].get(
@@ -1178,6 +1471,7 @@ class ZVMDriver(driver.ComputeDriver):
             zvmutils.xdsh(inst_name, auth_command)
 
         try:
+            timer.start_phase('relocate')
             self._vmrelocate(dest_host, inst_name, 'move')
         except nova_exception.MigrationError as err:
             LOG.error(_("Live-migration failed: %s"), err.format_message(),
@@ -1188,12 +1482,19 @@ class ZVMDriver(driver.ComputeDriver):
 
         if not same_mn:
             # Delete node definition at source xCAT MN
+            timer.start_phase('cleanup')
             zvm_inst = ZVMInstance(self, instance_ref)
             self._networkop.clean_mac_switch_host(zvm_inst._name)
             zvm_inst.delete_xcat_node()
 
+        timer.start_phase('post')
         post_method(ctxt, instance_ref, dest,
                     block_migration, migrate_data)
+        migration_time = timer.finish()
+        LOG.info(_LI("Live-migrated %(inst)s in %(time)s seconds "
+                     "(%(phases)s)"),
+                 {'inst': inst_name, 'time': migration_time,
+                  'phases': timer.summary()}, instance=instance_ref)
 
     def post_live_migration_at_destination(self, ctxt, instance_ref,
                                            network_info,
@@ -1223,6 +1524,19 @@ class ZVMDriver(driver.ComputeDriver):
                                             nic_vdev, zhcp)
             nic_vdev = str(hex(int(nic_vdev, 16) + 3))[2:]
 
+    def rollback_live_migration_at_destination(self, context, instance,
+                                               network_info,
+                                               block_device_info,
+                                               destroy_disks=True,
+                                               migrate_data=None):
+        """Forget the xCAT MN public key after a failed live migration.
+
+        The key handed to the source by pre_live_migration may have been
+        rotated since it was read, so it is read again by the next live
+        migration.
+        """
+        zvmutils.get_mn_facts().invalidate('mn_pub_key')
+
     def unfilter_instance(self, instance, network_info):
         """Stop filtering instance."""
         # Not supported for now
@@ -1311,6 +1625,8 @@ class ZVMDriver(driver.ComputeDriver):
                                         fields.VMMode.HVM)]
         data['zhcp'] = self._get_hcp_info(info['zhcp'])
         data['ipl_time'] = info['ipl_time']
+        data['warm_pool'] = self._warm_pool.get_stats()
+        data['image_cache'] = self._zvm_images.image_cache.get_stats()
 
         caps.append(data)
 
@@ -1320,11 +1636,19 @@ class ZVMDriver(driver.ComputeDriver):
         if self._host_stats != []:
             return self._host_stats[0]['zhcp']
         else:
+            facts = zvmutils.get_mn_facts()
+            zhcp = facts.get('zhcp')
             if hcp_hostname is not None:
-                hcp_node = hcp_hostname.partition('.')[0]
-                return {'hostname': hcp_hostname,
-                        'nodename': hcp_node,
-                        'userid': zvmutils.get_userid(hcp_node)}
+                # Reload when zHCP of the host changed
+                if zhcp is None or zhcp['hostname'] != hcp_hostname:
+                    hcp_node = hcp_hostname.partition('.')[0]
+                    zhcp = {'hostname': hcp_hostname,
+                            'nodename': hcp_node,
+                            'userid': zvmutils.get_userid(hcp_node)}
+                    facts.set('zhcp', zhcp)
+                return zhcp
+            elif zhcp is not None:
+                return zhcp
             else:
                 self._host_stats = self.update_host_status()
                 return self._host_stats[0]['zhcp']
@@ -1581,6 +1905,8 @@ class ZVMDriver(driver.ComputeDriver):
         # changes the image_meta from dict to object, we have several
         # unique property can't be handled well
         # see bug 1537921 for detail info
+        timer = timing.PhaseTimer('finish_migration')
+        timer.start_phase('prepare')
         image_meta = self._image_api.get(context, image_meta.id)
 
         disk_info = jsonutils.loads(disk_info)
@@ -1637,6 +1963,8 @@ class ZVMDriver(driver.ComputeDriver):
         zhcp_userid = hcp_info['userid']
 
         new_inst = ZVMInstance(self, instance)
+        new_inst.timer = timer
+        timer.start_phase('transfer')
         if same_xcat_mn:
             # Same xCAT MN
             # cleanup networking, will re-configure later
@@ -1694,6 +2022,7 @@ class ZVMDriver(driver.ComputeDriver):
 
         try:
             # Pre-config network and create zvm userid
+            timer.start_phase('create_userid')
             self._preset_instance_network(new_inst._name, network_info)
             new_inst.create_userid(block_device_info, image_meta, context)
 
@@ -1702,8 +2031,10 @@ class ZVMDriver(driver.ComputeDriver):
                 zvmutils.process_eph_disk(new_inst._name)
 
             # Add nic and deploy the image
+            timer.start_phase('deploy')
             self._add_nic_to_table(new_inst._name, network_info)
             self._deploy_root_and_ephemeral(new_inst, image_name_xcat)
+            timer.start_phase('nic_wait')
             self._wait_and_get_nic_direct(new_inst._name, instance)
         except exception.ZVMBaseException:
             with excutils.save_and_reraise_exception():
@@ -1733,6 +2064,7 @@ class ZVMDriver(driver.ComputeDriver):
                         new_inst.power_on()
 
         # Cleanup image from xCAT image repository
+        timer.start_phase('start')
         self._zvm_images.delete_image_from_xcat(image_name_xcat)
 
         bdm = driver.block_device_info_get_mapping(block_device_info)
@@ -1757,6 +2089,11 @@ class ZVMDriver(driver.ComputeDriver):
                     new_inst.copy_xcat_node(old_inst._name)
                     old_inst.delete_xcat_node()
 
+        migration_time = timer.finish()
+        LOG.info(_LI("Migration finished in %(time)s seconds (%(phases)s)"),
+                 {'time': migration_time, 'phases': timer.summary()},
+                 instance=instance)
+
     def _reconfigure_networking(self, inst_name, network_info, instance,
                                 userid=None):
         self._preset_instance_network(inst_name, network_info)
@@ -1843,20 +2180,18 @@ class ZVMDriver(driver.ComputeDriver):
             self.power_on({}, instance, [])
 
     def _get_nic_switch_info(self, inst_name):
-        url = self._xcat_url.tabdump("/switch")
-        with zvmutils.expect_invalid_xcat_resp_data():
-            switch_info = zvmutils.xcat_request("GET", url)['data'][0]
-            switch_info.pop(0)
-            switch_dict = {}
-            for item in switch_info:
-                switch_list = item.split(',')
-                if switch_list[0].strip('"') == inst_name:
-                    switch_dict[switch_list[4].strip('"')] = \
-                                            switch_list[1].strip('"')
-
-            LOG.debug("Switch info the %(inst_name)s is %(switch_dict)s",
-                        {"inst_name": inst_name, "switch_dict": switch_dict})
-            return switch_dict
+        """Get {interface: switch} of the NICs of inst_name.
+
+        Only the switch table rows of inst_name are queried.
+        """
+        rows = zvmutils.xcat_cmd_gettab_rows('switch', 'node', inst_name,
+                                             ['interface', 'switch'])
+        switch_dict = dict((row.get('interface', ''), row.get('switch', ''))
+                           for row in rows)
+
+        LOG.debug("Switch info the %(inst_name)s is %(switch_dict)s",
+                    {"inst_name": inst_name, "switch_dict": switch_dict})
+        return switch_dict
 
     def _get_user_directory(self, inst_name):
         url = self._xcat_url.lsvm('/' + inst_name)
@@ -1891,52 +2226,64 @@ class ZVMDriver(driver.ComputeDriver):
                       {'instance': inst_name, 'err': err.format_message()})
             raise err
 
-    def _wait_and_get_nic_direct(self, inst_name, instance):
-        """Wait until neutron zvm-agent add NICs into user direct done."""
-        def _wait_for_nic_add_in_direct(inst_name, expiration):
-            if (CONF.zvm_reachable_timeout and
-                    timeutils.utcnow() > expiration):
-                msg = _("NIC update check failed "
-                        "on instance:%s") % instance.uuid
-                raise exception.ZVMNetworkError(msg=msg)
+    def _is_nic_granted(self, inst_name, switch_dict):
+        """Check whether all NICs in switch_dict are in user direct."""
+        if not switch_dict or '' in switch_dict.values():
+            # the nic switch info is not ready yet
+            return False
 
-            try:
-                switch_dict = self._get_nic_switch_info(inst_name)
-                if switch_dict and '' not in switch_dict.values():
-                    for key, value in switch_dict.items():
-                        args = '&checknics=' + key
-                        url = self._xcat_url.lsvm('/' + inst_name)
-                        url = url + args
-                        res_info = zvmutils.xcat_request("GET", url)
-                        with zvmutils.expect_invalid_xcat_resp_data(res_info):
-                            if ("errorcode" in res_info and
-                                (len(res_info["errorcode"]) > 0) and
-                                res_info["errorcode"][0] != '0'):
-                                # we didn't found the definition
-                                return
-                else:
-                    # in this case, the nic switch info is not ready yet
-                    # need another loop to check until time out or find it
-                    return
+        for key in sorted(switch_dict.keys()):
+            args = '&checknics=' + key
+            url = self._xcat_url.lsvm('/' + inst_name)
+            url = url + args
+            res_info = zvmutils.xcat_request("GET", url)
+            with zvmutils.expect_invalid_xcat_resp_data(res_info):
+                if ("errorcode" in res_info and
+                    (len(res_info["errorcode"]) > 0) and
+                    res_info["errorcode"][0] != '0'):
+                    # we didn't found the definition
+                    return False
+        return True
 
+    def _get_nic_granted_nodes(self, nodes):
+        """Get the nodes in nodes whose NICs are all in user direct."""
+        granted = set()
+        for node in nodes:
+            try:
+                # Switch rows don't change once complete, keep them until
+                # the NICs are granted
+                switch_dict = self._nic_switch_cache.get(node)
+                if switch_dict is None:
+                    switch_dict = self._get_nic_switch_info(node)
+                    if switch_dict and '' not in switch_dict.values():
+                        self._nic_switch_cache[node] = switch_dict
+                if self._is_nic_granted(node, switch_dict):
+                    granted.add(node)
             except exception.ZVMBaseException as e:
                 # Ignore any zvm driver exceptions
-                LOG.info(_LI('encounter error %s during get vswitch info'),
-                         e.format_message(), instance=instance)
-                return
+                LOG.info(_LI('encounter error %(err)s during get vswitch '
+                             'info of %(node)s'),
+                         {'err': e.format_message(), 'node': node})
+        return granted
 
-            # Enter here means all NIC granted
-            LOG.info(_LI("All NICs are added in user direct for "
-                         "instance %s."), inst_name, instance=instance)
-            raise loopingcall.LoopingCallDone()
+    def _get_reachable_nodes(self, nodes):
+        return zvmwaiter.get_reachable_nodes(nodes,
+                            zvmutils.xcat_support_iucv(self._xcat_version))
 
-        expiration = timeutils.utcnow() + datetime.timedelta(
-                             seconds=CONF.zvm_reachable_timeout)
+    def _wait_and_get_nic_direct(self, inst_name, instance):
+        """Wait until neutron zvm-agent add NICs into user direct done."""
         LOG.info(_LI("Wait neturon-zvm-agent to add NICs to %s user direct."),
                  inst_name, instance=instance)
-        timer = loopingcall.FixedIntervalLoopingCall(
-                    _wait_for_nic_add_in_direct, inst_name, expiration)
-        timer.start(interval=10).wait()
+        granted = self._state_waiter.wait(inst_name, zvmwaiter.NICS_GRANTED,
+                                          CONF.zvm_reachable_timeout)
+        self._nic_switch_cache.pop(inst_name, None)
+        if not granted:
+            msg = _("NIC update check failed "
+                    "on instance:%s") % instance.uuid
+            raise exception.ZVMNetworkError(msg=msg)
+
+        LOG.info(_LI("All NICs are added in user direct for "
+                     "instance %s."), inst_name, instance=instance)
 
     def get_console_output(self, context, instance):
         """Get console output for an instance."""
@@ -2000,12 +2347,7 @@ class ZVMDriver(driver.ComputeDriver):
         return bdm
 
     def _get_xcat_version(self):
-        url = self._xcat_url.version()
-        version_info = zvmutils.xcat_request("GET", url)
-        with zvmutils.expect_invalid_xcat_resp_data(version_info):
-            dict_str = version_info['data'][0][0]
-            version = dict_str.split()[1]
-        return version
+        return zvmutils.get_xcat_version()
 
     def _version_check(self, req_ver=None, op=operator.lt):
         try:
@@ -0,0 +1,352 @@
+# Copyright 2017 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import hashlib
+import os
+import re
+import time
+
+from nova.i18n import _LI, _LW
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_utils import units
+from oslo_utils import uuidutils
+
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+# Glance checksums are md5 hex digests
+_CHECKSUM_RE = re.compile('^[0-9a-f]{32}$')
+_PART_SUFFIX = '.part'
+_STATS_FILE = 'stats.json'
+CHUNK_SIZE = 64 * units.Ki
+# Zeros are left as holes in image files by blocks of the file system
+SPARSE_BLOCK_SIZE = 4 * units.Ki
+
+
+def md5sum(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class SparseFile(object):
+    """File written sequentially, leaving holes where it has zeros.
+
+    Disk images are mostly empty, so the image files and bundles written
+    on the compute node only take the space of their data. Reading the
+    file returns the zeros again, so it is copied or transferred to xCAT
+    in full.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._f = open(path, 'wb')
+        self._zeros = b'\0' * SPARSE_BLOCK_SIZE
+        self._pos = 0
+        # Bytes of zeros which were not written
+        self.skipped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def tell(self):
+        return self._pos
+
+    def write(self, data):
+        if self._zeros not in data:
+            self._write(data)
+            return
+
+        # Skip the zeros of the blocks data covers, and write the rest
+        start = offset = 0
+        while offset < len(data):
+            end = min(len(data), offset + SPARSE_BLOCK_SIZE -
+                      (self._pos + offset - start) % SPARSE_BLOCK_SIZE)
+            if data.count(b'\0', offset, end) == end - offset:
+                self._write(data[start:offset])
+                self._pos += end - offset
+                self.skipped += end - offset
+                start = end
+            offset = end
+        self._write(data[start:])
+
+    def _write(self, data):
+        if data:
+            if self._f.tell() != self._pos:
+                self._f.seek(self._pos)
+            self._f.write(data)
+            self._pos += len(data)
+
+    def close(self):
+        if self._f.closed:
+            return
+        # Zeros at the end make the file longer without being written
+        if self._f.tell() != self._pos:
+            self._f.truncate(self._pos)
+        self._f.close()
+        LOG.debug("Wrote %(size)d bytes to %(path)s, %(skipped)d bytes of "
+                  "zeros left as holes", {'size': self._pos,
+                                          'path': self.path,
+                                          'skipped': self.skipped})
+
+
+def copy_sparse(src, dst_path):
+    """Copy the file object src to dst_path as a sparse file."""
+    with SparseFile(dst_path) as dst:
+        for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+            dst.write(chunk)
+
+
+def _copy_file(src_path, dst_path):
+    with open(src_path, 'rb') as src:
+        copy_sparse(src, dst_path)
+
+
+class ImageCache(object):
+    """Copies of glance images on the compute node, keyed by checksum.
+
+    An image pruned from xCAT is imported again from the cached copy
+    instead of being downloaded from glance. The file of an image is named
+    by its checksum and its modification time is the time it was last
+    used, so the cache and its LRU order survive a restart of the service.
+    When the cache grows beyond zvm_image_cache_size, the least recently
+    used images are removed.
+    """
+
+    def __init__(self):
+        # checksum -> [size, last used]
+        self._entries = None
+        self._stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0,
+                       'added': 0, 'evicted': 0}
+
+    @staticmethod
+    def enabled():
+        return CONF.zvm_image_cache_size > 0
+
+    @staticmethod
+    def _get_limit():
+        return CONF.zvm_image_cache_size * units.Mi
+
+    @staticmethod
+    def _get_cache_path():
+        path = os.path.normpath(CONF.zvm_image_cache_path or
+                                os.path.join(CONF.zvm_image_tmp_path,
+                                             'image_cache'))
+        if not os.path.exists(path):
+            LOG.debug("Creating the image cache folder %s", path)
+            os.makedirs(path)
+        return path
+
+    def _get_file(self, checksum):
+        return os.path.join(self._get_cache_path(), checksum)
+
+    def _get_part_file(self, checksum):
+        # Unique per download, so that concurrent downloads of the same
+        # image do not write to the same file
+        return '%s.%s%s' % (self._get_file(checksum),
+                            uuidutils.generate_uuid().replace('-', ''),
+                            _PART_SUFFIX)
+
+    def _is_part_file(self, checksum, path):
+        name = os.path.basename(path)
+        return (os.path.dirname(path) == self._get_cache_path() and
+                name.startswith(checksum + '.') and
+                name.endswith(_PART_SUFFIX))
+
+    def _load(self):
+        """Scan the cache folder the first time the cache is used."""
+        if self._entries is not None:
+            return
+        self._entries = {}
+        path = self._get_cache_path()
+        for name in os.listdir(path):
+            file_path = os.path.join(path, name)
+            if name.endswith(_PART_SUFFIX):
+                # Left by an interrupted download
+                os.remove(file_path)
+            elif _CHECKSUM_RE.match(name):
+                st = os.stat(file_path)
+                self._entries[name] = [st.st_size, st.st_mtime]
+
+        stats_file = os.path.join(path, _STATS_FILE)
+        if os.path.isfile(stats_file):
+            try:
+                with open(stats_file) as f:
+                    self._stats.update(jsonutils.loads(f.read()))
+            except (IOError, ValueError) as err:
+                LOG.warning(_LW("Failed to load the image cache statistics "
+                                "%(file)s: %(err)s"),
+                            {'file': stats_file, 'err': err})
+        LOG.debug("Image cache %(path)s has %(num)d images",
+                  {'path': path, 'num': len(self._entries)})
+
+    def _save_stats(self):
+        stats_file = os.path.join(self._get_cache_path(), _STATS_FILE)
+        try:
+            with open(stats_file + '.tmp', 'w') as f:
+                f.write(jsonutils.dumps(self._stats))
+            os.rename(stats_file + '.tmp', stats_file)
+        except (IOError, OSError) as err:
+            LOG.warning(_LW("Failed to save the image cache statistics "
+                            "%(file)s: %(err)s"),
+                        {'file': stats_file, 'err': err})
+
+    def _usable(self, checksum):
+        return (self.enabled() and checksum is not None and
+                _CHECKSUM_RE.match(checksum) is not None)
+
+    def lookup(self, checksum):
+        """Return the cached file of the image with checksum, or None.
+
+        A hit marks the image as used now.
+        """
+        if not self._usable(checksum):
+            return None
+        self._load()
+        entry = self._entries.get(checksum)
+        file_path = self._get_file(checksum)
+        if entry is not None and not os.path.isfile(file_path):
+            del self._entries[checksum]
+            entry = None
+
+        if entry is None:
+            self._stats['misses'] += 1
+            self._save_stats()
+            return None
+
+        entry[1] = time.time()
+        os.utime(file_path, (entry[1], entry[1]))
+        self._stats['hits'] += 1
+        self._stats['bytes_saved'] += entry[0]
+        self._save_stats()
+        LOG.debug("Image %s found in the image cache", checksum)
+        return file_path
+
+    def fetch(self, checksum, target):
+        """Put the cached image with checksum at target.
+
+        :returns: True if the image was cached, False otherwise.
+        """
+        file_path = self.lookup(checksum)
+        if file_path is None:
+            return False
+        try:
+            os.link(file_path, target)
+        except OSError:
+            # Another file system
+            _copy_file(file_path, target)
+        return True
+
+    def get_part_file(self, checksum, size):
+        """Return the file to write an image to, None if it isn't cached.
+
+        The file is added to the cache by add() once the image has been
+        verified.
+        """
+        if not self._usable(checksum) or size > self._get_limit():
+            return None
+        return self._get_part_file(checksum)
+
+    def add(self, checksum, src_path):
+        """Add a copy of the image file src_path to the cache.
+
+        A part file from get_part_file() is moved into the cache, any other
+        file is linked or copied after verifying its checksum.
+        """
+        if not self._usable(checksum):
+            return
+        self._load()
+        file_path = self._get_file(checksum)
+        if self._is_part_file(checksum, src_path):
+            os.rename(src_path, file_path)
+        else:
+            size = os.path.getsize(src_path)
+            if size > self._get_limit() or checksum in self._entries:
+                return
+            if md5sum(src_path) != checksum:
+                LOG.warning(_LW("Image file %(file)s does not match the "
+                                "checksum %(checksum)s, not cached"),
+                            {'file': src_path, 'checksum': checksum})
+                return
+            tmp_path = self._get_part_file(checksum)
+            try:
+                os.link(src_path, tmp_path)
+            except OSError:
+                _copy_file(src_path, tmp_path)
+            os.rename(tmp_path, file_path)
+
+        self._entries[checksum] = [os.path.getsize(file_path), time.time()]
+        self._stats['added'] += 1
+        LOG.debug("Image %s added to the image cache", checksum)
+        self._evict(keep=checksum)
+        self._save_stats()
+
+    def remove(self, checksum):
+        """Remove an image from the cache, a corrupted one for example."""
+        self._load()
+        if self._entries.pop(checksum, None) is not None:
+            LOG.warning(_LW("Removing image %s from the image cache"),
+                        checksum)
+            os.remove(self._get_file(checksum))
+            self._save_stats()
+
+    def discard(self, path):
+        """Remove a part file that is not going to be added."""
+        if path is not None and os.path.isfile(path):
+            os.remove(path)
+
+    def _evict(self, keep=None):
+        """Remove the least recently used images beyond the size limit."""
+        total = sum(e[0] for e in self._entries.values())
+        limit = self._get_limit()
+        for checksum in sorted(self._entries,
+                               key=lambda c: self._entries[c][1]):
+            if total <= limit:
+                break
+            if checksum == keep:
+                continue
+            total -= self._entries.pop(checksum)[0]
+            self._stats['evicted'] += 1
+            try:
+                os.remove(self._get_file(checksum))
+            except OSError as err:
+                LOG.warning(_LW("Failed to remove image %(checksum)s from "
+                                "the image cache: %(err)s"),
+                            {'checksum': checksum, 'err': err})
+                continue
+            LOG.info(_LI("Image %s evicted from the image cache"), checksum)
+
+    def get_stats(self):
+        """Return the cache size and hit counters, for the host stats."""
+        if not self.enabled():
+            return {'size_limit': 0}
+        self._load()
+        stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats.update({
+            'size_limit': self._get_limit(),
+            'size': sum(e[0] for e in self._entries.values()),
+            'images': len(self._entries),
+            'hit_rate': (round(float(stats['hits']) / lookups, 3)
+                         if lookups else 0.0)})
+        return stats
@@ -13,29 +13,300 @@
 #    under the License.
 
 
+import contextlib
 import datetime
+import eventlet
+import hashlib
+import heapq
 import os
 import re
 import shutil
+import six
 import tarfile
+import time
 import xml.dom.minidom as Dom
 
 from nova import exception as nova_exception
-from nova.i18n import _, _LW
+from nova.i18n import _, _LI, _LW
 from nova.image import glance
-from nova import utils
 from nova.virt import images
-from oslo_concurrency import processutils
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import excutils
 
 from nova_zvm.virt.zvm import exception
+from nova_zvm.virt.zvm import imagecache
 from nova_zvm.virt.zvm import utils as zvmutils
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 QUEUE_BUFFER_SIZE = 10
+_LAST_USE_DATE_PREFIX = 'auto:last_use_date:'
+# Content checksum of an imported image, in the osimage description
+_CHECKSUM_PREFIX = 'auto:md5:'
+# The xCAT image header, like 'xCAT CKD Disk Image:        3338 CYL HLen: ...'
+IMAGE_HEADER_SIZE = 48
+_HEADER_UNITS = {b'CKD': 'CYL', b'FBA': 'BLK'}
+# Concurrent glance requests looking up image sizes
+_SIZE_LOOKUP_CONCURRENCY = 8
+
+
+def parse_image_header(header, image):
+    """Return the root_disk_units of an xCAT image from its header.
+
+    :param header: the first IMAGE_HEADER_SIZE bytes of the image file
+    :param image: the image file or id, for error messages
+    """
+    disk_type = header[5:8]
+    if not header.startswith(b'xCAT ') or disk_type not in _HEADER_UNITS:
+        msg = (_("The image's disk type is not valid. Currently we only"
+                  " support FBA and CKD disk"))
+        raise exception.ZVMImageError(msg=msg)
+
+    try:
+        root_disk_size = int(header[20:32])
+    except ValueError:
+        root_disk_size = 0
+    disk_units = header[33:36].decode('ascii', 'replace')
+    if root_disk_size <= 0 or disk_units != _HEADER_UNITS[disk_type]:
+        msg = (_("Image file at %s is missing built-in disk size "
+                "metadata, it was probably not captured with xCAT")
+                % image)
+        raise exception.ZVMImageError(msg=msg)
+
+    root_disk_units = ':'.join([str(root_disk_size), disk_units])
+    LOG.debug("The image's root_disk_units is %s", root_disk_units)
+    return root_disk_units
+
+
+class _ChunkReader(object):
+    """File like object reading the chunks of an image download.
+
+    The md5 checksum of the data is computed while it is read, and the
+    data is copied to sink if given.
+    """
+
+    def __init__(self, chunks, sink=None):
+        self._chunks = iter(chunks)
+        self._buf = b''
+        self._sink = sink
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += next(self._chunks)
+            except StopIteration:
+                break
+
+        if size < 0:
+            data, self._buf = self._buf, b''
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        self.md5.update(data)
+        if self._sink is not None:
+            self._sink.write(data)
+        return data
+
+
+class OSImage(object):
+    """An xCAT osimage, as listed by lsdef."""
+
+    def __init__(self, name, profile='', isdeletable='', osarch='',
+                 provmethod='', description=''):
+        self.name = name
+        self.profile = profile
+        # Glance image id, with '_' instead of '-' as in the profile
+        self.uuid = profile.partition('_')[2]
+        self.isdeletable = isdeletable
+        self.osarch = osarch
+        self.provmethod = provmethod
+        self.description = description
+        # Size of the glance image in GB, looked up when needed
+        self.size = None
+
+    @property
+    def last_use_date(self):
+        """The last use date string of a deletable image, or None."""
+        if self.isdeletable.startswith(_LAST_USE_DATE_PREFIX):
+            return self.isdeletable[len(_LAST_USE_DATE_PREFIX):]
+
+    @property
+    def checksum(self):
+        """The checksum of the glance image content, or None."""
+        if self.description.startswith(_CHECKSUM_PREFIX):
+            return self.description[len(_CHECKSUM_PREFIX):]
+
+
+class ImageCatalog(object):
+    """In-process catalog of the xCAT osimages, indexed for lookups.
+
+    The catalog is built from one lsdef of all osimages and indexed by
+    image uuid and profile, so that finding the image of a spawn does not
+    make xCAT match the profile of every osimage. The images the driver
+    imports, captures, uses and deletes are updated in place. The catalog
+    is listed again after zvm_image_catalog_refresh_interval to pick up
+    changes made by others, and an image which is not found in it is
+    looked up in xCAT before it is reported missing. An image found in it
+    is confirmed by name before its import is skipped, since another
+    compute node of the xCAT MN may have deleted it meanwhile.
+
+    The images imported by the driver are also indexed by the checksum of
+    their content. A glance image with the same content as one of them,
+    a copy in another project for example, is an alias of it and deploys
+    it rather than being imported again.
+    """
+
+    LSDEF_FIELDS = ('profile', 'isdeletable', 'osarch', 'provmethod',
+                    'description')
+
+    def __init__(self):
+        self._xcat_url = zvmutils.get_xcat_url()
+        # name -> OSImage
+        self._images = {}
+        self._by_uuid = {}
+        self._by_profile = {}
+        self._by_checksum = {}
+        # image uuid -> OSImage with the same content
+        self._aliases = {}
+        self._loaded = None
+
+    def _lsdef(self, criteria=''):
+        """Return the OSImages listed by lsdef with criteria."""
+        fields = ''.join('&field=' + f for f in self.LSDEF_FIELDS)
+        url = self._xcat_url.lsdef_image(addp=criteria + fields)
+        with zvmutils.except_xcat_call_failed_and_reraise(
+                exception.ZVMImageError):
+            res = zvmutils.xcat_request("GET", url)
+
+            attrs = {}
+            name = None
+            with zvmutils.expect_invalid_xcat_resp_data(res):
+                for info in res['info']:
+                    for line in info:
+                        line = line.strip()
+                        if line.startswith('Object name:'):
+                            name = line.partition(':')[2].strip()
+                            attrs[name] = {}
+                            continue
+                        key, sep, value = line.partition('=')
+                        if name and sep and key in self.LSDEF_FIELDS:
+                            attrs[name][key] = value
+
+        return [OSImage(n, **kwargs) for (n, kwargs) in attrs.items()]
+
+    def reload(self):
+        """List all osimages from xCAT again."""
+        images = self._lsdef()
+        old_images = self._images
+        self._images = {}
+        self._by_uuid = {}
+        self._by_profile = {}
+        self._by_checksum = {}
+        old_aliases, self._aliases = self._aliases, {}
+        for image in images:
+            self._add(image, old_images.get(image.name))
+        for (uuid, image) in old_aliases.items():
+            if image.name in self._images and uuid not in self._by_uuid:
+                self._aliases[uuid] = self._images[image.name]
+        self._loaded = time.time()
+        LOG.debug("Loaded %d osimages from xCAT", len(images))
+
+    def _ensure_loaded(self):
+        ttl = CONF.zvm_image_catalog_refresh_interval
+        if (self._loaded is None or
+                (ttl and time.time() - self._loaded > ttl)):
+            self.reload()
+
+    def _add(self, image, old_image=None):
+        old_image = old_image or self._images.get(image.name)
+        if old_image is not None and old_image.profile == image.profile:
+            # Keep the size looked up before
+            image.size = old_image.size
+        self.remove(image.name)
+        self._images[image.name] = image
+        if image.uuid:
+            self._by_uuid[image.uuid] = image
+        if image.profile:
+            self._by_profile[image.profile] = image
+        if image.checksum:
+            self._by_checksum[image.checksum] = image
+
+    def add(self, name, profile):
+        """Add an image the driver created."""
+        self._add(OSImage(name, profile=profile))
+
+    def remove(self, name):
+        """Remove an image the driver deleted."""
+        image = self._images.pop(name, None)
+        if image is None:
+            return
+        if self._by_uuid.get(image.uuid) is image:
+            del self._by_uuid[image.uuid]
+        if self._by_profile.get(image.profile) is image:
+            del self._by_profile[image.profile]
+        if self._by_checksum.get(image.checksum) is image:
+            del self._by_checksum[image.checksum]
+        for (uuid, alias) in list(self._aliases.items()):
+            if alias is image:
+                del self._aliases[uuid]
+
+    def confirm(self, image):
+        """Whether image is still in xCAT, it is removed if it is not."""
+        url = self._xcat_url.lsdef_image('/' + image.name,
+                                         addp='&field=profile')
+        with zvmutils.except_xcat_call_failed_and_reraise(
+                exception.ZVMImageError):
+            try:
+                zvmutils.xcat_request("GET", url)
+            except exception.ZVMXCATInternalError as err:
+                if "Could not find an object" not in err.format_message():
+                    raise
+                LOG.info(_LI("Osimage %s was deleted from xCAT"), image.name)
+                self.remove(image.name)
+                return False
+        return True
+
+    def load_profile(self, profile):
+        """Look up the images of profile in xCAT and add them."""
+        images = self._lsdef('&criteria=profile=~' + profile)
+        for image in images:
+            self._add(image)
+        return images
+
+    def find(self, image_id, checksum=None):
+        """Return the OSImage of a glance image id or profile, or None.
+
+        With the checksum of the glance image, an image with the same
+        content is returned when there is none of the image id.
+        """
+        self._ensure_loaded()
+        key = image_id.replace('-', '_')
+        image = (self._by_uuid.get(key) or self._by_profile.get(key) or
+                 self._aliases.get(key))
+        if image is None and checksum in self._by_checksum:
+            image = self._by_checksum[checksum]
+            LOG.info(_LI("Image %(id)s has the same content as osimage "
+                         "%(name)s, which is deployed for it"),
+                     {'id': image_id, 'name': image.name})
+            self._aliases[key] = image
+        if image is None:
+            # Imported by someone else since the catalog was listed
+            images = [i for i in self.load_profile(key) if key in i.profile]
+            image = images[0] if images else None
+        return image
+
+    def get(self, name):
+        return self._images.get(name)
+
+    def set_last_use_date(self, name, last_use_date):
+        image = self._images.get(name)
+        if image is not None:
+            image.isdeletable = _LAST_USE_DATE_PREFIX + last_use_date
+
+    def list(self):
+        self._ensure_loaded()
+        return list(self._images.values())
 
 
 class ZVMImages(object):
@@ -43,6 +314,13 @@ class ZVMImages(object):
     def __init__(self):
         self._xcat_url = zvmutils.get_xcat_url()
         self._pathutils = zvmutils.PathUtils()
+        self.image_cache = imagecache.ImageCache()
+        self.catalog = ImageCatalog()
+        # image checksum -> root_disk_units read from the image header
+        self._root_disk_units = {}
+        # image name -> last use date not written to xCAT yet
+        self._pending_last_use = {}
+        self._last_use_writer = None
 
     def create_zvm_image(self, instance, image_name, image_href):
         """Create z/VM image from z/VM instance by invoking xCAT REST API
@@ -69,6 +347,7 @@ class ZVMImages(object):
             res = zvmutils.xcat_request("POST", url, body)
 
         os_image = self._get_os_image(res)
+        self.catalog.add(os_image, profile)
 
         return os_image
 
@@ -178,6 +457,9 @@ class ZVMImages(object):
     def delete_image_from_xcat(self, image_name_xcat):
         self._delete_image_file_from_xcat(image_name_xcat)
         self._delete_image_object_from_xcat(image_name_xcat)
+        self.catalog.remove(image_name_xcat)
+        # A table update would define the image again
+        self._pending_last_use.pop(image_name_xcat, None)
 
     def _getxmlnode(self, node, name):
         return node.getElementsByTagName(name)[0] if node else []
@@ -221,12 +503,22 @@ class ZVMImages(object):
         return manifest
 
     def untar_image_bundle(self, snapshot_time_path, image_bundle):
-        """Untar the image bundle *.tgz from xCAT and remove the *.tgz."""
+        """Untar the image bundle *.tgz from xCAT and remove the *.tgz.
+
+        The files are extracted as sparse files.
+        """
         if os.path.exists(image_bundle):
             LOG.debug("Untarring the image bundle ... ")
             tarobj = tarfile.open(image_bundle, "r:gz")
             for tarinfo in tarobj:
-                tarobj.extract(tarinfo.name, path=snapshot_time_path)
+                if not tarinfo.isfile():
+                    tarobj.extract(tarinfo.name, path=snapshot_time_path)
+                    continue
+                file_path = os.path.join(snapshot_time_path, tarinfo.name)
+                if not os.path.isdir(os.path.dirname(file_path)):
+                    os.makedirs(os.path.dirname(file_path))
+                imagecache.copy_sparse(tarobj.extractfile(tarinfo),
+                                       file_path)
             tarobj.close()
             os.remove(image_bundle)
         else:
@@ -245,28 +537,32 @@ class ZVMImages(object):
             msg = _("Image path %s not exist") % image_package_path
         raise exception.ZVMImageError(msg=msg)
 
-    def image_exist_xcat(self, image_id):
+    def image_exist_xcat(self, image_id, checksum=None):
         """To see if the specific image exist in xCAT MN's image
         repository.
+
+        An image with the same content checksum counts as the image.
         """
         LOG.debug("Checking if the image %s exists or not in xCAT "
                     "MN's image repository ", image_id)
-        image_uuid = image_id.replace('-', '_')
-        parm = '&criteria=profile=~' + image_uuid
-        url = self._xcat_url.lsdef_image(addp=parm)
-
-        with zvmutils.except_xcat_call_failed_and_reraise(
-                exception.ZVMImageError):
-            res = zvmutils.xcat_request("GET", url)
-
-        res_image = res['info']
-
-        if '_' in str(res_image):
-            return True
-        else:
-            return False
+        image = self.catalog.find(image_id, checksum)
+        while image is not None and not self.catalog.confirm(image):
+            # Look for another copy of the content, or the image imported
+            # again by someone else
+            image = self.catalog.find(image_id, checksum)
+        return image is not None
+
+    def fetch_image(self, context, image_id, target, user, project,
+                    checksum=None):
+        """Download an image to target.
+
+        The image is taken from the image cache if it is there, and added
+        to it otherwise.
+        """
+        if self.image_cache.fetch(checksum, target):
+            LOG.debug("Image %s copied from the image cache", image_id)
+            return
 
-    def fetch_image(self, context, image_id, target, user, project):
         LOG.debug("Downloading image %s from glance image server",
                   image_id)
         try:
@@ -277,11 +573,24 @@ class ZVMImages(object):
                     " %(err)s") % {'id': image_id, 'err': emsg}
             raise exception.ZVMImageError(msg=msg)
 
+        try:
+            self.image_cache.add(checksum, target)
+        except (IOError, OSError) as err:
+            LOG.warning(_LW("Failed to add image %(id)s to the image cache: "
+                            "%(err)s"), {'id': image_id, 'err': err})
+
     def generate_manifest_file(self, image_meta, image_name, disk_file,
                                manifest_path):
         """Generate the manifest.xml file from glance's image metadata
         as a part of the image bundle.
         """
+        manifest_file = manifest_path + '/manifest.xml'
+        with open(manifest_file, 'w') as f:
+            f.write(self.get_manifest_xml(image_meta, image_name, disk_file))
+        return manifest_file
+
+    def get_manifest_xml(self, image_meta, image_name, disk_file):
+        """Return the content of the manifest.xml of an image bundle."""
         image_id = image_meta['id']
         image_type = image_meta['properties']['image_type_xcat']
         os_version = image_meta['properties']['os_version']
@@ -328,6 +637,8 @@ class ZVMImages(object):
 
         if 'image_comments' in image_meta['properties']:
             manifest['comments'] = image_meta['properties']['image_comments']
+        if image_meta.get('checksum'):
+            manifest['description'] = _CHECKSUM_PREFIX + image_meta['checksum']
 
         for item in list(manifest.keys()):
             itemkey = doc.createElement(item)
@@ -335,9 +646,6 @@ class ZVMImages(object):
             itemkey.appendChild(itemvalue)
             osimage.appendChild(itemkey)
             xcatimage.appendChild(osimage)
-            f = open(manifest_path + '/manifest.xml', 'w')
-            f.write(doc.toprettyxml(indent=''))
-            f.close()
 
         # Add the rawimagefiles section
         rawimagefiles = doc.createElement('rawimagefiles')
@@ -349,26 +657,11 @@ class ZVMImages(object):
 
         rawimagefiles.appendChild(files)
 
-        f = open(manifest_path + '/manifest.xml', 'w')
-        f.write(doc.toprettyxml(indent='  '))
-        f.close()
-
-        self._rewr(manifest_path)
-
-        return manifest_path + '/manifest.xml'
-
-    def _rewr(self, manifest_path):
-        f = open(manifest_path + '/manifest.xml', 'r')
-        lines = f.read()
-        f.close()
-
+        lines = doc.toprettyxml(indent='  ')
         lines = lines.replace('\n', '')
         lines = re.sub(r'>(\s*)<', r'>\n\1<', lines)
         lines = re.sub(r'>[ \t]*(\S+)[ \t]*<', r'>\1<', lines)
-
-        f = open(manifest_path + '/manifest.xml', 'w')
-        f.write(lines)
-        f.close()
+        return lines
 
     def generate_image_bundle(self, spawn_path, tmp_file_fn, image_name):
         """Generate the image bundle which is used to import to xCAT MN's
@@ -379,11 +672,12 @@ class ZVMImages(object):
         LOG.debug("The generate the image bundle file is %s", tar_file)
 
         os.chdir(spawn_path)
-        tarFile = tarfile.open(tar_file, mode='w')
 
         try:
-            tarFile.add(tmp_file_fn)
-            tarFile.close()
+            with imagecache.SparseFile(tar_file) as bundle:
+                tarFile = tarfile.open(fileobj=bundle, mode='w')
+                tarFile.add(tmp_file_fn)
+                tarFile.close()
         except Exception as err:
             msg = (_("Generate image bundle failed: %s") % err)
             LOG.error(msg)
@@ -395,6 +689,108 @@ class ZVMImages(object):
 
         return tar_file
 
+    def stream_image_bundle(self, context, image_meta, image_name, disk_file,
+                            spawn_path, tmp_file_fn):
+        """Generate the image bundle while the image is downloaded.
+
+        The tar stream of the bundle is written directly from the glance
+        download, so the image file is not written to disk on its own
+        first, and its checksum is verified in the same pass.
+
+        :returns: path of the image bundle.
+        """
+        tar_file = '%s/%s_%s.tar' % (spawn_path, tmp_file_fn, image_name)
+        LOG.debug("Streaming image %(id)s to the image bundle %(file)s",
+                  {'id': image_meta['id'], 'file': tar_file})
+        manifest = self.get_manifest_xml(image_meta, image_name, disk_file)
+        if isinstance(manifest, six.text_type):
+            manifest = manifest.encode('utf-8')
+        now = int(time.time())
+
+        def _tarinfo(name, size=0, is_dir=False):
+            info = tarfile.TarInfo('/'.join([tmp_file_fn] + name))
+            info.mtime = now
+            if is_dir:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+            else:
+                info.size = size
+                info.mode = 0o644
+            return info
+
+        checksum = image_meta.get('checksum')
+        cached_file = self.image_cache.lookup(checksum)
+        part_file = None
+        if cached_file is None:
+            part_file = self.image_cache.get_part_file(checksum,
+                                                       image_meta['size'])
+        try:
+            with imagecache.SparseFile(tar_file) as bundle, contextlib.closing(
+                    tarfile.open(fileobj=bundle, mode='w')) as tar:
+                tar.addfile(_tarinfo([], is_dir=True))
+                tar.addfile(_tarinfo(['manifest.xml'], len(manifest)),
+                            six.BytesIO(manifest))
+                with self._image_reader(context, image_meta, cached_file,
+                                        part_file) as reader:
+                    tar.addfile(_tarinfo([disk_file], image_meta['size']),
+                                reader)
+                    if reader.read(1):
+                        msg = _("image is larger than its size %s") % (
+                                                        image_meta['size'])
+                        raise exception.ZVMImageError(msg=msg)
+
+            if checksum and reader.md5.hexdigest() != checksum:
+                msg = (_("checksum %(md5)s does not match %(checksum)s") %
+                       {'md5': reader.md5.hexdigest(), 'checksum': checksum})
+                if cached_file is not None:
+                    self.image_cache.remove(checksum)
+                raise exception.ZVMImageError(msg=msg)
+        except Exception as err:
+            if os.path.isfile(tar_file):
+                os.remove(tar_file)
+            self.image_cache.discard(part_file)
+            emsg = zvmutils.format_exception_msg(err)
+            msg = (_("Generate image bundle of image %(id)s failed: "
+                     "%(err)s") % {'id': image_meta['id'], 'err': emsg})
+            LOG.error(msg)
+            raise exception.ZVMImageError(msg=msg)
+
+        if part_file is not None:
+            # The bundle is fine, failing to cache the image must not fail
+            # the spawn
+            try:
+                self.image_cache.add(checksum, part_file)
+            except (IOError, OSError) as err:
+                LOG.warning(_LW("Failed to add image %(id)s to the image "
+                                "cache: %(err)s"),
+                            {'id': image_meta['id'], 'err': err})
+                self.image_cache.discard(part_file)
+
+        return tar_file
+
+    @contextlib.contextmanager
+    def _image_reader(self, context, image_meta, cached_file, part_file):
+        """Yield a reader of the image, from the image cache or glance.
+
+        An image read from glance is copied to part_file if given.
+        """
+        if cached_file is not None:
+            LOG.debug("Reading image %s from the image cache",
+                      image_meta['id'])
+            with open(cached_file, 'rb') as f:
+                yield _ChunkReader(iter(lambda: f.read(imagecache.CHUNK_SIZE),
+                                        b''))
+            return
+
+        (image_service, image_id) = glance.get_remote_image_service(
+                                                context, image_meta['id'])
+        chunks = image_service.download(context, image_id)
+        if part_file is None:
+            yield _ChunkReader(chunks)
+        else:
+            with imagecache.SparseFile(part_file) as sink:
+                yield _ChunkReader(chunks, sink)
+
     def check_space_imgimport_xcat(self, context, instance, tar_file,
                                    xcat_free_space_threshold, zvm_xcat_master):
         image_href = instance['image_ref']
@@ -437,79 +833,76 @@ class ZVMImages(object):
         finally:
             os.remove(image_bundle_package)
 
-    def get_imgname_xcat(self, image_id):
+        try:
+            self.catalog.load_profile(image_profile)
+        except exception.ZVMImageError as err:
+            # Looked up again when the image is used
+            LOG.warning(_LW("Failed to look up the imported image %(img)s: "
+                            "%(err)s"), {'img': image_profile,
+                                         'err': err.format_message()})
+
+    def get_imgname_xcat(self, image_id, checksum=None):
         """Get the xCAT deployable image name by image id."""
-        image_uuid = image_id.replace('-', '_')
-        parm = '&criteria=profile=~' + image_uuid
-        url = self._xcat_url.lsdef_image(addp=parm)
-
-        with zvmutils.except_xcat_call_failed_and_reraise(
-                exception.ZVMImageError):
-            res = zvmutils.xcat_request("GET", url)
-            with zvmutils.expect_invalid_xcat_resp_data(res):
-                res_image = res['info'][0][0]
-                res_img_name = res_image.strip().split(" ")[0]
-
-        if res_img_name:
-            return res_img_name
-        else:
-            LOG.error(_("Fail to find the right image to deploy"))
+        image = self.catalog.find(image_id, checksum)
+        if image is None:
+            msg = _("Fail to find the right image to deploy")
+            LOG.error(msg)
+            raise exception.ZVMImageError(msg=msg)
+        return image.name
 
     def _get_image_list_xcat(self):
-        """Get an image list from xcat osimage table.
+        """Get an image list from the osimage catalog.
 
         criteria: osarch=s390x and provmethod=netboot|raw|sysclone and
         isdeletable field
 
         """
-        display_field = '&field=isdeletable'
-        isdeletable_criteria = '&criteria=isdeletable=~^auto:last_use_date:'
-        osarch_criteria = '&criteria=osarch=s390x'
-        provmethod_criteria = '&criteria=provmethod=~netboot|raw|sysclone'
-
-        addp = ''.join([isdeletable_criteria, osarch_criteria,
-                       provmethod_criteria, display_field])
-        url = self._xcat_url.lsdef_image(addp=addp)
-
-        with zvmutils.except_xcat_call_failed_and_reraise(
-                exception.ZVMImageError):
-            output = zvmutils.xcat_request("GET", url)
-
         image_list = []
-        if len(output['info']) <= 0:
-            return image_list
-
-        if len(output['info'][0]) > 0:
-            i = 0
-            while i < len(output['info'][0]):
-                if "Object name:" in output['info'][0][i]:
-                    sub_list = []
-                    len_objectname = len("Object name: ")
-                    is_deletable = output['info'][0][i + 1]
-                    last_use_date = self._validate_last_use_date(
-                                        output['info'][0][i][len_objectname:],
-                                        is_deletable)
-                    if last_use_date is None:
-                        i += 2
-                        continue
-                    sub_list.append(output['info'][0][i][len_objectname:])
-                    sub_list.append(last_use_date)
-                    image_list.append(sub_list)
-                i += 2
+        for image in self.catalog.list():
+            if (image.last_use_date is None or image.osarch != 's390x' or
+                    not re.search('netboot|raw|sysclone', image.provmethod)):
+                continue
+            is_deletable = image.isdeletable
+            if image.name in self._pending_last_use:
+                # Used since the date stored in xCAT
+                is_deletable = (_LAST_USE_DATE_PREFIX +
+                                self._pending_last_use[image.name])
+            last_use_date = self._validate_last_use_date(image.name,
+                                                         is_deletable)
+            if last_use_date is not None:
+                image_list.append([image.name, last_use_date])
 
         return image_list
 
     def update_last_use_date(self, image_name_xcat):
         """Update the last_use_date in xCAT osimage table after a
         successful deploy.
-        """
-        LOG.debug("Update the last_use_date in xCAT osimage table "
-                    "after a successful deploy")
 
+        With zvm_image_last_use_flush_interval set, the date is written by
+        flush_last_use_dates() later. Nothing is written when the image was
+        already used today.
+        """
         today_date = datetime.date.today()
         last_use_date_string = today_date.strftime("%Y-%m-%d")
+        image = self.catalog.get(image_name_xcat)
+        if (self._pending_last_use.get(image_name_xcat) ==
+                last_use_date_string or
+                (image is not None and
+                 image.last_use_date == last_use_date_string)):
+            return last_use_date_string
+
+        if CONF.zvm_image_last_use_flush_interval:
+            self._pending_last_use[image_name_xcat] = last_use_date_string
+        else:
+            self._write_last_use_date(image_name_xcat, last_use_date_string)
+        return last_use_date_string
+
+    def _write_last_use_date(self, image_name_xcat, last_use_date_string):
+        LOG.debug("Update the last_use_date of %(img)s in xCAT osimage table "
+                  "to %(date)s", {'img': image_name_xcat,
+                                  'date': last_use_date_string})
         url = self._xcat_url.tabch('/osimage')
-        is_deletable = "auto:last_use_date:" + last_use_date_string
+        is_deletable = _LAST_USE_DATE_PREFIX + last_use_date_string
         body = ["imagename=" + image_name_xcat,
                 "osimage.isdeletable=" + is_deletable]
 
@@ -520,8 +913,39 @@ class ZVMImages(object):
                 exception.ZVMXCATInternalError) as err:
             LOG.warning(_LW("Illegal date for last_use_date %s"),
                      err.format_message())
+            return False
 
-        return last_use_date_string
+        self.catalog.set_last_use_date(image_name_xcat, last_use_date_string)
+        return True
+
+    def flush_last_use_dates(self):
+        """Write the buffered last use dates to xCAT.
+
+        Dates which failed to be written are kept for the next flush.
+        """
+        pending, self._pending_last_use = self._pending_last_use, {}
+        for (image_name_xcat, last_use_date) in pending.items():
+            image = self.catalog.get(image_name_xcat)
+            if image is not None and image.last_use_date == last_use_date:
+                continue
+            if not self._write_last_use_date(image_name_xcat, last_use_date):
+                self._pending_last_use.setdefault(image_name_xcat,
+                                                  last_use_date)
+
+    def start_last_use_writer(self):
+        """Flush the buffered last use dates in the background."""
+        if (CONF.zvm_image_last_use_flush_interval and
+                self._last_use_writer is None):
+            self._last_use_writer = eventlet.spawn(self._flush_loop)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(CONF.zvm_image_last_use_flush_interval)
+            try:
+                self.flush_last_use_dates()
+            except Exception as err:
+                LOG.warning(_LW("Failed to write the image last use dates: "
+                                "%s"), zvmutils.format_exception_msg(err))
 
     def _validate_last_use_date(self, image_name, is_deletable):
         """Validate the isdeletable date format."""
@@ -558,23 +982,38 @@ class ZVMImages(object):
         else:
             return False
 
-    def clean_image_cache_xcat(self, clean_period):
-        """Clean the old image."""
-        image_list = self._get_image_list_xcat()
-        if len(image_list) <= 0:
+    def delete_images_from_xcat(self, image_names):
+        """Delete images from xCAT, zvm_image_clean_concurrency at a time."""
+        pool = eventlet.GreenPool(CONF.zvm_image_clean_concurrency)
+        for name in image_names:
+            LOG.debug('Delete the image %s', name)
+            pool.spawn_n(self.delete_image_from_xcat, name)
+        pool.waitall()
+
+    def clean_image_cache_xcat(self, clean_period, context=None):
+        """Clean the old image.
+
+        The images not used for clean_period days are deleted. Then, if
+        xcat_image_free_space_goal is set and the xCAT MN has less free
+        space, the least recently used images are deleted until it is met.
+        """
+        # Reconcile the catalog with xCAT
+        self.catalog.reload()
+        expired = [name for (name, last_use_date)
+                   in self._get_image_list_xcat()
+                   if self._verify_is_deletable_periodic(last_use_date,
+                                                         clean_period)]
+        self.delete_images_from_xcat(expired)
+
+        goal = CONF.xcat_image_free_space_goal
+        if not goal or context is None:
             return
-        else:
-            i = 0
-            while i < len(image_list):
-                image_name_xcat = image_list[i][0]
-                last_use_date = image_list[i][1]
-                if self._verify_is_deletable_periodic(last_use_date,
-                                                   clean_period):
-                    LOG.debug('Delete the image %s', image_name_xcat)
-                    self.delete_image_from_xcat(image_name_xcat)
-                else:
-                    LOG.debug("Keep the image")
-                i += 1
+        free_space = self.get_free_space_xcat(CONF.xcat_free_space_threshold,
+                                              CONF.zvm_xcat_master)
+        if free_space < goal:
+            LOG.info(_LI("xCAT MN free space %(free).1f G is below the goal "
+                         "%(goal)d G"), {'free': free_space, 'goal': goal})
+            self.prune_image_xcat(context, goal - free_space, 0)
 
     def _get_image_bundle_size(self, tar_file):
         size_byte = os.path.getsize(tar_file)
@@ -656,87 +1095,77 @@ class ZVMImages(object):
         image_size = self._get_image_size_glance(context, image_href)
         return image_bundle_size + image_size
 
-    def _get_image_href_by_osimage(self, image_name_xcat):
-        """If we have the xCAT.osimage.imagename, we want to get the
-        image_href.
+    def _get_image_sizes(self, context, images):
+        """Look up the glance sizes the catalog does not know yet.
+
+        The sizes are looked up concurrently and kept in the catalog.
         """
-        try:
-            image_profile = image_name_xcat.split("-")
-            if len(image_profile) >= 4:
-                return image_profile[3]
-            else:
-                return image_name_xcat
-        except (TypeError, IndexError):
-            LOG.error(_("xCAT imagename format for %s is not as expected"),
-                      image_name_xcat)
-
-    def _sort_image_by_use_date(self, image_list, left, right):
-        """Sort the image_list by last_use_date from oldest image to latest."""
-        if (left < right):
-            i = left
-            j = right
-            x = image_list[left]
-            while (i < j):
-                while (i < j and image_list[j][1] >= x[1]):
-                    j -= 1
-                if(i < j):
-                    image_list[i] = image_list[j]
-                    i += 1
-                while(i < j and image_list[i][1] < x[1]):
-                    i += 1
-                if(i < j):
-                    image_list[j] = image_list[i]
-                    j -= 1
-            image_list[i] = x
-            self._sort_image_by_use_date(image_list, left, i - 1)
-            self._sort_image_by_use_date(image_list, i + 1, right)
-
-    def _get_to_be_deleted_images_xcat(self, context, size_needed,
-                                      current_needed):
-        """To get a list of images which is to be removed from xCAT image
-        repository because it cannot provide enough space for image operations
-        from OpenStack.
+        missing = [image for image in images if image.size is None]
+        if not missing:
+            return
+
+        LOG.debug("Looking up the size of %d images in glance", len(missing))
+        pool = eventlet.GreenPool(_SIZE_LOOKUP_CONCURRENCY)
+        sizes = pool.imap(lambda image: self._get_image_size_glance(
+                                context, image.uuid.replace('_', '-')),
+                          missing)
+        for (image, size) in zip(missing, sizes):
+            image.size = size
+
+    def plan_image_eviction(self, context, size_needed):
+        """Plan which images to remove from xCAT to free size_needed GB.
+
+        The least recently used deletable images are taken until their
+        sizes add up to size_needed. Images unknown to glance are kept.
+
+        :returns: a tuple of the list of OSImages to delete, least recently
+                  used first, and the space in GB they free
         """
-        image_list = self._get_image_list_xcat()
+        candidates = []
+        for (name, last_use_date) in self._get_image_list_xcat():
+            image = self.catalog.get(name)
+            if image is not None:
+                candidates.append((last_use_date, name, image))
+        self._get_image_sizes(context, [c[2] for c in candidates])
+
+        heapq.heapify(candidates)
+        plan = []
         size_sum = 0
-        to_be_deleted_image_profile = []
-
-        if len(image_list) <= 0:
+        while candidates and size_sum < size_needed:
+            image = heapq.heappop(candidates)[2]
+            if image.size > 0:
+                plan.append(image)
+                size_sum += image.size
+        return plan, size_sum
+
+    def prune_image_xcat(self, context, size_needed, current_needed,
+                         dry_run=False):
+        """Remove the images which meet remove criteria from xCAT.
+
+        :param dry_run: only log the images which would be removed
+        :returns: the names of the images removed, or to be removed
+        """
+        LOG.debug("Clear up space by clean images in xCAT")
+        plan, size_sum = self.plan_image_eviction(context, size_needed)
+        if not plan:
             msg = _LW("No image to be deleted, please create space manually "
                     "on xcat(%s).") % CONF.zvm_xcat_server
             LOG.warning(msg)
-        else:
-            self._sort_image_by_use_date(image_list, 0, len(image_list) - 1)
-            for img in image_list:
-                image_name_xcat = img[0]
-                image_profile = self._get_image_href_by_osimage(
-                                    image_name_xcat)
-                image_uuid = image_profile.partition('_')[2].replace("_", "-")
-                image_size = self._get_image_size_glance(context,
-                                                         image_uuid)
-                if image_size > 0:
-                    to_be_deleted_image_profile.append(image_profile)
-                    size_sum += image_size
-                    if size_sum >= size_needed:
-                        return to_be_deleted_image_profile
-
-        if size_sum < current_needed:
+        elif size_sum < size_needed and size_sum < current_needed:
             msg = _LW("xCAT MN space not enough for current image operation: "
                     "%(n)d G needed,%(a)d G available") % {'n': current_needed,
                                                            'a': size_sum}
             LOG.warning(msg)
 
-        return to_be_deleted_image_profile
-
-    def prune_image_xcat(self, context, size_needed, current_needed):
-        """Remove the images which meet remove criteria from xCAT."""
-        LOG.debug("Clear up space by clean images in xCAT")
-        to_be_deleted_image_profile = self._get_to_be_deleted_images_xcat(
-            context, size_needed, current_needed)
-        if len(to_be_deleted_image_profile) > 0:
-            for image_profile in to_be_deleted_image_profile:
-                image_name_xcat = self.get_imgname_xcat(image_profile)
-                self.delete_image_from_xcat(image_name_xcat)
+        names = [image.name for image in plan]
+        if names:
+            LOG.info(_LI("%(action)s images %(names)s to free %(size).1f G "
+                         "in xCAT"),
+                     {'action': 'Would delete' if dry_run else 'Deleting',
+                      'names': names, 'size': size_sum})
+        if not dry_run:
+            self.delete_images_from_xcat(names)
+        return names
 
     def zimage_check(self, image_meta):
         """Do a brief check to see if the image is a valid zVM image."""
@@ -767,39 +1196,64 @@ class ZVMImages(object):
                 self.delete_image_from_xcat(img_name)
 
     def get_root_disk_units(self, image_file_path):
-        """use 'hexdump' to get the root_disk_units."""
+        """Read the root_disk_units from the header of an image file."""
         try:
-            (output, _toss) = utils.execute('hexdump', '-n', '48',
-                '-C', image_file_path)
-        except processutils.ProcessExecutionError:
+            with open(image_file_path, 'rb') as f:
+                header = f.read(IMAGE_HEADER_SIZE)
+        except IOError as err:
             msg = (_("Get image property failed,"
-                    " please check whether the image file exists!"))
+                    " please check whether the image file exists: %s") % err)
             raise exception.ZVMImageError(msg=msg)
 
-        LOG.debug("hexdump result is %s", output)
+        return parse_image_header(header, image_file_path)
+
+    def _get_root_disk_units_glance(self, context, image_meta):
+        """Read the root_disk_units from the first bytes of the download.
+
+        Only the first chunk of the image is downloaded.
+        """
+        (image_service, image_id) = glance.get_remote_image_service(
+                                                context, image_meta['id'])
         try:
-            root_disk_size = int(output[144:156])
-            disk_units = output[220:223]
-            root_disk_units = ':'.join([str(root_disk_size), disk_units])
-        except ValueError:
-            msg = (_("Image file at %s is missing built-in disk size "
-                    "metadata, it was probably not captured with xCAT")
-                    % image_file_path)
+            chunks = image_service.download(context, image_id)
+            try:
+                header = _ChunkReader(chunks).read(IMAGE_HEADER_SIZE)
+            finally:
+                if hasattr(chunks, 'close'):
+                    chunks.close()
+        except Exception as err:
+            emsg = zvmutils.format_exception_msg(err)
+            msg = _("Download image file of image %(id)s failed with reason:"
+                    " %(err)s") % {'id': image_meta['id'], 'err': emsg}
             raise exception.ZVMImageError(msg=msg)
 
-        if 'FBA' not in output and 'CKD' not in output:
-            msg = (_("The image's disk type is not valid. Currently we only"
-                      " support FBA and CKD disk"))
-            raise exception.ZVMImageError(msg=msg)
+        return parse_image_header(header, image_meta['id'])
 
-        LOG.debug("The image's root_disk_units is %s", root_disk_units)
-        return root_disk_units
+    def set_image_root_disk_units(self, context, image_meta,
+                                  image_file_path=None):
+        """Set the property 'root_disk_units'to image.
 
-    def set_image_root_disk_units(self, context, image_meta, image_file_path):
-        """Set the property 'root_disk_units'to image."""
-        new_image_meta = image_meta
-        root_disk_units = self.get_root_disk_units(image_file_path)
+        The root_disk_units is read from image_file_path if given, or else
+        from the beginning of the image download, and is kept per image
+        checksum, so that an image is inspected only once.
+        """
+        checksum = image_meta.get('checksum')
+        root_disk_units = self._root_disk_units.get(checksum)
+        if root_disk_units is not None:
+            LOG.debug("The image's root_disk_units %s is known",
+                      root_disk_units)
+            properties = dict(image_meta['properties'],
+                              root_disk_units=root_disk_units)
+            return dict(image_meta, properties=properties)
+
+        if image_file_path is not None:
+            root_disk_units = self.get_root_disk_units(image_file_path)
+        else:
+            root_disk_units = self._get_root_disk_units_glance(context,
+                                                               image_meta)
         LOG.debug("The image's root_disk_units is %s", root_disk_units)
+        if checksum:
+            self._root_disk_units[checksum] = root_disk_units
 
         (glance_image_service, image_id) = glance.get_remote_image_service(
                                                 context, image_meta['id'])
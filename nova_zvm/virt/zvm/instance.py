@@ -27,8 +27,10 @@ from oslo_log import log as logging
 from nova_zvm.virt.zvm import const
 from nova_zvm.virt.zvm import dist
 from nova_zvm.virt.zvm import exception
+from nova_zvm.virt.zvm import timing
 from nova_zvm.virt.zvm import utils as zvmutils
 from nova_zvm.virt.zvm import volumeop
+from nova_zvm.virt.zvm import waiter as zvmwaiter
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
@@ -73,6 +75,9 @@ class ZVMInstance(object):
         self._volumeop = volumeop.VolumeOperator()
         self._dist_manager = dist.ListDistManager()
         self._driver = driver
+        # Phases are only recorded when the caller sets a timer of an
+        # operation
+        self.timer = timing.PhaseTimer()
 
     def power_off(self, timeout=0, retry_interval=10):
         """Power off z/VM instance."""
@@ -90,34 +95,41 @@ class ZVMInstance(object):
                 LOG.error(msg)
                 raise nova_exception.InstancePowerOffFailure(reason=msg)
 
+        # retry_interval is kept for compatibility, the shared state waiter
+        # polls at zvm_state_poll_interval
         timeout = timeout or CONF.shutdown_timeout
-        retry_interval = retry_interval or 10
-        retry_count = timeout // retry_interval
-        while (retry_count > 0):
-            if self._check_power_stat() == power_state.SHUTDOWN:
-                # In shutdown state already
-                return
-            else:
-                time.sleep(retry_interval)
-                retry_count -= 1
+        if self._driver._state_waiter.wait(self._name, zvmwaiter.POWER_OFF,
+                                           timeout):
+            return
 
         LOG.warning(_LW("Failed to shutdown instance %(inst)s in %(time)d "
                      "seconds"), {'inst': self._name, 'time': timeout})
 
-    def power_on(self):
-        """"Power on z/VM instance."""
+    def power_on(self, booting=False):
+        """"Power on z/VM instance.
+
+        :param booting: True for the first power on of a new instance. It
+                        is then waited for to be reachable even if it is
+                        already active, since a failed batch or try of this
+                        power on may have activated it.
+        """
         try:
-            self._power_state("PUT", "on")
+            with self.timer.phase('power_on'):
+                # Combined with the power on of concurrent spawns
+                self._driver._power_on_batcher.submit(self._name)
         except exception.ZVMXCATInternalError as err:
             err_str = err.format_message()
             if ("Return Code: 200" in err_str and
                     "Reason Code: 8" in err_str):
                 # Instance already active
                 LOG.warning(_LW("z/VM instance %s already active"), self._name)
-                return
-            raise nova_exception.InstancePowerOnFailure(reason=err_str)
+                if not booting:
+                    return
+            else:
+                raise nova_exception.InstancePowerOnFailure(reason=err_str)
 
-        self._wait_for_reachable()
+        with self.timer.phase('reachable'):
+            self._wait_for_reachable()
         if not self._reachable:
             LOG.error(_("Failed to power on instance %s: timeout"), self._name)
             raise nova_exception.InstancePowerOnFailure(reason="timeout")
@@ -273,6 +285,11 @@ class ZVMInstance(object):
                 exception.ZVMXCATCreateNodeFailed, node=self._name):
             zvmutils.xcat_request("POST", url, body)
 
+        node_attrs = zvmutils.get_node_attr_cache()
+        node_attrs.remove(self._name)
+        node_attrs.update(self._name, {'zvm.userid': user_id,
+                                       'zvm.hcp': zhcp})
+
     def _create_user_id_body(self, boot_from_volume):
         kwprofile = 'profile=%s' % CONF.zvm_user_profile
         body = [kwprofile,
@@ -294,6 +311,48 @@ class ZVMInstance(object):
         if not zvmutils.xcat_support_mkvm_ipl_param(xcat_version):
             self._set_ipl(CONF.zvm_user_root_vdev)
 
+    def _get_mdisks(self, block_device_info, image_meta, boot_from_volume):
+        """Get the minidisks of the instance.
+
+        :returns: a list of (vdev, size) for the root disk, which is first,
+                  and (vdev, size, fmt) tuples for ephemeral disks.
+        """
+        mdisks = []
+        if not boot_from_volume:
+            size = '%ig' % self._instance['root_gb']
+            # If the flavor specifies 0 for the root disk size, use the
+            # size in the image's metadata
+            if size == '0g':
+                root_disk_units = image_meta['properties'][
+                                'root_disk_units']
+                size = root_disk_units.split(":")[0]
+            mdisks.append((CONF.zvm_user_root_vdev, size))
+
+        # Add additional ephemeral disk
+        if self._instance['ephemeral_gb'] != 0:
+            eph_disks = block_device_info.get('ephemerals', [])
+            if eph_disks == []:
+                # Create ephemeral disk according to flavor
+                fmt = (CONF.default_ephemeral_format or
+                       const.DEFAULT_EPH_DISK_FMT)
+                mdisks.append((CONF.zvm_user_adde_vdev,
+                               '%ig' % self._instance['ephemeral_gb'], fmt))
+            else:
+                # Create ephemeral disks according --ephemeral option
+                for idx, eph in enumerate(eph_disks):
+                    vdev = (eph.get('vdev') or
+                            zvmutils.generate_eph_vdev(idx))
+                    size = eph['size']
+                    size_in_units = eph.get('size_in_units', False)
+                    if not size_in_units:
+                        size = '%ig' % size
+                    fmt = (eph.get('guest_format') or
+                           CONF.default_ephemeral_format or
+                           const.DEFAULT_EPH_DISK_FMT)
+                    mdisks.append((vdev, size, fmt))
+
+        return mdisks
+
     def create_userid(self, block_device_info, image_meta, context,
                       os_image=None):
         """Create z/VM userid into user directory for a z/VM instance."""
@@ -302,8 +361,6 @@ class ZVMInstance(object):
 
         boot_from_volume = zvmutils.is_boot_from_volume(block_device_info)[1]
 
-        eph_disks = block_device_info.get('ephemerals', [])
-
         body = self._create_user_id_body(boot_from_volume)
 
         if not boot_from_volume:
@@ -330,46 +387,16 @@ class ZVMInstance(object):
         # Note: driver.py:spawn() has already checked that the root disk units
         # and the type of disks in the pool are compatible.
         try:
-            zvmutils.xcat_request("POST", url, body)
+            mdisks = self._get_mdisks(block_device_info, image_meta,
+                                      boot_from_volume)
+            with self.timer.phase('mkvm'):
+                zvmutils.xcat_request("POST", url, body)
 
-            if not boot_from_volume:
-                size = '%ig' % self._instance['root_gb']
-                # If the flavor specifies 0 for the root disk size, use the
-                # size in the image's metadata
-                if size == '0g':
-                    root_disk_units = image_meta['properties'][
-                                    'root_disk_units']
-                    size = root_disk_units.split(":")[0]
-
-                # Add root disk and set ipl
-                self.add_mdisk(CONF.zvm_diskpool,
-                               CONF.zvm_user_root_vdev,
-                               size)
-                self._check_set_ipl()
-
-            # Add additional ephemeral disk
-            if self._instance['ephemeral_gb'] != 0:
-                if eph_disks == []:
-                    # Create ephemeral disk according to flavor
-                    fmt = (CONF.default_ephemeral_format or
-                           const.DEFAULT_EPH_DISK_FMT)
-                    self.add_mdisk(CONF.zvm_diskpool,
-                                   CONF.zvm_user_adde_vdev,
-                                   '%ig' % self._instance['ephemeral_gb'],
-                                   fmt)
-                else:
-                    # Create ephemeral disks according --ephemeral option
-                    for idx, eph in enumerate(eph_disks):
-                        vdev = (eph.get('vdev') or
-                                zvmutils.generate_eph_vdev(idx))
-                        size = eph['size']
-                        size_in_units = eph.get('size_in_units', False)
-                        if not size_in_units:
-                            size = '%ig' % size
-                        fmt = (eph.get('guest_format') or
-                               CONF.default_ephemeral_format or
-                               const.DEFAULT_EPH_DISK_FMT)
-                        self.add_mdisk(CONF.zvm_diskpool, vdev, size, fmt)
+            for mdisk in mdisks:
+                self.add_mdisk(CONF.zvm_diskpool, *mdisk)
+                if not boot_from_volume and mdisk is mdisks[0]:
+                    # Set ipl after the root disk is added
+                    self._check_set_ipl()
         except (exception.ZVMXCATRequestFailed,
                 exception.ZVMInvalidXCATResponseDataError,
                 exception.ZVMXCATInternalError,
@@ -496,6 +523,7 @@ class ZVMInstance(object):
     def _delete_userid(self, url):
         try:
             zvmutils.xcat_request("DELETE", url)
+            zvmutils.get_node_attr_cache().remove(self._name)
         except exception.ZVMXCATInternalError as err:
             emsg = err.format_message()
             LOG.debug("error emsg in delete_userid: %s", emsg)
@@ -545,6 +573,7 @@ class ZVMInstance(object):
     def delete_xcat_node(self):
         """Remove xCAT node for z/VM instance."""
         url = self._xcat_url.rmdef('/' + self._name)
+        zvmutils.get_node_attr_cache().remove(self._name)
         try:
             zvmutils.xcat_request("DELETE", url)
         except exception.ZVMXCATInternalError as err:
@@ -577,7 +606,8 @@ class ZVMInstance(object):
         else:
             body = [" ".join([action, diskpool, vdev, size])]
         url = self._xcat_url.chvm('/' + self._name)
-        zvmutils.xcat_request("PUT", url, body)
+        with self.timer.phase('mdisk'):
+            zvmutils.xcat_request("PUT", url, body)
 
     def _power_state(self, method, state):
         """Invoke xCAT REST API to set/get power state for a instance."""
@@ -722,19 +752,26 @@ class ZVMInstance(object):
                     return True
         return False
 
-    def _wait_for_reachable(self):
-        """Called at an interval until the instance is reachable."""
-        self._reachable = False
+    def _get_boot_key(self):
+        """Get the (image, distro) key of the boot time history."""
+        sys_meta = self._instance['system_metadata'] or {}
+        return (self._instance['image_ref'],
+                sys_meta.get('image_os_version'))
 
-        def _check_reachable():
-            if not self.is_reachable():
-                raise exception.ZVMRetryException()
-            else:
-                self._reachable = True
+    def _wait_for_reachable(self):
+        """Wait until the instance is reachable or timeout.
 
-        zvmutils.looping_call(_check_reachable, 5, 5, 30,
-                              CONF.zvm_reachable_timeout,
-                              exception.ZVMRetryException)
+        The boot time history of the image decides when to start checking
+        densely.
+        """
+        boot_times = self._driver._boot_time_model
+        image, distro = self._get_boot_key()
+        start = time.time()
+        self._reachable = self._driver._state_waiter.wait(
+            self._name, zvmwaiter.REACHABLE, CONF.zvm_reachable_timeout,
+            boot_times.dense_after(image, distro))
+        if self._reachable:
+            boot_times.record(image, distro, time.time() - start)
 
     def update_node_info(self, image_meta):
         LOG.debug("Update the node info for instance %s", self._name)
@@ -757,6 +794,9 @@ class ZVMInstance(object):
                 exception.ZVMXCATUpdateNodeFailed, node=self._name):
             zvmutils.xcat_request("PUT", url, body)
 
+        zvmutils.get_node_attr_cache().update(self._name,
+                                    {'nodetype.provmethod': prov_method})
+
     def update_node_info_resize(self, image_name_xcat):
         LOG.debug("Update the nodetype for instance %s", self._name)
 
@@ -777,11 +817,18 @@ class ZVMInstance(object):
                 exception.ZVMXCATUpdateNodeFailed, node=self._name):
             zvmutils.xcat_request("PUT", url, body)
 
+        zvmutils.get_node_attr_cache().update(self._name,
+                                    {'nodetype.provmethod': 'sysclone'})
+
     def get_provmethod(self):
-        addp = "&col=node=%s&attribute=provmethod" % self._name
-        url = self._xcat_url.gettab('/nodetype', addp)
-        res_info = zvmutils.xcat_request("GET", url)
-        return res_info['data'][0][0]
+        def _get_provmethod():
+            addp = "&col=node=%s&attribute=provmethod" % self._name
+            url = self._xcat_url.gettab('/nodetype', addp)
+            res_info = zvmutils.xcat_request("GET", url)
+            return res_info['data'][0][0]
+
+        return zvmutils.get_node_attr_cache().get(self._name,
+                                    'nodetype.provmethod', _get_provmethod)
 
     def update_node_provmethod(self, provmethod):
         LOG.debug("Update the nodetype for instance %s", self._name)
@@ -794,6 +841,9 @@ class ZVMInstance(object):
                 exception.ZVMXCATUpdateNodeFailed, node=self._name):
             zvmutils.xcat_request("PUT", url, body)
 
+        zvmutils.get_node_attr_cache().update(self._name,
+                                    {'nodetype.provmethod': provmethod})
+
     def update_node_def(self, hcp, userid):
         """Update xCAT node definition."""
 
@@ -805,6 +855,9 @@ class ZVMInstance(object):
                 exception.ZVMXCATUpdateNodeFailed, node=self._name):
             zvmutils.xcat_request("PUT", url, body)
 
+        zvmutils.get_node_attr_cache().update(self._name,
+                                    {'zvm.hcp': hcp, 'zvm.userid': userid})
+
     def deploy_node(self, image_name, transportfiles=None, vdev=None):
         LOG.debug("Begin to deploy image on instance %s", self._name)
         vdev = vdev or CONF.zvm_user_root_vdev
@@ -821,7 +874,8 @@ class ZVMInstance(object):
 
         with zvmutils.except_xcat_call_failed_and_reraise(
                 exception.ZVMXCATDeployNodeFailed, node=self._name):
-            zvmutils.xcat_request("PUT", url, body)
+            with self.timer.phase('nodeset'):
+                zvmutils.xcat_request("PUT", url, body)
 
     def copy_xcat_node(self, source_node_name):
         """Create xCAT node from an existing z/VM instance."""
@@ -838,6 +892,7 @@ class ZVMInstance(object):
 
         url = self._xcat_url.mkdef('/' + self._name)
 
+        zvmutils.get_node_attr_cache().remove(self._name)
         with zvmutils.except_xcat_call_failed_and_reraise(
                 exception.ZVMXCATCreateNodeFailed, node=self._name):
             zvmutils.xcat_request("POST", url, body)
@@ -0,0 +1,298 @@
+# Copyright 2017 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import collections
+import eventlet
+import time
+
+from nova.i18n import _LI, _LW
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from nova_zvm.virt.zvm import admission
+from nova_zvm.virt.zvm import exception
+from nova_zvm.virt.zvm import instance as zvminstance
+from nova_zvm.virt.zvm import utils as zvmutils
+
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+# Flavor attributes a pool guest is created with
+_FLAVOR_KEYS = ('memory_mb', 'vcpus', 'root_gb', 'ephemeral_gb')
+
+
+class PoolGuest(object):
+    """A pre-created guest of the warm pool."""
+
+    def __init__(self, node, key, image_name):
+        self.node = node
+        # The z/VM userid is the node name the guest was created with
+        self.userid = node
+        self.key = key
+        self.image_name = image_name
+
+
+class WarmPool(object):
+    """Pre-created and pre-deployed z/VM guests that spawns take over.
+
+    Every successful spawn from an image records the image and flavor as a
+    template. A background green thread creates guests for the templates,
+    one image with the flavor it is spawned with most often, up to the
+    targets of the images and the pool size. claim() hands a guest of the
+    same image and flavor to a spawn, which then only defines its own xCAT
+    node for the userid of the guest and punches its config drive.
+    """
+
+    def __init__(self, driver):
+        self._driver = driver
+        # key -> template of the last spawn of the key
+        self._templates = {}
+        # key -> number of spawns recorded
+        self._demand = collections.Counter()
+        # key -> [PoolGuest, ...] ready to be claimed, oldest first
+        self._ready = {}
+        # key -> number of guests being created
+        self._creating = collections.Counter()
+        self._seq = 0
+        self._refiller = None
+        self.claimed = 0
+        self.missed = 0
+        self.created = 0
+        self.failed = 0
+
+    @staticmethod
+    def enabled():
+        return CONF.zvm_warm_pool_size > 0
+
+    def owns(self, node):
+        """Whether node is a pool guest."""
+        return self.enabled() and node.startswith(CONF.zvm_warm_pool_prefix)
+
+    @staticmethod
+    def get_key(instance, block_device_info):
+        """Key of the guests a spawn can take over, None if it can't.
+
+        Spawns from volumes or with ephemeral disks of their own are not
+        served from the pool.
+        """
+        boot_from_volume = zvmutils.is_boot_from_volume(block_device_info)[1]
+        if (boot_from_volume or
+                (block_device_info or {}).get('ephemerals')):
+            return None
+        return ((instance['image_ref'],) +
+                tuple(instance[k] for k in _FLAVOR_KEYS))
+
+    def record_spawn(self, key, image_meta, image_name):
+        """Remember a successful spawn so that guests are made for it.
+
+        :param image_meta: the image meta prepared by the spawn, with the
+                           root disk units, or None if the spawn took a
+                           guest of the pool and prepared no image
+        """
+        if not self.enabled() or key is None:
+            return
+        self._demand[key] += 1
+        if image_meta is not None:
+            self._templates[key] = {'image_meta': image_meta,
+                                    'image_name': image_name}
+
+    def claim(self, key):
+        """Take a guest for key out of the pool, None if there is none."""
+        if not self.enabled() or key is None:
+            return None
+        guests = self._ready.get(key)
+        if not guests:
+            self.missed += 1
+            return None
+        self.claimed += 1
+        guest = guests.pop(0)
+        LOG.info(_LI("Warm pool guest %(node)s claimed, %(num)d left for "
+                     "image %(image)s"),
+                 {'node': guest.node, 'num': len(guests), 'image': key[0]})
+        return guest
+
+    def release(self, guest):
+        """Put back a claimed guest which was not taken over."""
+        self.claimed -= 1
+        self._ready.setdefault(guest.key, []).insert(0, guest)
+        LOG.info(_LI("Warm pool guest %s released"), guest.node)
+
+    def take_over(self, guest):
+        """Remove the xCAT node of a claimed guest.
+
+        The node of the instance has been defined for the userid of the
+        guest before, so the userid is not deleted with the node.
+        """
+        self._get_zvm_inst(guest.node).delete_xcat_node()
+
+    def start(self):
+        """Start refilling the pool in the background."""
+        if self.enabled() and self._refiller is None:
+            self._refiller = eventlet.spawn(self._refill_loop)
+
+    def _refill_loop(self):
+        self._clean_leftovers()
+        while True:
+            time.sleep(CONF.zvm_warm_pool_refill_interval)
+            try:
+                self.refill()
+            except Exception as err:
+                LOG.warning(_LW("Failed to refill the warm pool: %s"),
+                            zvmutils.format_exception_msg(err))
+
+    def _clean_leftovers(self):
+        """Delete the guests left by a previous run of the service.
+
+        The templates they were created for are not known any more.
+        """
+        try:
+            nodes = [n for n in self._driver._list_guest_nodes()
+                     if self.owns(n)]
+        except exception.ZVMBaseException as err:
+            LOG.warning(_LW("Failed to list warm pool guests: %s"),
+                        err.format_message())
+            return
+
+        for node in nodes:
+            self._seq = max(self._seq, self._get_seq(node))
+            self._delete_guest(node)
+
+    @staticmethod
+    def _get_seq(node):
+        try:
+            return int(node[len(CONF.zvm_warm_pool_prefix):])
+        except ValueError:
+            return 0
+
+    def _next_node(self):
+        self._seq += 1
+        width = 8 - len(CONF.zvm_warm_pool_prefix)
+        self._seq %= 10 ** width
+        return '%s%0*d' % (CONF.zvm_warm_pool_prefix, width, self._seq)
+
+    def _get_targets(self):
+        """Number of guests wanted per key."""
+        targets = {}
+        for entry in CONF.zvm_warm_pool_targets:
+            image, _sep, count = entry.partition(':')
+            try:
+                targets[image.strip()] = int(count)
+            except ValueError:
+                LOG.warning(_LW("Invalid warm pool target %s"), entry)
+
+        # Only the most spawned flavor of each image gets guests
+        best = {}
+        for key, demand in self._demand.items():
+            image = key[0]
+            if image not in best or demand > self._demand[best[image]]:
+                best[image] = key
+        return dict((key, targets.get(image,
+                                      CONF.zvm_warm_pool_default_target))
+                    for (image, key) in best.items())
+
+    def plan(self):
+        """Keys of the guests to create next, most wanted first."""
+        total = (sum(len(g) for g in self._ready.values()) +
+                 sum(self._creating.values()))
+        room = min(CONF.zvm_warm_pool_size - total,
+                   CONF.zvm_warm_pool_refill_rate)
+        missing = []
+        for key, target in self._get_targets().items():
+            have = len(self._ready.get(key, ())) + self._creating[key]
+            if target > have:
+                missing.append([target - have, key])
+
+        plan = []
+        # Round robin over the keys, in the order of their demand
+        missing.sort(key=lambda m: -self._demand[m[1]])
+        while missing and len(plan) < room:
+            for item in list(missing):
+                if len(plan) >= room:
+                    break
+                plan.append(item[1])
+                item[0] -= 1
+                if not item[0]:
+                    missing.remove(item)
+        return plan
+
+    def refill(self):
+        for key in self.plan():
+            self._creating[key] += 1
+            try:
+                guest = self._create_guest(key)
+            except Exception as err:
+                # Any failure only fails this guest, not the refill pass
+                self.failed += 1
+                LOG.warning(_LW("Failed to create a warm pool guest for "
+                                "image %(image)s: %(err)s"),
+                            {'image': key[0],
+                             'err': zvmutils.format_exception_msg(err)})
+                continue
+            finally:
+                self._creating[key] -= 1
+            self.created += 1
+            self._ready.setdefault(key, []).append(guest)
+
+    def _get_zvm_inst(self, node, key=None):
+        inst = zvminstance.CopiedInstance({'name': node})
+        inst['uuid'] = None
+        if key is not None:
+            inst['image_ref'] = key[0]
+            for (k, v) in zip(_FLAVOR_KEYS, key[1:]):
+                inst[k] = v
+        return zvminstance.ZVMInstance(self._driver, inst)
+
+    def _create_guest(self, key):
+        template = self._templates[key]
+        node = self._next_node()
+        LOG.debug("Creating warm pool guest %(node)s for image %(image)s",
+                  {'node': node, 'image': key[0]})
+        zvm_inst = self._get_zvm_inst(node, key)
+        zvm_inst.create_xcat_node(self._driver._get_hcp_info()['hostname'])
+        try:
+            with self._driver._admission.admit(admission.DIRECTORY):
+                zvm_inst.create_userid({}, template['image_meta'], None,
+                                       template['image_name'])
+            with self._driver._admission.admit(admission.DEPLOY):
+                zvm_inst.update_node_info(template['image_meta'])
+                zvm_inst.deploy_node(template['image_name'])
+        except Exception:
+            self._delete_guest(node)
+            raise
+        return PoolGuest(node, key, template['image_name'])
+
+    def _delete_guest(self, node):
+        try:
+            self._get_zvm_inst(node).delete_userid(
+                    self._driver._get_hcp_info()['nodename'], None)
+        except exception.ZVMBaseException as err:
+            LOG.warning(_LW("Failed to delete warm pool guest %(node)s: "
+                            "%(err)s"), {'node': node,
+                                         'err': err.format_message()})
+
+    def get_stats(self):
+        """Return the pool content and counters, for the host stats."""
+        images = {}
+        for key, guests in self._ready.items():
+            images[key[0]] = images.get(key[0], 0) + len(guests)
+        return {'size': CONF.zvm_warm_pool_size,
+                'ready': sum(images.values()),
+                'creating': sum(self._creating.values()),
+                'images': images,
+                'claimed': self.claimed,
+                'missed': self.missed,
+                'created': self.created,
+                'failed': self.failed}
@@ -0,0 +1,137 @@
+# Copyright 2017 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import collections
+
+from nova import exception as nova_exception
+from nova.i18n import _LI, _LW
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import units
+
+from nova_zvm.virt.zvm import exception
+from nova_zvm.virt.zvm import instance as zvminstance
+
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+
+class ImagePrewarmer(object):
+    """Import popular images to xCAT before they are spawned.
+
+    Spawns are counted per image, starting from the images of the instances
+    on the host. At each image cache pass, the first of the images of
+    zvm_image_prewarm_images and the zvm_image_prewarm_top most spawned
+    images which is not in xCAT is imported, as long as the xCAT MN keeps
+    enough free space, so that the first spawn of it on the host does not
+    wait for the download and import. Only one image is imported per pass
+    since the other periodic tasks of the compute manager wait for it.
+    """
+
+    def __init__(self, driver):
+        self._driver = driver
+        # image id -> number of spawns
+        self._spawns = collections.Counter()
+        self._seeded = False
+        self.imported = 0
+        self.failed = 0
+        self.no_space = 0
+
+    def record_spawn(self, image_id):
+        if image_id:
+            self._spawns[image_id] += 1
+
+    def _seed(self, instances):
+        """Count the images of the instances on the host once."""
+        if self._seeded:
+            return
+        self._seeded = True
+        for inst in instances:
+            self.record_spawn(inst.get('image_ref'))
+
+    def get_candidates(self):
+        """Images to keep in xCAT, the listed ones first."""
+        images = []
+        for image_id in CONF.zvm_image_prewarm_images:
+            image_id = image_id.strip()
+            if image_id and image_id not in images:
+                images.append(image_id)
+
+        popular = [i for (i, _count) in self._spawns.most_common()
+                   if i not in images]
+        return images + popular[:CONF.zvm_image_prewarm_top]
+
+    def run(self, context, instances):
+        """Import the first candidate image which is not in xCAT."""
+        self._seed(instances)
+        candidates = [i for i in self.get_candidates()
+                      if not self._driver._zvm_images.image_exist_xcat(i)]
+        if not candidates:
+            return
+
+        zvm_images = self._driver._zvm_images
+        free_space = zvm_images.get_free_space_xcat(
+                        CONF.xcat_free_space_threshold, CONF.zvm_xcat_master)
+        reserve = max(CONF.xcat_free_space_threshold,
+                      CONF.xcat_image_free_space_goal)
+        for image_id in candidates:
+            try:
+                image_meta = self._driver._image_api.get(context, image_id)
+                zvm_images.zimage_check(image_meta)
+            except (nova_exception.NovaException,
+                    exception.ZVMBaseException) as err:
+                self.failed += 1
+                LOG.warning(_LW("Image %(image)s can not be pre-imported: "
+                                "%(err)s"),
+                            {'image': image_id, 'err': err.format_message()})
+                continue
+
+            # The bundle and the image are both in /install while importing
+            needed = 2.0 * image_meta.get('size', 0) / units.Gi
+            if free_space - needed < reserve:
+                self.no_space += 1
+                LOG.info(_LI("Not pre-importing image %(image)s, xCAT MN "
+                             "free space %(free).1f G is too low"),
+                         {'image': image_id, 'free': free_space})
+                continue
+
+            self._import(context, image_meta)
+            return
+
+    def _import(self, context, image_meta):
+        inst = zvminstance.CopiedInstance({'image_ref': image_meta['id'],
+                                           'user_id': context.user_id,
+                                           'project_id': context.project_id})
+        inst['uuid'] = None
+        LOG.info(_LI("Pre-importing image %s to xCAT"), image_meta['id'])
+        try:
+            self._driver._prepare_image_for_spawn(context, inst, image_meta)
+        except (nova_exception.NovaException,
+                exception.ZVMBaseException) as err:
+            self.failed += 1
+            LOG.warning(_LW("Failed to pre-import image %(image)s: %(err)s"),
+                        {'image': image_meta['id'],
+                         'err': err.format_message()})
+            return
+
+        self.imported += 1
+
+    def get_stats(self):
+        """Return the counters and most spawned images, for the stats."""
+        return {'imported': self.imported,
+                'failed': self.failed,
+                'no_space': self.no_space,
+                'popular': dict(self._spawns.most_common(10))}
@@ -0,0 +1,166 @@
+# Copyright 2017 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import bisect
+import collections
+import contextlib
+import os
+import time
+
+from nova.i18n import _LW
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+# Upper bounds (seconds) of the histogram buckets, the last bucket is
+# everything above
+BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# (operation, phase) -> Histogram
+_HISTOGRAMS = {}
+# name -> function returning more statistics to export
+_PROVIDERS = {}
+
+
+class Histogram(object):
+    """Distribution of the durations of one phase of one operation."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        buckets = collections.OrderedDict()
+        for bound, count in zip(BUCKETS, self.counts):
+            buckets['le_%s' % bound] = count
+        buckets['inf'] = self.counts[-1]
+        return {'count': self.count,
+                'sum': round(self.sum, 3),
+                'max': round(self.max, 3),
+                'buckets': buckets}
+
+
+def record(operation, phase, seconds):
+    """Add a phase duration to the in-process histograms."""
+    key = (operation, phase)
+    if key not in _HISTOGRAMS:
+        _HISTOGRAMS[key] = Histogram()
+    _HISTOGRAMS[key].add(seconds)
+
+
+def get_stats():
+    """Return the histograms as {operation: {phase: histogram dict}}."""
+    stats = {}
+    for (operation, phase), hist in _HISTOGRAMS.items():
+        stats.setdefault(operation, {})[phase] = hist.to_dict()
+    return stats
+
+
+def reset():
+    _HISTOGRAMS.clear()
+
+
+def register_stats(name, func):
+    """Export the JSON serializable result of func() under name as well."""
+    _PROVIDERS[name] = func
+
+
+def export(path=None):
+    """Write the histograms to path as JSON.
+
+    :param path: file to write, CONF.zvm_phase_stats_file by default. Nothing
+                 is written when neither is set.
+    """
+    path = path or CONF.zvm_phase_stats_file
+    if not path:
+        return
+
+    stats = get_stats()
+    for (name, func) in _PROVIDERS.items():
+        stats[name] = func()
+
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(jsonutils.dumps(stats, indent=2, sort_keys=True))
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        LOG.warning(_LW("Failed to export phase timings to %(path)s: "
+                        "%(err)s"), {'path': path, 'err': err})
+
+
+class PhaseTimer(object):
+    """Time the phases of one operation on one instance.
+
+    Phases are either timed by the phase() context manager, which may be
+    used by concurrent steps, or one after another by start_phase(), which
+    ends the phase started before. finish() records the total.
+    Durations are added to the histograms of operation, unless operation
+    is None.
+    """
+
+    def __init__(self, operation=None):
+        self._operation = operation
+        self._start = time.time()
+        self._current = None
+        self.timings = collections.OrderedDict()
+
+    def _add(self, phase, seconds):
+        self.timings[phase] = self.timings.get(phase, 0) + seconds
+        if self._operation is not None:
+            record(self._operation, phase, seconds)
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self._add(phase, time.time() - start)
+
+    def start_phase(self, phase):
+        self._end_phase()
+        self._current = (phase, time.time())
+
+    def _end_phase(self):
+        if self._current is not None:
+            phase, start = self._current
+            self._current = None
+            self._add(phase, time.time() - start)
+
+    def finish(self):
+        """End the current phase and record the total, in seconds."""
+        self._end_phase()
+        total = time.time() - self._start
+        if self._operation is not None:
+            record(self._operation, 'total', total)
+            export()
+        return total
+
+    def summary(self):
+        return ', '.join('%s=%.1fs' % (phase, seconds)
+                         for (phase, seconds) in self.timings.items())
@@ -13,14 +13,17 @@
 #    under the License.
 
 import contextlib
+import eventlet
 import functools
 import os
 import pwd
+import re
 import shutil
 import six
 from six.moves import http_client as httplib
 import socket
 import ssl
+import sys
 import time
 
 from nova import block_device
@@ -45,6 +48,8 @@ CONF.import_opt('instances_path', 'nova.compute.manager')
 
 
 _XCAT_URL = None
+_NODE_ATTR_CACHE = None
+_MN_FACTS = None
 
 
 class XCATUrl(object):
@@ -291,6 +296,218 @@ def get_xcat_url():
     return _XCAT_URL
 
 
+class NodeAttrCache(object):
+    """Cache of xCAT node attributes which rarely change.
+
+    Attributes are keyed by node and 'table.attr' name. The cache is filled
+    by one lsdef of the whole node group, or node by node on miss, and is
+    updated when the driver writes the attributes itself. An attribute is
+    read again from xCAT after zvm_node_attr_refresh_interval, since other
+    compute nodes sharing the xCAT MN may change it.
+    """
+
+    # lsdef attribute name -> cache key
+    LSDEF_ATTRS = {'userid': 'zvm.userid',
+                   'hcp': 'zvm.hcp',
+                   'provmethod': 'nodetype.provmethod'}
+    # Keys which can be cached for gettab requests. zvm.status is not
+    # cached since xCAT writes it too.
+    CACHED_KEYS = ('zvm.userid', 'zvm.hcp', 'nodetype.provmethod')
+
+    def __init__(self):
+        # node -> {key: (value, load time)}
+        self._nodes = {}
+
+    def load(self, group=None):
+        """Fill the cache with one lsdef of all nodes in group."""
+        group = group or CONF.zvm_xcat_group
+        url = get_xcat_url().lsdef_node('/' + group)
+        res_info = xcat_request("GET", url)
+
+        nodes = {}
+        node = None
+        with expect_invalid_xcat_resp_data(res_info):
+            for info in res_info['info']:
+                for line in info:
+                    line = line.strip()
+                    if line.startswith('Object name:'):
+                        node = line.partition(':')[2].strip()
+                        nodes[node] = {}
+                        continue
+                    attr, sep, value = line.partition('=')
+                    if node and sep and attr in self.LSDEF_ATTRS:
+                        nodes[node][self.LSDEF_ATTRS[attr]] = value
+
+        for node, attrs in nodes.items():
+            self.update(node, attrs)
+        LOG.debug("Loaded attributes of %(num)d nodes of group %(group)s",
+                  {'num': len(nodes), 'group': group})
+
+    def get(self, node, key, loader):
+        """Get attribute key of node, calling loader() on cache miss."""
+        attr = self._nodes.get(node, {}).get(key)
+        ttl = CONF.zvm_node_attr_refresh_interval
+        if attr is not None and not (ttl and time.time() - attr[1] > ttl):
+            return attr[0]
+
+        value = loader()
+        if value is not None:
+            self.update(node, {key: value})
+        return value
+
+    def update(self, node, attrs):
+        now = time.time()
+        self._nodes.setdefault(node, {}).update(
+                        (key, (value, now)) for (key, value) in attrs.items())
+
+    def remove(self, node):
+        self._nodes.pop(node, None)
+
+
+def get_node_attr_cache():
+    global _NODE_ATTR_CACHE
+
+    if _NODE_ATTR_CACHE is not None:
+        return _NODE_ATTR_CACHE
+
+    _NODE_ATTR_CACHE = NodeAttrCache()
+    return _NODE_ATTR_CACHE
+
+
+class MNFacts(object):
+    """Stable facts of the xCAT MN and zHCP, like SSH key and zHCP identity.
+
+    A fact is loaded on first use and reloaded after
+    zvm_mn_facts_refresh_interval, or when the caller sets a new value.
+    """
+
+    def __init__(self):
+        # name -> (value, load time)
+        self._facts = {}
+
+    def get(self, name, loader=None):
+        """Get fact name, calling loader() if it is missing or expired.
+
+        Without loader, None is returned for a missing or expired fact.
+        """
+        fact = self._facts.get(name)
+        ttl = CONF.zvm_mn_facts_refresh_interval
+        if fact is not None and not (ttl and time.time() - fact[1] > ttl):
+            return fact[0]
+
+        if loader is None:
+            return None
+        value = loader()
+        self.set(name, value)
+        return value
+
+    def set(self, name, value):
+        self._facts[name] = (value, time.time())
+
+    def invalidate(self, name):
+        self._facts.pop(name, None)
+
+
+def get_mn_facts():
+    global _MN_FACTS
+
+    if _MN_FACTS is not None:
+        return _MN_FACTS
+
+    _MN_FACTS = MNFacts()
+    return _MN_FACTS
+
+
+class KeyedLock(object):
+    """Run operations one at a time per key, reusing in-flight results.
+
+    A caller of run() that finds an operation on the same key in progress
+    waits for it and gets its result instead of running the operation
+    again. If it failed, the waiting callers run it again one at a time.
+    Operations on different keys run concurrently.
+    """
+
+    def __init__(self):
+        # key -> event sent with (succeeded, result) of the running operation
+        self._running = {}
+
+    def run(self, key, func):
+        while key in self._running:
+            (succeeded, result) = self._running[key].wait()
+            if succeeded:
+                LOG.debug("Reusing result of operation on %s", key)
+                return result
+
+        event = eventlet.event.Event()
+        self._running[key] = event
+        try:
+            result = func()
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                del self._running[key]
+                event.send((False, None))
+
+        del self._running[key]
+        event.send((True, result))
+        return result
+
+
+class Batcher(object):
+    """Combine the calls made while a previous call is running.
+
+    submit(item) returns when func has been called with a list of items
+    including item. The first caller's batch starts at once; callers that
+    submit while a batch is running are combined into the next batch, so
+    a burst of N calls makes about two calls of func. If a batch of
+    several items fails, its items are retried one by one so that each
+    caller gets its own result.
+    """
+
+    def __init__(self, name, func):
+        self._name = name
+        self._func = func
+        # (item, event) of the callers waiting for the next batch
+        self._pending = []
+        self._running = False
+
+    def submit(self, item):
+        event = eventlet.event.Event()
+        self._pending.append((item, event))
+        if not self._running:
+            self._running = True
+            eventlet.spawn_n(self._run)
+
+        (succeeded, result) = event.wait()
+        if not succeeded:
+            six.reraise(*result)
+        return result
+
+    def _run(self):
+        try:
+            while self._pending:
+                batch, self._pending = self._pending, []
+                self._run_batch(batch)
+        finally:
+            self._running = False
+
+    def _run_batch(self, batch):
+        items = [item for (item, event) in batch]
+        LOG.debug("%(name)s: run batch of %(num)d", {'name': self._name,
+                                                     'num': len(items)})
+        try:
+            result = self._func(items)
+        except Exception:
+            if len(batch) == 1:
+                batch[0][1].send((False, sys.exc_info()))
+            else:
+                for one in batch:
+                    self._run_batch([one])
+            return
+
+        for (item, event) in batch:
+            event.send((True, result))
+
+
 def remove_prefix_of_unicode(str_unicode):
     str_unicode = str_unicode.encode('unicode_escape')
     str_unicode = str_unicode.replace('\u', '')
@@ -661,13 +878,16 @@ def get_host():
 
 def get_xcat_version():
     """Return the version of xCAT"""
-    url = get_xcat_url().version()
-    data = xcat_request('GET', url)['data']
+    def _get_xcat_version():
+        url = get_xcat_url().version()
+        data = xcat_request('GET', url)['data']
 
-    with expect_invalid_xcat_resp_data(data):
-        version = data[0][0].split()[1]
-        version = version.strip()
-        return version
+        with expect_invalid_xcat_resp_data(data):
+            version = data[0][0].split()[1]
+            version = version.strip()
+            return version
+
+    return get_mn_facts().get('xcat_version', _get_xcat_version)
 
 
 def xcat_support_chvm_smcli():
@@ -697,12 +917,15 @@ def xcat_support_iucv(xcat_version=None):
 
 def get_userid(node_name):
     """Returns z/VM userid for the xCAT node."""
-    url = get_xcat_url().lsdef_node(''.join(['/', node_name]))
-    info = xcat_request('GET', url)
-    with expect_invalid_xcat_resp_data(info):
-        for s in info['info'][0]:
-            if s.__contains__('userid='):
-                return s.strip().rpartition('=')[2]
+    def _get_userid():
+        url = get_xcat_url().lsdef_node(''.join(['/', node_name]))
+        info = xcat_request('GET', url)
+        with expect_invalid_xcat_resp_data(info):
+            for s in info['info'][0]:
+                if s.__contains__('userid='):
+                    return s.strip().rpartition('=')[2]
+
+    return get_node_attr_cache().get(node_name, 'zvm.userid', _get_userid)
 
 
 def xdsh(node, commands):
@@ -736,6 +959,12 @@ def execcmdonvm(node, commands):
     return xcat_request("PUT", url, body)
 
 
+def power_on_nodes(nodes):
+    """Power on many nodes with one rpower request."""
+    url = get_xcat_url().rpower('/' + ','.join(nodes))
+    return xcat_request("PUT", url, ['on'])
+
+
 def punch_file(node, fn, fclass, remote_host=None, del_src=True):
     """punch file to reader. """
     if remote_host:
@@ -783,12 +1012,39 @@ def copy_zvm_table_status(des_inst_name, src_inst_name):
     xcat_cmd_settab('zvm', 'node', des_inst_name, "status", status)
 
 
-def punch_iucv_file(os_ver, zhcp, zhcp_userid, instance_name,
-                    instance_path):
-    """put iucv server and service files to reader."""
+def _parse_md5sum(res_dict):
+    with expect_invalid_xcat_resp_data(res_dict):
+        output = res_dict['data'][0][0]
+    match = re.search(r'\b[0-9a-f]{32}\b', output)
+    return match and match.group(0)
+
+
+def get_iucv_server_version(zhcp_node):
+    """Get the version (md5sum) of the IUCV server punched from zhcp."""
+    def _get_iucv_server_version():
+        cmd = 'md5sum /opt/zhcp/bin/IUCV/iucvserv'
+        return _parse_md5sum(xdsh(zhcp_node, cmd))
+
+    return get_mn_facts().get('iucv_server_version', _get_iucv_server_version)
+
+
+def get_guest_iucv_server_version(instance_name):
+    """Get the version (md5sum) of the IUCV server installed in a guest."""
+    cmd = 'md5sum /usr/bin/iucvserv'
+    return _parse_md5sum(execcmdonvm(instance_name, cmd))
+
+
+def get_iucv_authorized_command(zhcp_userid):
+    return "echo -n %s >/etc/iucv_authorized_userid 2>&1" % zhcp_userid
+
+
+def _get_iucv_files(os_ver, zhcp_userid):
+    """Get the IUCV service file on zhcp and the commands setting it up.
+
+    :returns: a tuple of the path of the iucvserd service file on zhcp and
+              the commands which install the IUCV server in the guest.
+    """
     xcat_iucv_path = '/opt/zhcp/bin/IUCV'
-    # generate iucvserver file
-    iucv_server_fn = ''.join([xcat_iucv_path, '/iucvserv'])
     iucv_server_path = '/usr/bin/iucvserv'
     punch_path = '/var/opt/xcat/transport'
     # generate iucvserver service and script file
@@ -812,7 +1068,6 @@ def punch_iucv_file(os_ver, zhcp, zhcp_userid, instance_name,
         if(distro == "sles" and release >= '12'):
             iucv_service_path = '/usr/lib/systemd/system/' + iucv_service_name
 
-    iucv_cmd_file_path = instance_path + '/iucvexec.sh'
     cmd = '\n'.join((
         # if when execute this script, conf4z hasn't received iucv file.
         "spoolid=`vmur li | awk '/iucvserv/{print \$2}'|tail -1`",
@@ -825,22 +1080,42 @@ def punch_iucv_file(os_ver, zhcp, zhcp_userid, instance_name,
         "cp -rf %s/%s %s 2>&1 >/var/log/messages" % (punch_path,
                                         iucv_service_name, iucv_service_path),
         "chmod +x %s %s" % (iucv_server_path, iucv_service_path),
-        "echo -n %s >/etc/iucv_authorized_userid 2>&1" % zhcp_userid,
+        get_iucv_authorized_command(zhcp_userid),
         start_iucv_service_sh
         ))
-    _generate_iucv_cmd_file(iucv_cmd_file_path, cmd)
+    return (iucv_serverd_fn, cmd)
+
+
+def get_iucv_setup_commands(os_ver, zhcp_userid):
+    """Commands which install the IUCV server in the guest at first boot."""
+    return _get_iucv_files(os_ver, zhcp_userid)[1]
+
+
+def punch_iucv_file(os_ver, zhcp, zhcp_userid, instance_name,
+                    instance_path, bundled=False):
+    """put iucv server and service files to reader.
+
+    :param bundled: the setup commands are in the transport files already,
+                    only punch the IUCV server and service files.
+    """
+    # generate iucvserver file
+    iucv_server_fn = '/opt/zhcp/bin/IUCV/iucvserv'
+    (iucv_serverd_fn, cmd) = _get_iucv_files(os_ver, zhcp_userid)
     punch_file(instance_name, iucv_server_fn, 'X',
                                    remote_host=zhcp, del_src=False)
     punch_file(instance_name, iucv_serverd_fn, 'X',
                                    remote_host=zhcp, del_src=False)
-    punch_file(instance_name, iucv_cmd_file_path, 'X', remote_host=get_host(),
-                                                     del_src=False)
+    if not bundled:
+        iucv_cmd_file_path = instance_path + '/iucvexec.sh'
+        _generate_iucv_cmd_file(iucv_cmd_file_path, cmd)
+        punch_file(instance_name, iucv_cmd_file_path, 'X',
+                   remote_host=get_host(), del_src=False)
     # set VM's communicate type is IUCV
     add_iucv_in_zvm_table(instance_name)
 
 
 def punch_iucv_authorized_file(old_inst_name, new_inst_name, zhcp_userid):
-    cmd = "echo -n %s >/etc/iucv_authorized_userid 2>&1" % zhcp_userid
+    cmd = get_iucv_authorized_command(zhcp_userid)
     iucv_cmd_file_path = '/tmp/%s.sh' % new_inst_name[-8:]  # nosec
     _generate_iucv_cmd_file(iucv_cmd_file_path, cmd)
     punch_file(new_inst_name, iucv_cmd_file_path, 'X', remote_host=get_host())
@@ -952,12 +1227,15 @@ def _generate_zipl_file(fn, lun, wwpn, fcp, volume_meta):
 
 @wrap_invalid_xcat_resp_data_error
 def get_mn_pub_key():
-    cmd = 'cat /root/.ssh/id_rsa.pub'
-    resp = xdsh(CONF.zvm_xcat_master, cmd)
-    key = resp['data'][0][0]
-    start_idx = key.find('ssh-rsa')
-    key = key[start_idx:]
-    return key
+    def _get_mn_pub_key():
+        cmd = 'cat /root/.ssh/id_rsa.pub'
+        resp = xdsh(CONF.zvm_xcat_master, cmd)
+        key = resp['data'][0][0]
+        start_idx = key.find('ssh-rsa')
+        key = key[start_idx:]
+        return key
+
+    return get_mn_facts().get('mn_pub_key', _get_mn_pub_key)
 
 
 def parse_os_version(os_version):
@@ -978,15 +1256,21 @@ def parse_os_version(os_version):
 
 
 def xcat_cmd_gettab(table, col, col_value, attr):
-    addp = ("&col=%(col)s=%(col_value)s&attribute=%(attr)s" %
-            {'col': col, 'col_value': col_value, 'attr': attr})
-    url = get_xcat_url().gettab('/%s' % table, addp)
-    res_info = xcat_request("GET", url)
-    with expect_invalid_xcat_resp_data(res_info):
-        if res_info['data']:
-            return res_info['data'][0][0]
-        else:
-            return ''
+    def _gettab():
+        addp = ("&col=%(col)s=%(col_value)s&attribute=%(attr)s" %
+                {'col': col, 'col_value': col_value, 'attr': attr})
+        url = get_xcat_url().gettab('/%s' % table, addp)
+        res_info = xcat_request("GET", url)
+        with expect_invalid_xcat_resp_data(res_info):
+            if res_info['data']:
+                return res_info['data'][0][0]
+            else:
+                return ''
+
+    key = '%s.%s' % (table, attr)
+    if col == 'node' and key in NodeAttrCache.CACHED_KEYS:
+        return get_node_attr_cache().get(col_value, key, _gettab)
+    return _gettab()
 
 
 def xcat_cmd_settab(table, col, col_value, attr, value):
@@ -997,7 +1281,12 @@ def xcat_cmd_settab(table, col, col_value, attr, value):
     url = get_xcat_url().tabch("/%s" % table)
     body = [commands]
     with expect_invalid_xcat_resp_data():
-        return xcat_request("PUT", url, body)['data']
+        res_data = xcat_request("PUT", url, body)['data']
+
+    key = '%s.%s' % (table, attr)
+    if col == 'node' and key in NodeAttrCache.CACHED_KEYS:
+        get_node_attr_cache().update(col_value, {key: value})
+    return res_data
 
 
 def xcat_cmd_gettab_multi_attr(table, col, col_value, attr_list):
@@ -1019,6 +1308,38 @@ def xcat_cmd_gettab_multi_attr(table, col, col_value, attr_list):
     return outp
 
 
+def xcat_cmd_gettab_rows(table, col, col_value, attr_list):
+    """Get attr_list of all rows matching col=col_value in one request.
+
+    Unlike xcat_cmd_gettab_multi_attr, every matched row is returned, as
+    a list of {attr: value} dicts.
+    """
+    attr_str = ''.join(["&attribute=%s" % attr for attr in attr_list])
+    addp = ("&col=%(col)s=%(col_value)s&%(attr)s" %
+            {'col': col, 'col_value': col_value, 'attr': attr_str})
+    url = get_xcat_url().gettab('/%s' % table, addp)
+    res_data = xcat_request("GET", url)['data']
+
+    rows = []
+    row = {}
+    with expect_invalid_xcat_resp_data(res_data):
+        for data in res_data:
+            name, _sep, value = data[0].partition(':')
+            attr = name.strip().rpartition('.')[2]
+            if attr not in attr_list:
+                continue
+            # Attributes are listed in order per row, a repeated attribute
+            # starts the next row
+            if attr in row:
+                rows.append(row)
+                row = {}
+            row[attr] = value.strip()
+    if row:
+        rows.append(row)
+
+    return rows
+
+
 def format_exception_msg(exc_obj):
     """Return message string from nova exceptions and common exceptions."""
     if isinstance(exc_obj, nova_exception.NovaException):
@@ -1027,6 +1348,12 @@ def format_exception_msg(exc_obj):
         return str(exc_obj)
 
 
+def is_transient_error(exc_obj):
+    """Whether a failed operation may succeed when done again."""
+    emsg = format_exception_msg(exc_obj)
+    return any(pattern in emsg for pattern in const.XCAT_TRANSIENT_ERRORS)
+
+
 def looping_call(f, sleep=5, inc_sleep=0, max_sleep=60, timeout=600,
                  exceptions=(), *args, **kwargs):
     """Helper function that to run looping call with fixed/dynamical interval.
@@ -0,0 +1,323 @@
+# Copyright 2017 IBM Corp.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+
+import collections
+import eventlet
+import time
+
+from nova.compute import power_state
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from nova_zvm.virt.zvm import exception
+from nova_zvm.virt.zvm import utils as zvmutils
+
+
+LOG = logging.getLogger(__name__)
+CONF = cfg.CONF
+
+# Target states an instance can be waited for
+REACHABLE = 'reachable'
+POWER_OFF = 'off'
+NICS_GRANTED = 'nics_granted'
+
+# Before the expected state change time, a waiter is checked once every
+# _SPARSE_FACTOR poll intervals
+_SPARSE_FACTOR = 6
+
+
+class _Waiter(object):
+    """One caller waiting for a node to reach a target state."""
+
+    def __init__(self, node, timeout, dense_after=0, interval=None):
+        self.node = node
+        # current check interval when adaptive, None for fixed interval
+        self.interval = interval
+        now = time.time()
+        # timeout 0 means wait without a deadline
+        self.deadline = timeout and (now + timeout)
+        self.dense_after = now + dense_after
+        self.next_check = now
+        self.event = eventlet.event.Event()
+
+    def expired(self, now):
+        return bool(self.deadline) and now > self.deadline
+
+    def due(self, now):
+        return now >= self.next_check
+
+    def checked(self, now, interval):
+        if self.interval:
+            # adaptive: back off from the initial interval up to interval
+            interval = min(self.interval, interval)
+            self.interval = interval * 2
+        if now < self.dense_after:
+            # Check at the expected time at the latest, a late check would
+            # be recorded as a longer boot time
+            self.next_check = min(now + interval * _SPARSE_FACTOR,
+                                  self.dense_after)
+        else:
+            self.next_check = now + interval
+
+
+class StateWaiter(object):
+    """Multiplex state polling of many instances onto one loop.
+
+    Callers register a node name, a target state and a timeout through
+    wait(). A single green thread checks all pending nodes of the same
+    target state with one batched query per tick, and wakes up each
+    caller when its node reaches the target state or its deadline passes.
+    The polling thread is started on demand and exits when nothing is
+    pending.
+    """
+
+    def __init__(self, interval=None):
+        self._interval = interval or CONF.zvm_state_poll_interval
+        # target state -> function(list of nodes) -> set of nodes done
+        self._checkers = {}
+        # target state -> initial interval of adaptive polling
+        self._min_intervals = {}
+        # target state -> {node: [_Waiter, ...]}
+        self._waiters = {}
+        self._poller = None
+
+    def register(self, state, checker, min_interval=None):
+        """Register the batched check function for a target state.
+
+        :param state: name of the target state.
+        :param checker: callable taking a list of node names and returning
+                        the collection of those nodes that are in the target
+                        state.
+        :param min_interval: if given, a node is checked again after
+                             min_interval seconds first, and the interval
+                             doubles on each check up to the poll interval.
+        """
+        self._checkers[state] = checker
+        self._min_intervals[state] = min_interval
+
+    def wait(self, node, state, timeout=0, dense_after=0):
+        """Block until node reaches state.
+
+        :param node: xCAT node name of the instance.
+        :param state: one of the registered target states.
+        :param timeout: seconds to wait, 0 means no timeout.
+        :param dense_after: seconds before which the node is only checked
+                            sparsely, normally the expected time for the
+                            state change.
+        :returns: True if the state was reached, False on timeout.
+        """
+        if state not in self._checkers:
+            msg = "Unknown target state %s" % state
+            raise exception.ZVMDriverError(msg=msg)
+
+        waiter = _Waiter(node, timeout, dense_after,
+                         self._min_intervals[state])
+        self._waiters.setdefault(state, {}).setdefault(node, []).append(
+                                                                    waiter)
+        LOG.debug("Waiting for %(node)s to be %(state)s, %(num)d node(s) "
+                  "pending", {'node': node, 'state': state,
+                              'num': self.pending_count()})
+        if self._poller is None:
+            self._poller = eventlet.spawn(self._poll)
+        return waiter.event.wait()
+
+    def pending_count(self):
+        return sum(len(nodes) for nodes in self._waiters.values())
+
+    def _poll(self):
+        try:
+            while self._waiters:
+                self._tick()
+                if self._waiters:
+                    time.sleep(self._get_sleep_time())
+        except Exception as err:
+            # Never leave a caller blocked forever
+            emsg = zvmutils.format_exception_msg(err)
+            LOG.error("State waiter stopped unexpectedly: %s", emsg)
+            self._wake_all(False)
+        finally:
+            # Green threads are not preempted between the loop condition
+            # above and here, so a new waiter can't be lost in between.
+            self._poller = None
+
+    def _get_sleep_time(self):
+        """Sleep until the next check or deadline, at most the interval."""
+        wake_up = time.time() + self._interval
+        for nodes in self._waiters.values():
+            for waiters in nodes.values():
+                for waiter in waiters:
+                    wake_up = min(wake_up, waiter.next_check,
+                                  waiter.deadline or wake_up)
+        return max(0, wake_up - time.time())
+
+    def _tick(self):
+        for state, nodes in list(self._waiters.items()):
+            now = time.time()
+            node_list = [node for (node, waiters) in nodes.items()
+                         if any(w.due(now) for w in waiters)]
+            done = node_list and self._check(state, node_list) or ()
+
+            now = time.time()
+            for node in list(nodes.keys()):
+                if node in done:
+                    for waiter in nodes.pop(node):
+                        waiter.event.send(True)
+                    continue
+
+                waiters = nodes[node]
+                for waiter in waiters:
+                    if node in node_list:
+                        waiter.checked(now, self._interval)
+                for waiter in [w for w in waiters if w.expired(now)]:
+                    LOG.debug("Waiting for %(node)s to be %(state)s timeout",
+                              {'node': node, 'state': state})
+                    waiters.remove(waiter)
+                    waiter.event.send(False)
+                if not waiters:
+                    del nodes[node]
+
+            if not nodes:
+                del self._waiters[state]
+
+    def _check(self, state, nodes):
+        """Return the ones of nodes in state.
+
+        xCAT fails a noderange request when one of its nodes fails, so a
+        batch failed by xCAT is split in halves which are checked on their
+        own, and only the failing nodes are left to be checked again later.
+        When the request itself failed, xCAT being unavailable or busy for
+        example, the whole batch is checked again at the next tick instead
+        of sending more requests to it.
+        """
+        try:
+            return set(self._checkers[state](nodes))
+        except exception.ZVMBaseException as err:
+            if (len(nodes) == 1 or zvmutils.is_transient_error(err) or
+                    isinstance(err, (exception.ZVMXCATRequestFailed,
+                            exception.ZVMInvalidXCATResponseDataError))):
+                LOG.debug("Failed to check %(state)s of %(nodes)s, will "
+                          "re-try: %(err)s", {'state': state,
+                          'nodes': nodes, 'err': err.format_message()})
+                return set()
+
+        half = len(nodes) // 2
+        return (self._check(state, nodes[:half]) |
+                self._check(state, nodes[half:]))
+
+    def _wake_all(self, result):
+        for nodes in self._waiters.values():
+            for waiters in nodes.values():
+                for waiter in waiters:
+                    waiter.event.send(result)
+        self._waiters = {}
+
+
+class BootTimeModel(object):
+    """Observed power-on to reachable durations per image and distro.
+
+    The history is used to derive when an instance is expected to become
+    reachable, so it is polled sparsely before that and densely around
+    it. It does not shorten the time the instance is waited for, which
+    stays zvm_reachable_timeout, since a slow boot is not a failed one.
+    """
+
+    # Samples kept per key
+    MAX_SAMPLES = 20
+    # Samples needed before the history of a key is trusted
+    MIN_SAMPLES = 3
+    # Start dense polling at this fraction of the expected boot time
+    DENSE_RATIO = 0.8
+
+    def __init__(self):
+        self._samples = {}
+
+    def record(self, image, distro, seconds):
+        LOG.debug("Instance of image %(image)s (%(distro)s) became "
+                  "reachable in %(sec).1f seconds",
+                  {'image': image, 'distro': distro, 'sec': seconds})
+        for key in ((image, distro), (None, distro)):
+            samples = self._samples.setdefault(key, collections.deque(
+                                                maxlen=self.MAX_SAMPLES))
+            samples.append(seconds)
+
+    def _get_samples(self, image, distro):
+        # Fall back to the history of the distro for a new image
+        for key in ((image, distro), (None, distro)):
+            samples = self._samples.get(key, ())
+            if len(samples) >= self.MIN_SAMPLES:
+                return sorted(samples)
+        return None
+
+    def expected(self, image, distro):
+        """Median boot time in seconds, or None without enough history."""
+        samples = self._get_samples(image, distro)
+        return samples and samples[len(samples) // 2]
+
+    def dense_after(self, image, distro):
+        expected = self.expected(image, distro)
+        return expected and expected * self.DENSE_RATIO or 0
+
+
+def _get_node_values(res_info):
+    """Parse 'node: value' lines of a noderange request into a dict."""
+    values = {}
+    for info in res_info:
+        for item in info:
+            for line in item.split('\n'):
+                node, sep, value = line.partition(':')
+                if sep:
+                    values[node.strip()] = value.strip()
+    return values
+
+
+def get_power_stats(nodes):
+    """Get power state of many nodes with one rpower stat request."""
+    url = zvmutils.get_xcat_url().rpower('/' + ','.join(nodes))
+    res_dict = zvmutils.xcat_request("GET", url, ['stat'])
+
+    with zvmutils.expect_invalid_xcat_resp_data(res_dict):
+        stats = _get_node_values(res_dict['info'])
+
+    return dict((node, zvmutils.mapping_power_stat(stat))
+                for (node, stat) in stats.items())
+
+
+def get_powered_off_nodes(nodes):
+    stats = get_power_stats(nodes)
+    return set(node for node in nodes
+               if stats.get(node) == power_state.SHUTDOWN)
+
+
+def get_reachable_nodes(nodes, iucv=True):
+    """Get the reachable ones of nodes with one request."""
+    noderange = '/' + ','.join(nodes)
+    if iucv:
+        url = zvmutils.get_xcat_url().rpower(noderange)
+        res_dict = zvmutils.xcat_request("PUT", url, ['isreachable'])
+        with zvmutils.expect_invalid_xcat_resp_data(res_dict):
+            stats = _get_node_values(res_dict['info'])
+        return set(node for (node, stat) in stats.items()
+                   if stat == 'reachable')
+
+    url = zvmutils.get_xcat_url().nodestat(noderange)
+    res_dict = zvmutils.xcat_request("GET", url)
+    reachable = set()
+    with zvmutils.expect_invalid_xcat_resp_data(res_dict):
+        for node_info in res_dict['node']:
+            for stat in node_info:
+                status = stat['data'][0]
+                if status is not None and 'sshd' in status:
+                    reachable.add(stat['name'][0])
+    return reachable